@@ -1,17 +1,333 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable, Optional
+
+from sqlalchemy import bindparam, event, func, inspect, select, update
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-DATABASE_URL = "sqlite:///./patients.db"
+from .services.metrics import METRICS_ENABLED, record_query
 
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,
-    connect_args={"check_same_thread": False},
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./patients.db")
+# Async read path (aiosqlite) for the read-heavy endpoints; same database file.
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL", DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
 )
 
+# --- SQLite storage profile ---
+# WAL lets readers keep reading while a single writer appends to the log,
+# so a long /dedupe/run write no longer blocks intake or search traffic.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+# NORMAL is durable across application crashes in WAL mode; only an OS crash
+# can lose the last commits (FULL would fsync on every commit).
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))     # page cache per connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# --- Connection pool ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# --- Write serialization ---
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "32"))   # jobs sharing one commit
+# rows per writer job for bulk persists (ingest, dedupe run), so other writes interleave
+DB_WRITE_JOB_ROWS = int(os.getenv("DB_WRITE_JOB_ROWS", "5000"))
+
+_is_sqlite = DATABASE_URL.startswith("sqlite")
+_engine_kwargs: dict[str, Any] = {}
+if _is_sqlite:
+    _engine_kwargs["connect_args"] = {
+        "check_same_thread": False,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+    }
+if ":memory:" not in DATABASE_URL:
+    _engine_kwargs.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+engine = create_engine(DATABASE_URL, echo=False, **_engine_kwargs)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **_engine_kwargs)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, _connection_record):
+    # Let SQLAlchemy emit BEGIN itself: pysqlite's implicit transaction
+    # handling breaks SAVEPOINTs and cannot issue BEGIN IMMEDIATE.
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _begin_sqlite_transaction(conn):
+    # The writer takes the RESERVED lock up front, so it never fails with
+    # "database is locked" when upgrading a read transaction to a write.
+    if conn.get_execution_options().get("sqlite_immediate"):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        conn.exec_driver_sql("BEGIN")
+
+
+if _is_sqlite:
+    for _sync_engine in (engine, async_engine.sync_engine):
+        event.listen(_sync_engine, "connect", _apply_sqlite_pragmas)
+        event.listen(_sync_engine, "begin", _begin_sqlite_transaction)
+
+
+def _query_started(conn, _cursor, _statement, _parameters, _context, _executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _query_finished(conn, _cursor, _statement, _parameters, _context, _executemany):
+    record_query(time.perf_counter() - conn.info["query_start"].pop())
+
+
+def _query_failed(exc_context):
+    starts = exc_context.connection.info.get("query_start") if exc_context.connection is not None else None
+    if starts:
+        record_query(time.perf_counter() - starts.pop())
+
+
+if METRICS_ENABLED:
+    # query count and time per request and in total (see services/metrics.py)
+    for _sync_engine in (engine, async_engine.sync_engine):
+        event.listen(_sync_engine, "before_cursor_execute", _query_started)
+        event.listen(_sync_engine, "after_cursor_execute", _query_finished)
+        event.listen(_sync_engine, "handle_error", _query_failed)
+
+
 def init_db() -> None:
     from . import models  # ensure tables imported
     SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
+    _backfill_patient_keys()
+    _install_change_tracking()
+
+def _add_missing_columns() -> None:
+    """
+    Lightweight migration: create_all() never alters existing tables, so
+    columns added to a model later are appended here with ALTER TABLE.
+    New columns must be nullable (or have a server default).
+    """
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                col_type = col.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {col_type}')
+                if col.index:
+                    conn.exec_driver_sql(
+                        f'CREATE INDEX IF NOT EXISTS "ix_{table.name}_{col.name}" ON "{table.name}" ("{col.name}")'
+                    )
+
+def _backfill_patient_keys(chunk: int = 2000) -> None:
+    """Fill the Patient shadow key columns and content_hash for rows written before they existed."""
+    from .models import Patient
+    from .services.patient_keys import CONTENT_FIELDS, KEY_COLUMNS, content_hash, key_columns
+
+    t = Patient.__table__
+    raw_cols = [t.c.id] + [t.c[f] for f in CONTENT_FIELDS]
+    derived = KEY_COLUMNS + ["content_hash"]
+    stmt = (
+        update(t)
+        .where(t.c.id == bindparam("_pk"))
+        .values({c: bindparam(f"k_{c}") for c in derived})
+    )
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(*raw_cols).where(t.c.name_norm.is_(None) | t.c.content_hash.is_(None)).limit(chunk)
+            ).mappings().all()
+            if not rows:
+                return
+            params = []
+            for r in rows:
+                values = {**key_columns(r), "content_hash": content_hash(r)}
+                params.append({"_pk": r["id"], **{f"k_{c}": values[c] for c in derived}})
+            conn.execute(stmt, params)
+
+def _install_change_tracking() -> None:
+    """
+    Patient.change_seq orders patient changes by commit across every process:
+    each write draws it from a counter inside its write transaction, and
+    write transactions are serialized by the database's write lock. Core
+    writes reserve a block with next_change_seqs(); ORM writes are stamped
+    by the Patient mapper hooks (models.py). Rows from before the column
+    existed are numbered by id.
+    """
+    from .models import ChangeSequence, Patient
+    t, ct = Patient.__table__, ChangeSequence.__table__
+    with engine.begin() as conn:
+        conn.execute(update(t).where(t.c.change_seq.is_(None)).values(change_seq=t.c.id))
+        present = set(conn.execute(select(ct.c.name)).scalars())
+        for name in ("patient", "patient_delete"):
+            if name not in present:
+                conn.execute(ct.insert().values(name=name, value=0))
+        top = conn.execute(select(func.max(t.c.change_seq))).scalar() or 0
+        conn.execute(update(ct).where(ct.c.name == "patient", ct.c.value < top).values(value=top))
+
+
+def _bump_change_counter(conn, name: str, n: int) -> int:
+    from .models import ChangeSequence
+    ct = ChangeSequence.__table__
+    conn.execute(update(ct).where(ct.c.name == name).values(value=ct.c.value + n))
+    return conn.execute(select(ct.c.value).where(ct.c.name == name)).scalar_one()
+
+
+def next_change_seqs(conn, n: int) -> range:
+    """Reserve n patient change_seq values in the current write transaction (Session or Connection)."""
+    last = _bump_change_counter(conn, "patient", n)
+    return range(last - n + 1, last + 1)
+
+
+def count_patient_deletes(conn, n: int) -> None:
+    """Record n hard deletes of patients, so other processes' intake indexes rebuild."""
+    if n:
+        _bump_change_counter(conn, "patient_delete", n)
+
+
+def change_counters(session: Session) -> tuple[int, int]:
+    """(last patient change_seq, hard deletes so far) as seen by this session's transaction."""
+    from .models import ChangeSequence
+    values = dict(session.exec(select(ChangeSequence.name, ChangeSequence.value)).all())
+    return values.get("patient", 0), values.get("patient_delete", 0)
+
 
 def get_session() -> Session:
     with Session(engine) as session:
         yield session
+
+async def get_async_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
+class WriteQueue:
+    """
+    Single-writer queue. Every write job runs on one dedicated thread and
+    connection; jobs queued while a commit is in flight are grouped and
+    committed together, each inside its own SAVEPOINT so a failing job
+    (e.g. an HTTPException raised for a 409) only rolls back itself. If the
+    shared commit itself fails, the batch's jobs are re-run one per commit,
+    so only the job that cannot commit fails.
+
+    Jobs receive the writer Session and must not call commit() themselves;
+    they should return plain data (pydantic models, ids, counters), since
+    ORM instances are detached once the batch is committed. They may be run
+    a second time after a failed commit, so they must not depend on state
+    left by a previous attempt. Large writes should be split into jobs of
+    about DB_WRITE_JOB_ROWS rows so they do not hold the writer for long.
+    """
+
+    def __init__(self, bind, max_batch: int = DB_WRITE_BATCH_MAX):
+        self._bind = bind.execution_options(sqlite_immediate=True)
+        self._max_batch = max(1, max_batch)
+        self._jobs: "queue.Queue[tuple[Callable[[Session], Any], Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._current_session: Optional[Session] = None
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, fn: Callable[[Session], Any]) -> Future:
+        fut: Future = Future()
+        # the job runs in the submitter's context, so its queries count towards the submitting request
+        ctx = contextvars.copy_context()
+        self._jobs.put((lambda session: ctx.run(fn, session), fut))
+        self._ensure_started()
+        return fut
+
+    def run(self, fn: Callable[[Session], Any]) -> Any:
+        """Run fn(session) on the writer and wait for its commit."""
+        if threading.current_thread() is self._thread:
+            # nested call from inside a job: join the current transaction
+            return fn(self._current_session)
+        return self.submit(fn).result()
+
+    @property
+    def depth(self) -> int:
+        return self._jobs.qsize()
+
+    def _next_batch(self) -> list:
+        batch = [self._jobs.get()]
+        while len(batch) < self._max_batch:
+            try:
+                batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, jobs: list) -> Optional[BaseException]:
+        """
+        Runs jobs in one transaction. Jobs that raise are failed right away;
+        the others are resolved after the commit, or left pending (and the
+        error returned) when the commit fails.
+        """
+        done: list[tuple[Future, Any]] = []
+        try:
+            with Session(self._bind, expire_on_commit=False) as session:
+                self._current_session = session
+                for fn, fut in jobs:
+                    try:
+                        with session.begin_nested():
+                            result = fn(session)
+                    except BaseException as e:
+                        fut.set_exception(e)
+                    else:
+                        done.append((fut, result))
+                session.commit()
+        except BaseException as e:
+            return e
+        finally:
+            self._current_session = None
+        for fut, result in done:
+            fut.set_result(result)
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            batch = [(fn, fut) for fn, fut in self._next_batch() if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            error = self._commit(batch)
+            if error is None:
+                continue
+            pending = [(fn, fut) for fn, fut in batch if not fut.done()]
+            if len(pending) > 1:
+                # the shared commit failed: nothing was persisted; retry the jobs one
+                # per commit so a job that cannot commit does not fail its batch-mates
+                print(f"EROARE: Commit-ul unui lot de {len(batch)} scrieri a esuat ({error}); reiau individual.")
+                for job in pending:
+                    err = self._commit([job])
+                    if err is not None and not job[1].done():
+                        job[1].set_exception(err)
+            else:
+                for _, fut in pending:
+                    fut.set_exception(error)
+
+
+writer = WriteQueue(engine)
@@ -1,10 +1,31 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .db import init_db
-from .routers import ingest, dedupe, links, export, patients, auth, patients_intake
+from .routers import ingest, dedupe, links, export, patients, auth, patients_intake, metrics, profiling
+from .services.ai_logic.ai_core import reset_provider, warmup_provider
+from .services.ai_logic.config import AI_WARMUP_ON_STARTUP
+from .services.auto_merge import recover_interrupted_jobs
+from .services.metrics import METRICS_ENABLED, MetricsMiddleware
+from .services.profiling import PROFILING_ENABLED, ProfilingMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the AI provider in the background; the API serves requests meanwhile
+    # and /dedupe/ai_ready reports when it is usable.
+    if AI_WARMUP_ON_STARTUP:
+        warmup_provider()
+    # auto-merge jobs this process cannot be running yet were cut off by a restart
+    recover_interrupted_jobs()
+    yield
+    # stops the inference worker processes, if any
+    reset_provider()
+
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Patients Dedupe API", version="1.0.0")
+    app = FastAPI(title="Patients Dedupe API", version="1.0.0", lifespan=lifespan)
     app.include_router(ingest.router)
     app.include_router(dedupe.router)
     app.include_router(links.router)
@@ -12,6 +33,14 @@ def create_app() -> FastAPI:
     app.include_router(patients.router)
     app.include_router(auth.router)
     app.include_router(patients_intake.router)
+    if METRICS_ENABLED:
+        app.include_router(metrics.router)
+        # request latency, in-flight count and DB queries per route template
+        app.add_middleware(MetricsMiddleware)
+    if PROFILING_ENABLED:
+        app.include_router(profiling.router)
+        # admin-only, per request: X-Profile: 1 or ?profile=1
+        app.add_middleware(ProfilingMiddleware)
     return app
 
 init_db()
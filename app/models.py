@@ -1,7 +1,10 @@
 from datetime import datetime
 from typing import Optional
 from sqlmodel import SQLModel, Field
-from sqlalchemy import CheckConstraint
+from sqlalchemy import CheckConstraint, event
+from sqlalchemy.orm import object_session
+
+from .services.patient_keys import CONTENT_FIELDS, content_hash, key_columns
 
 # Patients imported - CSV
 class Patient(SQLModel, table=True):
@@ -22,12 +25,57 @@ class Patient(SQLModel, table=True):
     deleted_at: Optional[datetime] = None
     merged_into: Optional[str] = Field(default=None, index=True)
 
+    # normalized shadow columns (see services/patient_keys.py); kept in sync
+    # on every ORM insert/update, backfilled by init_db for older rows
+    phone_digits: Optional[str] = Field(default=None, index=True)
+    phone_last4: Optional[str] = Field(default=None, index=True)
+    email_norm: Optional[str] = Field(default=None, index=True)
+    email_domain: Optional[str] = Field(default=None, index=True)
+    name_norm: Optional[str] = Field(default=None, index=True)
+    name_phonetic: Optional[str] = None
+    dob_iso: Optional[str] = Field(default=None, index=True)
+
+    # change tracking: digest of the content fields, last change time, feed label
+    content_hash: Optional[str] = None
+    updated_at: Optional[datetime] = Field(default=None, index=True)
+    source: Optional[str] = None
+    # position in the commit order of patient changes (see db._install_change_tracking)
+    change_seq: Optional[int] = Field(default=None, index=True)
+
+@event.listens_for(Patient, "before_insert")
+@event.listens_for(Patient, "before_update")
+def _sync_patient_keys(_mapper, connection, target: Patient) -> None:
+    # before_update also fires for objects without net changes
+    sess = object_session(target)
+    changed = target.id is None or sess is None or sess.is_modified(target, include_collections=False)
+    raw = {f: getattr(target, f) for f in CONTENT_FIELDS}
+    for col, value in key_columns(raw).items():
+        setattr(target, col, value)
+    target.content_hash = content_hash(raw)
+    if changed:
+        from .db import next_change_seqs
+        target.updated_at = datetime.utcnow()
+        target.change_seq = next_change_seqs(connection, 1)[0]
+
+@event.listens_for(Patient, "after_delete")
+def _count_patient_delete(_mapper, connection, _target: Patient) -> None:
+    from .db import count_patient_deletes
+    count_patient_deletes(connection, 1)
+
 # Dedupe runs metadata
 class DedupeRun(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     model_version: Optional[str] = Field(default="v1")
     strategy: Optional[str] = Field(default="full")
+    artifact_path: Optional[str] = None  # pickled scoring artifacts (TF-IDF vectorizer, thresholds)
+    # running | completed | failed; None for runs from before the column (complete).
+    # Only complete runs count as "the latest run" (see utils.finished_runs).
+    status: Optional[str] = Field(default=None, index=True)
+    # optional post-run stage: precomputed AI merge suggestions (see services/suggestion_precompute.py)
+    suggestions_status: Optional[str] = None   # queued | running | done | failed
+    suggestions_total: Optional[int] = None
+    suggestions_done: Optional[int] = None
 
 # Links (pairs) results
 class Link(SQLModel, table=True):
@@ -60,10 +108,66 @@ class ClusterAssignment(SQLModel, table=True):
     record_id: str = Field(index=True)
     patient_id: str = Field(index=True)  # P00001 etc.
 
+# AI merge suggestions computed ahead of time for a run's review / match clusters
+class AISuggestion(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    run_id: int = Field(index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    cluster_key: str                        # patient_id (match cluster) or "review:<pid1>+<pid2>"
+    record_ids: str                         # sorted, comma-separated
+    records_hash: str = Field(index=True)   # digest of the members' content when computed
+    status: str = Field(default="ok")       # ok | error
+    human_review_required: Optional[bool] = None
+    suggestion: Optional[str] = None        # AIMergeSuggestionResponse as JSON
+    elapsed_s: Optional[float] = None
+    error: Optional[str] = None
+    telemetry: Optional[str] = None         # JSON totals of the LLM calls behind the suggestion (AI_TELEMETRY_PERSIST)
+
 class PatientMergeHistory(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     source_record: str
     target_record: str
     run_id: Optional[int] = None
-    reason: Optional[str] = None
\ No newline at end of file
+    reason: Optional[str] = None
+    # auto-merge jobs: the group's pre-merge state (JSON, on the group's first row) for undo
+    job_id: Optional[int] = Field(default=None, index=True)
+    undo: Optional[str] = None
+    undone_at: Optional[datetime] = None
+
+# Server-side auto-merge of a run's high-confidence clusters (see services/auto_merge.py)
+class AutoMergeJob(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    run_id: int = Field(index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None
+    status: str = Field(default="queued")    # queued | running | done | failed | undone
+    policy: Optional[str] = None             # AutoMergePolicy as JSON
+    clusters_total: Optional[int] = None
+    groups_total: Optional[int] = None       # clusters that passed the policy
+    groups_done: int = 0
+    records_merged: int = 0
+    errors: int = 0
+    error: Optional[str] = None
+# Chunked CSV ingest progress; a dropped upload resumes after chunks_committed
+class IngestBatch(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None
+    filename: Optional[str] = None
+    source: Optional[str] = None
+    chunk_size: int
+    status: str = Field(default="running", index=True)  # running | completed | failed
+    chunks_committed: int = 0
+    rows_committed: int = 0
+    inserted: int = 0
+    updated: int = 0
+    restored: int = 0
+    unchanged: int = 0
+    error: Optional[str] = None
+
+# Monotonic change counters (see db._install_change_tracking): "patient" hands
+# out Patient.change_seq, "patient_delete" counts hard deletes.
+class ChangeSequence(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    value: int = 0
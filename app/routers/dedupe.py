@@ -1,61 +1,325 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session
-from typing import List
-from ..db import get_session
-from ..models import DedupeRun, Link, ClusterAssignment
-from ..schemas import RunRequest
-from ..utils import df_from_patients_table, links_df_to_models, clusters_to_assignments
-from ..services.dedupe import run_pipeline 
-from ..services.auth_service import require_role
+import json
+import time
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import update
+from sqlmodel import Session, select
+from typing import List, Optional
+from ..db import DB_WRITE_JOB_ROWS, get_session, writer
+from ..models import AISuggestion, AutoMergeJob, DedupeRun, Link, ClusterAssignment, Patient
+from ..schemas import (RunRequest, AISuggestionSummary, RunSuggestionsOut, AutoMergePolicy, AutoMergeJobOut,
+                       AutoMergeUndoOut)
+from ..utils import PATIENTS_COLUMNS, df_from_patients_table, finished_runs, links_df_to_models, clusters_to_assignments
+from ..services.dedupe import run_pipeline, Embedder
+from ..services.model_registry import model_registry, save_run_artifacts
+from ..services.auth_service import get_current_user, require_role
 from ..schemas import PatientRecordInput, AIMergeSuggestionResponse
-from ..services.dedupe import suggest_ai_merge
+from ..services.dedupe import suggest_ai_merge, suggest_ai_merge_batch, suggest_ai_merge_events
+from ..services.ai_logic.decision_cache import decision_cache
+from ..services.ai_logic.rules import rules_stats
+from ..services.ai_logic.ai_core import inference_stats, provider_status
+from ..services.ai_logic.telemetry import telemetry
+from ..services.ai_logic.inference_pool import InferenceError
+from ..services.suggestion_precompute import lookup_suggestion, start_precompute, store_suggestion
+from ..services.auto_merge import dry_run as auto_merge_dry_run, start_auto_merge, undo_auto_merge
+from ..services.metrics import dedupe_stage_duration
 
 router = APIRouter(prefix="/dedupe", tags=["dedupe"])
 
 @router.post("/run", dependencies=[Depends(require_role("admin"))])
-def run_dedupe(session: Session = Depends(get_session)):
+def run_dedupe(
+    precompute_suggestions: bool = Query(False, description="Queue AI merge suggestions for review/match clusters"),
+    session: Session = Depends(get_session),
+):
     # 1) create run
-    run = DedupeRun(model_version="v1", strategy="full")
-    session.add(run)
-    session.commit()
-    session.refresh(run)
+    def _create_run(s: Session) -> int:
+        run = DedupeRun(model_version="v1", strategy="full", status="running")
+        s.add(run)
+        s.flush()
+        return run.id
+
+    run_id = writer.run(_create_run)
+
+    try:
+        # 2) get patients from DB
+        with dedupe_stage_duration.time("load"):
+            df_pat = df_from_patients_table(session)
+
+        # 3) run pipeline (no write lock is held while scoring)
+        embedder = Embedder()
+        links_df, clusters = run_pipeline(df_pat, embedder=embedder)
+
+        # 4) persist links
+        link_models = links_df_to_models(links_df, run_id=run_id)
+
+        # 5) persist cluster assignments (includes singletons)
+        assignments = clusters_to_assignments(clusters, run_id=run_id)
+
+        # 6) scoring artifacts for intake (vectorizer + thresholds), hot-swapped in this process
+        artifact_path = save_run_artifacts(run_id, embedder)
+
+        def _finish(s: Session) -> None:
+            run = s.get(DedupeRun, run_id)
+            run.artifact_path = artifact_path
+            run.status = "completed"
+            s.add(run)
+
+        # bounded writer jobs, so intake writes interleave with a large run's persist; the run
+        # only becomes "the latest run" once _finish marks it completed
+        with dedupe_stage_duration.time("persist"):
+            for rows in (link_models, assignments):
+                for i in range(0, len(rows), DB_WRITE_JOB_ROWS):
+                    writer.run(lambda s, part=rows[i:i + DB_WRITE_JOB_ROWS]: s.add_all(part))
+            writer.run(_finish)
+    except BaseException:
+        try:
+            writer.run(lambda s: s.execute(update(DedupeRun).where(DedupeRun.id == run_id).values(status="failed")))
+        except Exception as e:
+            print(f"EROARE: Rularea {run_id} nu a putut fi marcata ca esuata: {e}")
+        raise
+    model_registry.publish(run_id, artifact_path)
+    if precompute_suggestions:
+        start_precompute(run_id)
+    return {"run_id": run_id, "links_inserted": len(link_models), "clusters": int(clusters["patient_id"].nunique()),
+            "suggestions": "queued" if precompute_suggestions else None}
+
+
+@router.post("/runs/{run_id}/suggestions/precompute", status_code=202, tags=["AI Steward"],
+             dependencies=[Depends(require_role("admin"))])
+def precompute_run_suggestions(run_id: int):
+    """Queue the AI suggestion precompute stage for a finished run (runs in the background)."""
+    try:
+        queued = start_precompute(run_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"run_id": run_id, "queued": queued}
+
+
+@router.get("/runs/{run_id}/suggestions", response_model=RunSuggestionsOut, tags=["AI Steward"],
+            dependencies=[Depends(require_role("admin"))])
+def list_run_suggestions(
+    run_id: int,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    session: Session = Depends(get_session),
+):
+    """Progress of the precompute stage and the clusters it covered."""
+    run = session.get(DedupeRun, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    rows = session.exec(
+        select(AISuggestion).where(AISuggestion.run_id == run_id)
+        .order_by(AISuggestion.id).offset(offset).limit(limit)
+    ).all()
+    items = [
+        AISuggestionSummary(id=r.id, cluster_key=r.cluster_key, record_ids=r.record_ids.split(","),
+                            status=r.status, human_review_required=r.human_review_required,
+                            elapsed_s=r.elapsed_s, error=r.error,
+                            telemetry=json.loads(r.telemetry) if r.telemetry else None)
+        for r in rows
+    ]
+    return RunSuggestionsOut(run_id=run_id, status=run.suggestions_status, total=run.suggestions_total,
+                             done=run.suggestions_done, items=items)
 
-    # 2) get patients from DB
-    df_pat = df_from_patients_table(session)
 
-    # 3) run pipeline
-    links_df, clusters = run_pipeline(df_pat)
+@router.post("/runs/{run_id}/auto_merge", dependencies=[Depends(require_role("admin"))])
+def auto_merge_run(
+    run_id: int,
+    response: Response,
+    policy: AutoMergePolicy = Body(default_factory=AutoMergePolicy),
+    dry_run: bool = Query(False, description="Only return the plan (eligible clusters, masters, golden values)"),
+    limit: int = Query(100, ge=0, le=10000, description="Planned groups listed in a dry run"),
+):
+    """
+    Merges the run's clusters that pass the confidence policy: deterministic
+    master, rule-based golden record, batched set-based merges with undo data
+    in PatientMergeHistory. Runs in the background (202); poll
+    /dedupe/auto_merge/{job_id}. With dry_run the plan is returned instead.
+    """
+    try:
+        if dry_run:
+            return auto_merge_dry_run(run_id, policy, limit)
+        job_id, queued = start_auto_merge(run_id, policy)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    response.status_code = 202
+    return {"run_id": run_id, "job_id": job_id, "queued": queued}
+
+
+@router.get("/auto_merge/{job_id}", response_model=AutoMergeJobOut, dependencies=[Depends(require_role("admin"))])
+def get_auto_merge_job(job_id: int, session: Session = Depends(get_session)):
+    """Progress of an auto-merge job."""
+    job = session.get(AutoMergeJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Auto-merge job {job_id} not found")
+    out = job.model_dump()
+    out["policy"] = json.loads(job.policy) if job.policy else None
+    return AutoMergeJobOut(**out)
 
-    # 4) persist links
-    link_models = links_df_to_models(links_df, run_id=run.id)
-    session.add_all(link_models)
 
-    # 5) persist cluster assignments (includes singletons)
-    assignments = clusters_to_assignments(clusters, run_id=run.id)
-    session.add_all(assignments)
+@router.post("/auto_merge/{job_id}/undo", response_model=AutoMergeUndoOut,
+             dependencies=[Depends(require_role("admin"))])
+def undo_auto_merge_job(job_id: int):
+    """Reverts an auto-merge job's merges from the undo log (groups changed since then are skipped)."""
+    try:
+        return undo_auto_merge(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-    session.commit()
-    return {"run_id": run.id, "links_inserted": len(link_models), "clusters": len(clusters)}
+
+@router.get("/suggestion", response_model=AIMergeSuggestionResponse, tags=["AI Steward"],
+            dependencies=[Depends(get_current_user)])
+def get_merge_suggestion(
+    response: Response,
+    record_ids: str = Query(..., description="Comma-separated record_ids of the cluster (first = anchor)"),
+    session: Session = Depends(get_session),
+):
+    """
+    Suggestion for a cluster of stored patients: served from the precomputed
+    table when one exists for the records' current content, otherwise computed
+    live (and kept for the next request). X-Suggestion-Source tells which.
+    """
+    rids = list(dict.fromkeys(r.strip() for r in record_ids.split(",") if r.strip()))
+    if len(rids) < 2:
+        raise HTTPException(status_code=400,
+                            detail="Este necesar un minim de 2 inregistrari pentru o sugestie de fuziune.")
+    rows = {p.record_id: p for p in session.exec(select(Patient).where(Patient.record_id.in_(rids))).all()}
+    missing = [r for r in rids if r not in rows]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Unknown record_ids: {missing}")
+    records = [{c: getattr(rows[r], c) for c in PATIENTS_COLUMNS} for r in rids]
+
+    suggestion = lookup_suggestion(session, records)
+    if suggestion is not None:
+        response.headers["X-Suggestion-Source"] = "precomputed"
+        return suggestion
+
+    if provider_status()["status"] == "loading":
+        raise HTTPException(status_code=503, detail="Modelul AI inca se incarca.", headers={"Retry-After": "10"})
+    start = time.monotonic()
+    try:
+        suggestion = suggest_ai_merge(records)
+    except InferenceError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "5"})
+    if not suggestion or not suggestion.get("suggested_golden_record"):
+        raise HTTPException(status_code=500, detail="A aparut o eroare in timpul generarii sugestiei AI.")
+    latest = session.exec(select(DedupeRun.id).where(finished_runs()).order_by(DedupeRun.id.desc())).first()
+    store_suggestion(latest, records, suggestion, time.monotonic() - start)
+    response.headers["X-Suggestion-Source"] = "live"
+    return suggestion
 
 
 @router.post("/suggest_merge", response_model=AIMergeSuggestionResponse, tags=["AI Steward"])
-def ai_powered_merge_suggestion(records: List[PatientRecordInput]):
+def ai_powered_merge_suggestion(records: List[PatientRecordInput], response: Response,
+                                session: Session = Depends(get_session)):
     """
     Primeste un cluster de inregistrari (N > 1) si foloseste AI-ul pentru a
     sugera un Golden Record. Acest endpoint este ideal pentru a asista
     un operator uman in decizia de fuziune a inregistrarilor marcate pentru 'review'.
+    O sugestie precalculata pentru exact aceste inregistrari (acelasi continut) este servita direct.
     """
     if len(records) < 2:
         raise HTTPException(status_code=400,
                             detail="Este necesar un minim de 2 inregistrari pentru o sugestie de fuziune.")
+    precomputed = lookup_suggestion(session, [rec.model_dump() for rec in records])
+    if precomputed is not None:
+        response.headers["X-Suggestion-Source"] = "precomputed"
+        return precomputed
+    if provider_status()["status"] == "loading":
+        raise HTTPException(status_code=503, detail="Modelul AI inca se incarca.", headers={"Retry-After": "10"})
 
     # Convertim modelele Pydantic in dictionare simple
     records_as_dicts = [rec.model_dump() for rec in records]
 
     # Apelam serviciul care contine logica AI
-    suggestion = suggest_ai_merge(records_as_dicts)
+    try:
+        suggestion = suggest_ai_merge(records_as_dicts)
+    except InferenceError as e:
+        # coada de inferenta plina (429), pool indisponibil (503) sau timeout (504)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": "5"})
 
     if not suggestion or not suggestion.get("suggested_golden_record"):
         raise HTTPException(status_code=500, detail="A aparut o eroare in timpul generarii sugestiei AI.")
 
-    return suggestion
\ No newline at end of file
+    return suggestion
+
+@router.post("/suggest_merge/stream", tags=["AI Steward"])
+async def ai_powered_merge_suggestion_stream(records: List[PatientRecordInput]):
+    """
+    Same as /suggest_merge, streamed as Server-Sent Events: start, level_start,
+    iteration_start, field_resolved (source rule | cache | llm), cache_hit,
+    iteration_done, then one final `result` event whose data is an
+    AIMergeSuggestionResponse (or an `error` event).
+    """
+    if len(records) < 2:
+        raise HTTPException(status_code=400,
+                            detail="Este necesar un minim de 2 inregistrari pentru o sugestie de fuziune.")
+    if provider_status()["status"] == "loading":
+        raise HTTPException(status_code=503, detail="Modelul AI inca se incarca.", headers={"Retry-After": "10"})
+
+    records_as_dicts = [rec.model_dump() for rec in records]
+
+    async def _stream():
+        async for name, data in suggest_ai_merge_events(records_as_dicts):
+            if name == "result":
+                data = AIMergeSuggestionResponse.model_validate(data).model_dump()
+            yield f"event: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    return StreamingResponse(_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/suggest_merge_batch", tags=["AI Steward"])
+async def ai_powered_merge_suggestion_batch(
+    clusters: List[List[PatientRecordInput]],
+    item_timeout_s: Optional[float] = Query(None, gt=0, description="Per-cluster timeout (default AI_ITEM_TIMEOUT_S)"),
+):
+    """
+    Sugestii AI pentru mai multe clustere deodata. Clusterele sunt procesate
+    concurent (limitat per provider) iar rezultatele sunt trimise ca NDJSON,
+    in ordinea in care se termina; `index` indica pozitia clusterului in cerere.
+    Ultima linie este un sumar.
+    """
+    payload = [[rec.model_dump() for rec in recs] for recs in clusters]
+
+    async def _stream():
+        counts = {"ok": 0, "timeout": 0, "error": 0}
+        async for item in suggest_ai_merge_batch(payload, item_timeout_s):
+            counts[item["status"]] += 1
+            yield json.dumps(item, default=str) + "\n"
+        yield json.dumps({"done": True, "total": len(payload), **counts}) + "\n"
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+@router.get("/ai_cache/stats", tags=["AI Steward"], dependencies=[Depends(require_role("admin"))])
+def ai_cache_stats():
+    """Hit/miss counters and sizes of the AI merge decision cache."""
+    return decision_cache.stats()
+
+
+@router.get("/ai_rules/stats", tags=["AI Steward"], dependencies=[Depends(require_role("admin"))])
+def ai_rules_stats():
+    """How many conflicts (and whole LLM calls) the rule-based pre-resolver settled."""
+    return rules_stats()
+
+
+@router.get("/ai_ready", tags=["AI Steward"])
+def ai_ready():
+    """Readiness of the AI provider: 200 once it is loaded, 503 while loading / not loaded / failed."""
+    status = provider_status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@router.get("/ai_inference/stats", tags=["AI Steward"], dependencies=[Depends(require_role("admin"))])
+def ai_inference_stats():
+    """Queue depth, latency percentiles and worker health of the inference pool, plus JSON decoding / fixer counters."""
+    return inference_stats()
+
+
+@router.get("/ai_telemetry/stats", tags=["AI Steward"], dependencies=[Depends(require_role("admin"))])
+def ai_telemetry_stats():
+    """Per provider/model LLM call telemetry: tokens, latency / time-to-first-token percentiles, fixer retries, cache hit rate."""
+    return telemetry.stats()
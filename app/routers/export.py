@@ -1,24 +1,19 @@
 from io import StringIO
 import pandas as pd
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from sqlmodel import Session, select
-from ..utils import resolve_run_id
-from ..db import get_session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..utils import resolve_run_id_async
+from ..db import get_async_session
 from ..models import Link
 from ..services.auth_service import get_current_user
 
 router = APIRouter(prefix="/export", tags=["export"])
 
-@router.get("/links.csv",  dependencies=[Depends(get_current_user)])
-def export_links_csv(
-    run_id: int | None = Query(None, description="If omitted, latest run will be used"),
-    session: Session = Depends(get_session),
-):
-    run_id = resolve_run_id(session, run_id)
-    rows = session.exec(select(Link).where(Link.run_id == run_id)).all()
-    if not rows:
-        raise HTTPException(status_code=404, detail="Nu există link-uri pentru run_id")
+
+def _links_csv(rows) -> StringIO:
     df = pd.DataFrame([{
         "record_id1": r.record_id1,
         "record_id2": r.record_id2,
@@ -38,6 +33,19 @@ def export_links_csv(
     f = StringIO()
     df.to_csv(f, index=False)
     f.seek(0)
+    return f
+
+
+@router.get("/links.csv",  dependencies=[Depends(get_current_user)])
+async def export_links_csv(
+    run_id: int | None = Query(None, description="If omitted, latest run will be used"),
+    session: AsyncSession = Depends(get_async_session),
+):
+    run_id = await resolve_run_id_async(session, run_id)
+    rows = (await session.exec(select(Link).where(Link.run_id == run_id))).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Nu există link-uri pentru run_id")
+    f = await run_in_threadpool(_links_csv, rows)   # pandas off the event loop
     return StreamingResponse(
         f, media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename=patients_links_run_{run_id}.csv"}
@@ -1,13 +1,31 @@
+import itertools
+import json
+import os
+import shutil
+import tempfile
+from typing import Iterator, Optional
+
 import pandas as pd
 from datetime import datetime
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import bindparam, insert, select, update
 from sqlalchemy.exc import IntegrityError
-from sqlmodel import Session, select
+from sqlmodel import Session
+
+try:  # optional: faster, multi-threaded CSV parsing for the streaming ingest
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
 
-from ..db import get_session
-from ..models import Patient
-from ..schemas import IngestResponse
+from ..db import change_counters, get_session, next_change_seqs, writer
+from ..models import IngestBatch, Patient
+from ..schemas import IngestBatchOut, IngestChanges, IngestResponse
 from ..services.auth_service import require_role
+from ..services.intake_index import intake_index
+from ..services.patient_keys import content_hash, key_columns
 
 router = APIRouter(prefix="/ingest", tags=["ingest"])
 
@@ -16,6 +34,143 @@ EXPECTED = [
     "address","city","county","ssn","phone_number","email"
 ]
 
+# record_ids per IN (...) lookup; stays below SQLite's bound-parameter limit
+INGEST_LOOKUP_CHUNK = int(os.getenv("INGEST_LOOKUP_CHUNK", "900"))
+# rows per committed chunk of /ingest/patients-csv/stream
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "50000"))
+
+
+def _existing_by_record_id(session: Session, rids: list[str]) -> dict[str, dict]:
+    """record_id -> {record_id, is_deleted, deleted_at, merged_into, content_hash} for the rids already in the table."""
+    t = Patient.__table__
+    cols = [t.c.record_id, t.c.is_deleted, t.c.deleted_at, t.c.merged_into, t.c.content_hash]
+    out: dict[str, dict] = {}
+    for i in range(0, len(rids), INGEST_LOOKUP_CHUNK):
+        chunk = rids[i:i + INGEST_LOOKUP_CHUNK]
+        for row in session.execute(select(*cols).where(t.c.record_id.in_(chunk))).mappings():
+            out[row["record_id"]] = dict(row)
+    return out
+
+
+def bulk_upsert_patients(session: Session, rows: list[dict], restore_deleted: bool,
+                         reject_merged: bool, src: str, now: datetime) -> IngestResponse:
+    """
+    Set-based upsert of CSV rows (dicts with the EXPECTED fields) inside a writer job.
+
+    Existing rows are loaded with a few IN queries and every CSV row is
+    classified in memory (insert / update / restore / merged), then applied
+    with one executemany INSERT and one executemany UPDATE. Semantics match
+    the former row-by-row loop: a record merged into a master is rejected with
+    409 (reject_merged) or redirected to its master; a soft-deleted record is
+    restored when restore_deleted; a record_id repeated in the file is
+    inserted once and then counted as an update (last row wins).
+
+    Rows whose content_hash equals the stored one (and need no restore) are
+    counted as unchanged and not written at all; changed_record_ids lists the
+    inserted / updated / restored records for incremental consumers.
+    """
+    t = Patient.__table__
+    rids = list(dict.fromkeys(r["record_id"] for r in rows))
+    existing = _existing_by_record_id(session, rids)
+
+    if not reject_merged:
+        masters = {e["merged_into"] for e in existing.values() if e["merged_into"]}
+        missing = [m for m in masters if m not in existing]
+        existing.update(_existing_by_record_id(session, missing))
+
+    inserts: dict[str, dict] = {}
+    updates: dict[str, dict] = {}
+    changed: dict[str, None] = {}
+    inserted = updated = restored = unchanged = 0
+
+    for r in rows:
+        rid = r["record_id"]
+        values = {c: r[c] for c in EXPECTED if c != "record_id"}
+        values.update(key_columns(values))
+        values["content_hash"] = content_hash(values)
+        values["source"] = src
+        values["updated_at"] = now
+
+        if rid in inserts:
+            # repeated in this file after being inserted by an earlier row
+            if inserts[rid]["content_hash"] == values["content_hash"]:
+                unchanged += 1
+            else:
+                inserts[rid].update(values)
+                updated += 1
+            continue
+
+        obj = existing.get(rid)
+        if obj is None:
+            inserts[rid] = {"record_id": rid, **values, "is_deleted": False, "deleted_at": None, "merged_into": None}
+            changed[rid] = None
+            inserted += 1
+            continue
+
+        # If the record was merged into a master, protect it
+        target = obj
+        if obj["merged_into"]:
+            if reject_merged:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Record {rid} was merged into {obj['merged_into']}; update rejected."
+                )
+            # Alternative policy: propagate the update to the master
+            target = existing.get(obj["merged_into"])
+            if target is None and obj["merged_into"] in inserts:
+                if inserts[obj["merged_into"]]["content_hash"] == values["content_hash"]:
+                    unchanged += 1
+                else:
+                    inserts[obj["merged_into"]].update(values)
+                    updated += 1
+                continue
+            if target is None:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Record {rid} references missing master {obj['merged_into']}."
+                )
+
+        # If it was soft-deleted and appears again -> restore (if allowed)
+        restore = bool(target["is_deleted"] and restore_deleted)
+        if not restore and target["content_hash"] == values["content_hash"]:
+            unchanged += 1
+            continue
+        if restore:
+            target["is_deleted"] = False
+            target["deleted_at"] = None
+            restored += 1
+        target["content_hash"] = values["content_hash"]
+
+        updates[target["record_id"]] = {
+            "_rid": target["record_id"], **values,
+            "is_deleted": target["is_deleted"], "deleted_at": target["deleted_at"],
+        }
+        changed[target["record_id"]] = None
+        updated += 1
+
+    # one block of change_seq values for the whole job (see db._install_change_tracking)
+    seqs = iter(next_change_seqs(session, len(inserts) + len(updates)))
+    for values in (*inserts.values(), *updates.values()):
+        values["change_seq"] = next(seqs)
+    if inserts:
+        session.execute(insert(t), list(inserts.values()))
+    if updates:
+        cols = [c for c in next(iter(updates.values())) if c != "_rid"]
+        stmt = (
+            update(t)
+            .where(t.c.record_id == bindparam("_rid"))
+            .values({c: bindparam(f"v_{c}") for c in cols})
+        )
+        session.execute(stmt, [
+            {"_rid": u["_rid"], **{f"v_{c}": u[c] for c in cols}} for u in updates.values()
+        ])
+
+    return IngestResponse(
+        inserted=inserted, updated=updated, restored=restored, unchanged=unchanged,
+        changed_record_ids=list(changed),
+    )
+
+
 @router.post(
     "/patients-csv",
     response_model=IngestResponse,
@@ -23,7 +178,6 @@ EXPECTED = [
 )
 def ingest_patients_csv(
     file: UploadFile = File(...),
-    session: Session = Depends(get_session),
     restore_deleted: bool | None = Query(True, description="If a soft-deleted record reappears, restore it"),
     reject_merged: bool | None = Query(True, description="If record was merged into another, reject updates (409)"),
     source: str | None = Query(None, description="Optional logical source label"),
@@ -40,102 +194,334 @@ def ingest_patients_csv(
     if missing:
         raise HTTPException(status_code=400, detail=f"Missing columns in CSV: {missing}")
 
-    inserted = updated = 0
     now = datetime.utcnow()
     src = source or file.filename
+    rows = df[EXPECTED].to_dict("records")
 
+    # one writer job: the whole file commits or nothing does (/patients-csv/stream commits in chunks)
     try:
-        for _, r in df.iterrows():
-            rid = str(r["record_id"])
-            obj = session.exec(select(Patient).where(Patient.record_id == rid)).first()
-
-            if obj:
-                # If the record was merged into a master, protect it
-                if obj.merged_into:
-                    if reject_merged:
-                        raise HTTPException(
-                            status_code=409,
-                            detail=f"Record {rid} was merged into {obj.merged_into}; update rejected."
-                        )
-                    else:
-                        # Alternative policy: propagate the update to the master
-                        master = session.exec(
-                            select(Patient).where(Patient.record_id == obj.merged_into)
-                        ).first()
-                        if not master:
-                            raise HTTPException(
-                                status_code=409,
-                                detail=f"Record {rid} references missing master {obj.merged_into}."
-                            )
-                        target = master
-                else:
-                    target = obj
-
-                # If it was soft-deleted and appears again -> restore (if allowed)
-                if target.is_deleted and restore_deleted:
-                    target.is_deleted = False
-                    target.deleted_at = None
-
-                # Update fields
-                target.original_record_id = str(r["original_record_id"])
-                target.first_name = str(r["first_name"])
-                target.last_name  = str(r["last_name"])
-                target.gender     = str(r["gender"])
-                target.date_of_birth = str(r["date_of_birth"])
-                target.address    = str(r["address"])
-                target.city       = str(r["city"])
-                target.county     = str(r["county"])
-                target.ssn        = str(r["ssn"])
-                target.phone_number = str(r["phone_number"])
-                target.email      = str(r["email"])
-                # Optional audit
-                if hasattr(target, "source"):
-                    target.source = src
-                if hasattr(target, "updated_at"):
-                    target.updated_at = now
-
-                updated += 1
-
-            else:
-                # New insert
-                newp = Patient(
-                    record_id=rid,
-                    original_record_id=str(r["original_record_id"]),
-                    first_name=str(r["first_name"]),
-                    last_name=str(r["last_name"]),
-                    gender=str(r["gender"]),
-                    date_of_birth=str(r["date_of_birth"]),
-                    address=str(r["address"]),
-                    city=str(r["city"]),
-                    county=str(r["county"]),
-                    ssn=str(r["ssn"]),
-                    phone_number=str(r["phone_number"]),
-                    email=str(r["email"]),
-                )
-                if hasattr(newp, "is_deleted"):
-                    newp.is_deleted = False
-                if hasattr(newp, "deleted_at"):
-                    newp.deleted_at = None
-                if hasattr(newp, "merged_into"):
-                    newp.merged_into = None
-                if hasattr(newp, "source"):
-                    newp.source = src
-                if hasattr(newp, "updated_at"):
-                    newp.updated_at = now
-
-                session.add(newp)
-                inserted += 1
-
-        session.commit()
-
-    except HTTPException as e:
-        session.rollback()
-        raise HTTPException(status_code=e.status_code, detail=e.detail)
+        result = writer.run(lambda s: bulk_upsert_patients(
+            s, rows, bool(restore_deleted), bool(reject_merged), src, now
+        ))
     except IntegrityError as e:
-        session.rollback()
         raise HTTPException(status_code=409, detail=f"Integrity error: {e.orig}")  # e.g. duplicate key
-    # except Exception as e:
-    #     session.rollback()
-    #     raise HTTPException(status_code=500, detail=f"Ingest error: {e}")
+    finally:
+        # bulk change: rebuild the intake index lazily instead of patching it row by row
+        intake_index.invalidate()
+    return result
+
+
+# =============================
+# Streaming (chunked, resumable) ingest
+# =============================
+def _iter_csv_chunks(path: str, chunk_size: int, engine: str) -> Iterator[pd.DataFrame]:
+    """
+    Yields DataFrames of exactly chunk_size rows (the last one may be shorter),
+    all values as strings. Chunk boundaries depend only on chunk_size, so a
+    resumed upload of the same file lines up with the committed chunks.
+    """
+    if engine == "pyarrow":
+        reader = pa_csv.open_csv(
+            path,
+            convert_options=pa_csv.ConvertOptions(
+                column_types={c: pa.string() for c in EXPECTED},
+                strings_can_be_null=False,
+            ),
+        )
+        buf: list[pd.DataFrame] = []
+        buffered = 0
+        for batch in reader:
+            buf.append(batch.to_pandas())
+            buffered += batch.num_rows
+            while buffered >= chunk_size:
+                df = pd.concat(buf, ignore_index=True)
+                yield df.iloc[:chunk_size].fillna("").astype(str)
+                rest = df.iloc[chunk_size:]
+                buf, buffered = [rest], len(rest)
+        if buffered:
+            yield pd.concat(buf, ignore_index=True).fillna("").astype(str)
+    else:
+        for df in pd.read_csv(path, dtype=str, chunksize=chunk_size):
+            yield df.fillna("")
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _ndjson(obj: dict) -> str:
+    return json.dumps(obj, default=str) + "\n"
+
+
+@router.post(
+    "/patients-csv/stream",
+    dependencies=[Depends(require_role("admin"))],
+)
+def ingest_patients_csv_stream(
+    file: UploadFile = File(...),
+    restore_deleted: bool | None = Query(True, description="If a soft-deleted record reappears, restore it"),
+    reject_merged: bool | None = Query(True, description="If record was merged into another, reject updates (409)"),
+    source: str | None = Query(None, description="Optional logical source label"),
+    chunk_size: int = Query(INGEST_CHUNK_ROWS, ge=1, description="Rows per committed chunk"),
+    csv_engine: str = Query("auto", pattern="^(auto|pyarrow|pandas)$", description="CSV parser"),
+    batch_id: Optional[int] = Query(None, description="Resume this batch: chunks already committed are skipped"),
+    stop_on_error: bool = Query(True, description="Stop at the first failing chunk (else skip it and go on)"),
+    session: Session = Depends(get_session),
+):
+    """
+    Streaming ingest for very large CSV files. The upload is parsed in
+    fixed-size chunks; each chunk is upserted (same rules as /patients-csv)
+    in its own transaction together with the IngestBatch progress row.
+    The response is NDJSON: one line per chunk, then a summary line.
+    If the connection drops, re-upload the same file with batch_id to
+    continue after the last committed chunk (the batch is marked failed
+    meanwhile). A completed batch cannot be resumed; of two concurrent
+    uploads of one batch, each chunk is applied by only one of them.
+    """
+    if not file.filename.endswith(".csv"):
+        raise HTTPException(status_code=400, detail="Please upload a CSV file.")
+    if csv_engine == "pyarrow" and pa_csv is None:
+        raise HTTPException(status_code=400, detail="pyarrow is not installed.")
+    engine = csv_engine if csv_engine != "auto" else ("pyarrow" if pa_csv is not None else "pandas")
+
+    if batch_id is not None:
+        batch = session.get(IngestBatch, batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail=f"Ingest batch {batch_id} not found")
+        if batch.filename != file.filename:
+            raise HTTPException(status_code=409, detail=f"Batch {batch_id} was started for {batch.filename}")
+        if batch.status == "completed":
+            raise HTTPException(status_code=409, detail=f"Batch {batch_id} is already completed")
+        chunk_size = batch.chunk_size  # same boundaries as the interrupted upload
+    else:
+        src = source or file.filename
+        batch_id = writer.run(lambda s: _new_batch(s, file.filename, src, chunk_size))
+        batch = session.get(IngestBatch, batch_id)
+    src = batch.source or file.filename
+    skip = batch.chunks_committed
+
+    # UploadFile is closed once the endpoint returns, before the body streams
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(file.file, out)
+    except BaseException:
+        _remove_quietly(path)
+        raise
+
+    state = {"started": False}
+
+    def _progress() -> Iterator[str]:
+        state["started"] = True
+        now = datetime.utcnow()
+        failed = None
+        superseded = False
+        chunks = _iter_csv_chunks(path, chunk_size, engine)
+        try:
+            for i in itertools.count():
+                # read / parse errors and write errors are reported apart
+                try:
+                    df = next(chunks, None)
+                    if df is None:
+                        break
+                    if i == 0:
+                        missing = set(EXPECTED) - set(df.columns)
+                        if missing:
+                            failed = f"Missing columns in CSV: {missing}"
+                            yield _ndjson({"chunk": i, "status": "error", "error": failed})
+                            break
+                    rows = df[EXPECTED].to_dict("records") if i >= skip else None
+                except Exception as e:
+                    failed = f"CSV read error at chunk {i}: {e}"
+                    yield _ndjson({"chunk": i, "status": "error", "error": failed})
+                    break
+                if i < skip:
+                    yield _ndjson({"chunk": i, "status": "skipped", "rows": len(df)})
+                    continue
+                try:
+                    res = writer.run(lambda s: _apply_chunk(
+                        s, batch_id, i, rows, bool(restore_deleted), bool(reject_merged), src, now
+                    ))
+                except _ChunkConflict as e:
+                    # another upload of this batch got there first: leave the batch to it
+                    superseded = True
+                    yield _ndjson({"chunk": i, "status": "error", "rows": len(rows), "error": str(e)})
+                    break
+                except (HTTPException, IntegrityError) as e:
+                    err = e.detail if isinstance(e, HTTPException) else f"Integrity error: {e.orig}"
+                    yield _ndjson({"chunk": i, "status": "error", "rows": len(rows), "error": err})
+                    if stop_on_error:
+                        failed = f"chunk {i}: {err}"
+                        break
+                    try:
+                        writer.run(lambda s: _skip_chunk(s, batch_id, i, f"chunk {i}: {err}"))
+                    except _ChunkConflict as e:
+                        superseded = True
+                        yield _ndjson({"chunk": i, "status": "error", "error": str(e)})
+                        break
+                    continue
+                except Exception as e:
+                    # the database itself failed (locked, disk, ...): not worth trying the next chunk
+                    failed = f"chunk {i}: write error: {e}"
+                    yield _ndjson({"chunk": i, "status": "error", "rows": len(rows), "error": failed})
+                    break
+                yield _ndjson({"chunk": i, "status": "committed", "rows": len(rows), **res.model_dump()})
+        except GeneratorExit:
+            # the client went away: the committed chunks stay, the batch can be resumed
+            _interrupt_batch(batch_id)
+            raise
+        finally:
+            chunks.close()
+            _remove_quietly(path)
+            intake_index.invalidate()
+
+        if superseded:
+            yield _ndjson({"done": True, "status": "superseded", "batch_id": batch_id,
+                           "error": "Another upload is resuming this batch."})
+            return
+        final = writer.run(lambda s: _finish_batch(s, batch_id, failed))
+        yield _ndjson({"done": True, "status": "failed" if failed else "completed", "error": failed,
+                       **final.model_dump()})
+
+    body = _progress()
+
+    def _after_response() -> None:
+        # runs even when the body never started or the client disconnected mid-stream
+        try:
+            body.close()
+        except ValueError:
+            pass   # a chunk is still being applied in a worker thread; closed when collected
+        if not state["started"]:
+            _interrupt_batch(batch_id)
+        _remove_quietly(path)
+
+    return StreamingResponse(body, media_type="application/x-ndjson",
+                             background=BackgroundTask(_after_response))
+
+
+@router.get(
+    "/batches/{batch_id}",
+    response_model=IngestBatchOut,
+    dependencies=[Depends(require_role("admin"))],
+)
+def get_ingest_batch(batch_id: int, session: Session = Depends(get_session)):
+    batch = session.get(IngestBatch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"Ingest batch {batch_id} not found")
+    return batch
 
-    return IngestResponse(inserted=inserted, updated=updated)
+
+def _new_batch(session: Session, filename: str, src: str, chunk_size: int) -> int:
+    batch = IngestBatch(filename=filename, source=src, chunk_size=chunk_size)
+    session.add(batch)
+    session.flush()
+    return batch.id
+
+
+class _ChunkConflict(Exception):
+    """The chunk is not the batch's next one: another upload of the batch already moved past it."""
+
+
+def _claim_chunk(session: Session, batch_id: int, chunk: int) -> IngestBatch:
+    # compare-and-set on the progress mark, in the same transaction as the chunk's rows
+    t = IngestBatch.__table__
+    claimed = session.execute(
+        update(t).where(t.c.id == batch_id, t.c.chunks_committed == chunk)
+        .values(chunks_committed=chunk + 1)
+    ).rowcount
+    if not claimed:
+        raise _ChunkConflict(f"Chunk {chunk} of batch {batch_id} was already committed by another upload.")
+    return session.get(IngestBatch, batch_id, populate_existing=True)
+
+
+def _apply_chunk(session: Session, batch_id: int, chunk: int, rows: list[dict], restore_deleted: bool,
+                 reject_merged: bool, src: str, now: datetime) -> IngestResponse:
+    # the chunk and its progress mark commit together, and only if the mark is still at this
+    # chunk, so a resume (even a concurrent one) never re-applies or skips rows
+    batch = _claim_chunk(session, batch_id, chunk)
+    res = bulk_upsert_patients(session, rows, restore_deleted, reject_merged, src, now)
+    batch.rows_committed += len(rows)
+    batch.inserted += res.inserted
+    batch.updated += res.updated
+    batch.restored += res.restored
+    batch.unchanged += res.unchanged
+    batch.status = "running"
+    res.batch_id = batch_id
+    return res
+
+
+def _skip_chunk(session: Session, batch_id: int, chunk: int, error: str) -> None:
+    batch = _claim_chunk(session, batch_id, chunk)
+    batch.error = f"{batch.error}; {error}" if batch.error else error
+
+
+def _interrupt_batch(batch_id: int) -> None:
+    def _mark(s: Session) -> None:
+        batch = s.get(IngestBatch, batch_id)
+        if batch.status == "running":
+            batch.status = "failed"
+            batch.error = (f"upload interrupted after {batch.chunks_committed} chunk(s); "
+                           f"resume with batch_id={batch_id}")
+    try:
+        writer.run(_mark)
+    except Exception as e:
+        print(f"EROARE: Lotul de import {batch_id} nu a putut fi marcat ca intrerupt: {e}")
+
+
+def _finish_batch(session: Session, batch_id: int, failed: Optional[str]) -> IngestResponse:
+    batch = session.get(IngestBatch, batch_id)
+    if failed:
+        batch.status = "failed"
+        batch.error = failed
+    else:
+        batch.status = "completed"
+        batch.finished_at = datetime.utcnow()
+    return IngestResponse(
+        inserted=batch.inserted, updated=batch.updated, restored=batch.restored,
+        unchanged=batch.unchanged, batch_id=batch.id,
+    )
+
+
+@router.get(
+    "/changes",
+    response_model=IngestChanges,
+    dependencies=[Depends(require_role("admin"))],
+)
+def list_changed_records(
+    since_seq: int = Query(0, ge=0, description="Cursor: next_seq from the previous call (0 = from the start)"),
+    since: Optional[datetime] = Query(None, description="Only records last changed after this time (UTC)"),
+    limit: int = Query(10000, ge=1, le=100000),
+    session: Session = Depends(get_session),
+):
+    """
+    Incremental feed for downstream processing: record_ids whose content or
+    status changed after the cursor (ingest, intake, edits, merges, deletes),
+    in commit order. The cursor is Patient.change_seq, drawn inside each write
+    transaction, so a write that commits late still lands after the cursor
+    (updated_at is stamped before the commit and could fall behind a poll).
+    Keep calling with since_seq=next_seq; `since` only trims the first poll.
+    """
+    t = Patient.__table__
+    cond = t.c.change_seq > since_seq
+    if since is not None:
+        cond = cond & (t.c.updated_at > since)
+    rows = session.execute(
+        select(t.c.record_id, t.c.change_seq)
+        .where(cond)
+        .order_by(t.c.change_seq)
+        .limit(limit)
+    ).all()
+    if len(rows) == limit:
+        next_seq = rows[-1].change_seq
+    else:
+        # caught up: skip past the changes `since` filtered out too
+        next_seq = max(since_seq, change_counters(session)[0])
+    return IngestChanges(
+        since_seq=since_seq,
+        record_ids=[r.record_id for r in rows],
+        has_more=len(rows) == limit,
+        next_seq=next_seq,
+    )
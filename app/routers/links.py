@@ -1,50 +1,59 @@
 from typing import Optional, List, Dict, Any
 from fastapi import APIRouter, Depends, Query, HTTPException
-from sqlmodel import Session, select
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..db import get_session
+from ..db import get_async_session
 from ..models import Link, ClusterAssignment
 from ..schemas import LinkOut, ClustersResponse, ClusterItem
 from ..services.auth_service import get_current_user
 
 router = APIRouter(prefix="/links", tags=["links"])
 
+
+def _group_clusters(rows) -> ClustersResponse:
+    clusters: Dict[str, List[str]] = {}
+    for patient_id, record_id in rows:
+        clusters.setdefault(patient_id, []).append(record_id)
+    for k in clusters:
+        clusters[k] = sorted(clusters[k])
+
+    items = [ClusterItem(cluster_id=k, records=v) for k, v in sorted(clusters.items())]
+    return ClustersResponse(clusters=items)
+
+
 @router.get("", response_model=List[LinkOut])
-def list_links(
+async def list_links(
     run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
     decision: Optional[str] = Query(None, pattern="^(match|review|non-match)$"),
     limit: int = 100,
     offset: int = 0,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    from ..utils import resolve_run_id
-    run_id = resolve_run_id(session, run_id)
+    from ..utils import resolve_run_id_async
+    run_id = await resolve_run_id_async(session, run_id)
 
     q = select(Link).where(Link.run_id == run_id)
     if decision:
         q = q.where(Link.decision == decision)
     q = q.order_by(Link.id).offset(offset).limit(limit)
-    rows = session.exec(q).all()
+    rows = (await session.exec(q)).all()
     return [LinkOut.model_validate(r.__dict__) for r in rows]
 
 
 @router.get("/clusters", response_model=ClustersResponse, dependencies=[Depends(get_current_user)])
-def get_clusters(
+async def get_clusters(
     run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    from ..utils import resolve_run_id
-    run_id = resolve_run_id(session, run_id)
+    from ..utils import resolve_run_id_async
+    run_id = await resolve_run_id_async(session, run_id)
 
-    rows = session.exec(select(ClusterAssignment).where(ClusterAssignment.run_id == run_id)).all()
+    rows = (await session.exec(
+        select(ClusterAssignment.patient_id, ClusterAssignment.record_id).where(ClusterAssignment.run_id == run_id)
+    )).all()
     if not rows:
         return ClustersResponse(clusters=[])
-
-    clusters: Dict[str, List[str]] = {}
-    for a in rows:
-        clusters.setdefault(a.patient_id, []).append(a.record_id)
-    for k in clusters:
-        clusters[k] = sorted(clusters[k])
-
-    items = [ClusterItem(cluster_id=k, records=v) for k, v in sorted(clusters.items())]
-    return ClustersResponse(clusters=items)
+    # grouping a whole run is CPU work: keep it off the event loop
+    return await run_in_threadpool(_group_clusters, rows)
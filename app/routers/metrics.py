@@ -0,0 +1,43 @@
+from typing import List
+
+from fastapi import APIRouter, Response
+
+from ..db import writer
+from ..services.ai_logic import ai_core
+from ..services.ai_logic.inference_pool import InferencePool
+from ..services.intake_index import intake_index
+from ..services.metrics import registry
+
+router = APIRouter(tags=["metrics"])
+
+_BREAKER_STATES = ("closed", "half_open", "open")
+
+
+def _gauge(name: str, help_text: str, value, labels: str = "") -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name}{labels} {value}"]
+
+
+def _components() -> List[str]:
+    """Point-in-time gauges read from the components at scrape time."""
+    lines = _gauge("db_write_queue_depth", "Jobs waiting for the single DB writer.", writer.depth)
+    lines += _gauge("intake_index_records", "Records in the intake blocking index.", len(intake_index))
+    state = ai_core.breaker.stats()["state"]
+    lines += ["# HELP llm_breaker_state LLM circuit breaker state (1 for the current state).",
+              "# TYPE llm_breaker_state gauge"]
+    lines += [f'llm_breaker_state{{state="{s}"}} {int(s == state)}' for s in _BREAKER_STATES]
+    provider = ai_core.llm_provider
+    if isinstance(provider, InferencePool):
+        pool = provider.stats()
+        lines += _gauge("llm_pool_in_flight", "Requests admitted to the inference pool.", pool["in_flight"])
+        lines += _gauge("llm_pool_queue_depth", "Pool requests not yet picked up by a worker.", pool["queue_depth"])
+        lines += _gauge("llm_pool_workers_ready", "Inference workers ready.", pool["workers_ready"])
+    return lines
+
+
+registry.add_collector(_components)
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    """Prometheus text exposition of the in-process metrics."""
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
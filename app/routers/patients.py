@@ -1,12 +1,17 @@
 from typing import List, Optional, Dict, Set, Tuple
 from fastapi import APIRouter, Depends, HTTPException, Query, Body
-from sqlmodel import Session, select, func
-from ..utils import resolve_run_id
-from ..db import get_session
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..utils import resolve_run_id, resolve_run_id_async
+from ..db import get_session, get_async_session, writer
 from ..models import Patient, Link, ClusterAssignment, PatientMergeHistory
-from ..schemas import PatientOut, DuplicateCandidate, PatientWithDuplicates, MergeRequest, MergeResponse, PatientUpdate
+from ..schemas import (PatientOut, DuplicateCandidate, PatientWithDuplicates, MergeRequest, MergeResponse, PatientUpdate,
+                       BulkMergeRequest, BulkMergeResponse)
 from ..utils import resolve_run_id
 from ..services.auth_service import get_current_user
+from ..services.intake_index import intake_index
+from ..services.bulk_merge import merge_bulk
 from datetime import datetime
 
 router = APIRouter(prefix="/patients", tags=["patients"])
@@ -34,43 +39,42 @@ def _patient_to_out(p: Patient, cluster_id: Optional[str]) -> PatientOut:
 
 
 @router.get("/search", response_model=List[PatientWithDuplicates], dependencies=[Depends(get_current_user)])
-def search_by_name(
+async def search_by_name(
         name: str = Query(..., description="Searched name (partial or full; e.g. 'Ion Pop')"),
         run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
         limit_patients: int = 50,
-        session: Session = Depends(get_session),
+        session: AsyncSession = Depends(get_async_session),
 ):
     """
     Returns a single entry per cluster_id (or per record_id if there is no cluster),
     with duplicates unified from all records in that cluster.
     """
-    run_id = resolve_run_id(session, run_id)
-    name_norm = name.strip().lower()
+    run_id = await resolve_run_id_async(session, run_id)
+    name_norm = " ".join(name.strip().lower().split())
     name_q = f"%{name_norm}%"
 
-    full_name_expr = func.lower(func.concat(Patient.first_name, " ", Patient.last_name))
+    # Patient.name_norm is the stored lower("first last"), so one LIKE covers
+    # first name, last name and full name matches
     q = (
         select(Patient)
         .where(
-            (func.lower(Patient.first_name).like(name_q)) |
-            (func.lower(Patient.last_name).like(name_q)) |
-            (full_name_expr.like(name_q)),
+            Patient.name_norm.like(name_q),
             Patient.is_deleted == 0
         )
         .limit(limit_patients)
     )
-    patients = session.exec(q).all()
+    patients = (await session.exec(q)).all()
     if not patients:
         return []
 
     # --- fetch cluster assignments for those patients ---
     record_ids = [p.record_id for p in patients]
-    assigns = session.exec(
+    assigns = (await session.exec(
         select(ClusterAssignment).where(
             ClusterAssignment.run_id == run_id,
             ClusterAssignment.record_id.in_(record_ids)
         )
-    ).all()
+    )).all()
     rid_to_cluster = {a.record_id: a.patient_id for a in assigns}
 
     # --- group by cluster_id (fallback: record_id if no cluster) ---
@@ -102,14 +106,14 @@ def search_by_name(
 
         # --- gather links for ALL group members ---
         member_ids = [m.record_id for m in members]
-        links = session.exec(
+        links = (await session.exec(
             select(Link)
             .where(
                 Link.run_id == run_id,
                 Link.decision.in_(('match', 'review')),
                 (Link.record_id1.in_(member_ids)) | (Link.record_id2.in_(member_ids))
             )
-        ).all()
+        )).all()
 
         # remove internal pairs (within the same cluster)
         # 1) need cluster for "others"
@@ -120,12 +124,12 @@ def search_by_name(
         other_ids -= set(member_ids)
 
         if other_ids:
-            others_assigns = session.exec(
+            others_assigns = (await session.exec(
                 select(ClusterAssignment).where(
                     ClusterAssignment.run_id == run_id,
                     ClusterAssignment.record_id.in_(list(other_ids))
                 )
-            ).all()
+            )).all()
             rid_to_cluster_other = {a.record_id: a.patient_id for a in others_assigns}
         else:
             rid_to_cluster_other = {}
@@ -150,9 +154,9 @@ def search_by_name(
         # get details for "other"
         others_pat = []
         if best_by_other:
-            others_pat = session.exec(
+            others_pat = (await session.exec(
                 select(Patient).where(Patient.record_id.in_(list(best_by_other.keys())))
-            ).all()
+            )).all()
         rid_to_patient = {op.record_id: op for op in others_pat}
 
         dups: List[DuplicateCandidate] = []
@@ -177,37 +181,9 @@ def search_by_name(
 
     return results
 
-@router.get("/matches", response_model=List[PatientWithDuplicates], tags=["patients"],
-            dependencies=[Depends(get_current_user)])
-def list_all_matches_grouped(
-        run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
-        limit_groups: int = Query(200, description="Max number of groups to return"),
-        session: Session = Depends(get_session),
-):
-    run_id = resolve_run_id(session, run_id)
-
-    # 1) ia toate link-urile 'match' pentru run-ul curent
-    links: List[Link] = session.exec(
-        select(Link)
-        .where(Link.run_id == run_id, Link.decision == "match")
-        .order_by(Link.score.desc())
-    ).all()
-    if not links:
-        return []
-
-    # 2) construiește mulțimea tuturor record_id-urilor implicate în link-uri
-    all_rids: Set[str] = set()
-    for l in links:
-        all_rids.add(l.record_id1)
-        all_rids.add(l.record_id2)
-
-    # 3) încarcă doar pacienții existenți/neșterși dintre acele id-uri
-    pats: List[Patient] = session.exec(
-        select(Patient).where(Patient.record_id.in_(list(all_rids)), Patient.is_deleted == 0)
-    ).all()
-    if not pats:
-        return []
 
+def _group_match_components(links: List[Link], pats: List[Patient]) -> List[PatientWithDuplicates]:
+    """One entry per connected component of the match links; representative = lowest numeric record_id."""
     rid_to_pat: Dict[str, Patient] = {p.record_id: p for p in pats}
 
     # 4) graf neorientat din link-urile 'match' (doar noduri cu pacienți valizi)
@@ -324,6 +300,41 @@ def list_all_matches_grouped(
     return results
 
 
+@router.get("/matches", response_model=List[PatientWithDuplicates], tags=["patients"],
+            dependencies=[Depends(get_current_user)])
+async def list_all_matches_grouped(
+        run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
+        limit_groups: int = Query(200, description="Max number of groups to return"),
+        session: AsyncSession = Depends(get_async_session),
+):
+    run_id = await resolve_run_id_async(session, run_id)
+
+    # 1) ia toate link-urile 'match' pentru run-ul curent
+    links: List[Link] = (await session.exec(
+        select(Link)
+        .where(Link.run_id == run_id, Link.decision == "match")
+        .order_by(Link.score.desc())
+    )).all()
+    if not links:
+        return []
+
+    # 2) construiește mulțimea tuturor record_id-urilor implicate în link-uri
+    all_rids: Set[str] = set()
+    for l in links:
+        all_rids.add(l.record_id1)
+        all_rids.add(l.record_id2)
+
+    # 3) încarcă doar pacienții existenți/neșterși dintre acele id-uri
+    pats: List[Patient] = (await session.exec(
+        select(Patient).where(Patient.record_id.in_(list(all_rids)), Patient.is_deleted == 0)
+    )).all()
+    if not pats:
+        return []
+
+    # the graph and the response are built off the event loop
+    return await run_in_threadpool(_group_match_components, links, pats)
+
+
 
 
 
@@ -451,25 +462,25 @@ def list_all_patients_with_dups(
 
 
 @router.get("/{record_id}", response_model=PatientWithDuplicates, dependencies=[Depends(get_current_user)])
-def get_patient_with_dups(
+async def get_patient_with_dups(
         record_id: str,
         run_id: Optional[int] = Query(None, description="If omitted, latest run will be used"),
-        session: Session = Depends(get_session),
+        session: AsyncSession = Depends(get_async_session),
 ):
-    run_id = resolve_run_id(session, run_id)
-    p = session.exec(select(Patient).where(Patient.record_id == record_id, Patient.is_deleted == 0)).first()
+    run_id = await resolve_run_id_async(session, run_id)
+    p = (await session.exec(select(Patient).where(Patient.record_id == record_id, Patient.is_deleted == 0))).first()
     if not p:
         raise HTTPException(status_code=404, detail="Pacientul nu există sau este șters")
 
-    cluster = session.exec(
+    cluster = (await session.exec(
         select(ClusterAssignment).where(
             ClusterAssignment.run_id == run_id,
             ClusterAssignment.record_id == record_id
         )
-    ).first()
+    )).first()
     patient_out = _patient_to_out(p, cluster.patient_id if cluster else None)
 
-    links = session.exec(
+    links = (await session.exec(
         select(Link)
         .where(
             Link.run_id == run_id,
@@ -477,19 +488,19 @@ def get_patient_with_dups(
             ((Link.record_id1 == record_id) | (Link.record_id2 == record_id))
         )
         .order_by(Link.decision.desc(), Link.score.desc())
-    ).all()
+    )).all()
 
     dups: List[DuplicateCandidate] = []
     if links:
         others = [(l.record_id2 if l.record_id1 == record_id else l.record_id1) for l in links]
-        others_pat = session.exec(select(Patient).where(Patient.record_id.in_(others))).all()
+        others_pat = (await session.exec(select(Patient).where(Patient.record_id.in_(others)))).all()
         rid_to_patient = {op.record_id: op for op in others_pat}
-        others_assigns = session.exec(
+        others_assigns = (await session.exec(
             select(ClusterAssignment).where(
                 ClusterAssignment.run_id == run_id,
                 ClusterAssignment.record_id.in_(others)
             )
-        ).all()
+        )).all()
         rid_to_cluster_other = {a.record_id: a.patient_id for a in others_assigns}
 
         for l in links:
@@ -519,8 +530,26 @@ MERGE_MUTABLE_FIELDS = {
 @router.post("/merge", response_model=MergeResponse, dependencies=[Depends(get_current_user)])
 def merge_patients(
         req: MergeRequest = Body(...),
-        session: Session = Depends(get_session),
 ):
+    result = writer.run(lambda s: _apply_merge(s, req))
+    if result.master_after is not None:
+        intake_index.merge(result.master_after.model_dump(), result.merged)
+    return result
+
+
+@router.post("/merge_bulk", response_model=BulkMergeResponse, dependencies=[Depends(get_current_user)])
+def merge_patients_bulk(
+        req: BulkMergeRequest = Body(...),
+):
+    """
+    Many merges in one call: set-based updates per batch of groups (one commit
+    per `batch_size` groups) and a result per group, in request order.
+    """
+    return merge_bulk(req)
+
+
+def _apply_merge(session: Session, req: MergeRequest) -> MergeResponse:
+    """Merge body, executed as a single-writer job (the writer commits)."""
     # 0) find master (active)
     master = session.exec(
         select(Patient).where(Patient.record_id == req.master_record_id, Patient.is_deleted == 0)
@@ -636,7 +665,7 @@ def merge_patients(
                 setattr(master, field, value)
 
     session.add(master)
-    session.commit()
+    session.flush()
 
     # 5) return info about the merged master
     session.refresh(master)
@@ -657,53 +686,59 @@ def merge_patients(
 @router.delete("/{record_id}", response_model=PatientOut, dependencies=[Depends(get_current_user)])
 def soft_delete_patient(
         record_id: str,
-        session: Session = Depends(get_session),
 ):
-    p = session.exec(select(Patient).where(Patient.record_id == record_id)).first()
-    if not p:
-        raise HTTPException(status_code=404, detail="Pacientul nu există")
-
-    # if not already deleted, mark as deleted
-    if not p.is_deleted:
-        p.is_deleted = True
-        p.deleted_at = datetime.utcnow()
-        session.add(p)
-        session.commit()
-        session.refresh(p)
+    def _delete(session: Session) -> PatientOut:
+        p = session.exec(select(Patient).where(Patient.record_id == record_id)).first()
+        if not p:
+            raise HTTPException(status_code=404, detail="Pacientul nu există")
+
+        # if not already deleted, mark as deleted
+        if not p.is_deleted:
+            p.is_deleted = True
+            p.deleted_at = datetime.utcnow()
+            session.add(p)
+            session.flush()
+
+        # atach cluster_id if any
+        cluster = session.exec(
+            select(ClusterAssignment).where(ClusterAssignment.record_id == record_id)
+        ).first()
 
-    # atach cluster_id if any
-    cluster = session.exec(
-        select(ClusterAssignment).where(ClusterAssignment.record_id == record_id)
-    ).first()
+        return _patient_to_out(p, cluster.patient_id if cluster else None)
 
-    return _patient_to_out(p, cluster.patient_id if cluster else None)
+    out = writer.run(_delete)
+    intake_index.remove([out.record_id])
+    return out
 
 
 @router.patch("/{record_id}", response_model=PatientOut, dependencies=[Depends(get_current_user)])
 def update_patient(
         record_id: str,
         updates: PatientUpdate = Body(..., description="Doar câmpurile de actualizat"),
-        session: Session = Depends(get_session),
 ):
-    p = session.exec(select(Patient).where(Patient.record_id == record_id)).first()
-    if not p:
-        raise HTTPException(status_code=404, detail="Pacientul nu există")
-
     payload = updates.model_dump(exclude_unset=True)
     if not payload:
         raise HTTPException(status_code=400, detail="Niciun câmp de actualizat")
 
-    # apply updates
-    for field, value in payload.items():
-        if field in MERGE_MUTABLE_FIELDS:
-            setattr(p, field, value)
+    def _update(session: Session) -> PatientOut:
+        p = session.exec(select(Patient).where(Patient.record_id == record_id)).first()
+        if not p:
+            raise HTTPException(status_code=404, detail="Pacientul nu există")
 
-    session.add(p)
-    session.commit()
-    session.refresh(p)
+        # apply updates
+        for field, value in payload.items():
+            if field in MERGE_MUTABLE_FIELDS:
+                setattr(p, field, value)
 
-    cluster = session.exec(
-        select(ClusterAssignment).where(ClusterAssignment.record_id == record_id)
-    ).first()
+        session.add(p)
+        session.flush()
+
+        cluster = session.exec(
+            select(ClusterAssignment).where(ClusterAssignment.record_id == record_id)
+        ).first()
+
+        return _patient_to_out(p, cluster.patient_id if cluster else None)
 
-    return _patient_to_out(p, cluster.patient_id if cluster else None)
+    out = writer.run(_update)
+    intake_index.upsert(out.model_dump())
+    return out
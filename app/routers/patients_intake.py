@@ -1,19 +1,20 @@
 from typing import List, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, Body, Query
-from sqlalchemy import or_, and_
 from sqlmodel import Session, select, func
-from ..db import get_session
+from ..db import get_session, writer
 from ..models import Patient, Link, ClusterAssignment, DedupeRun
 from ..schemas import PatientCreate, IntakeResult, DuplicateHit, PatientOut
 from ..services.auth_service import get_current_user
-from ..utils import resolve_run_id
+from ..utils import resolve_run_id, PATIENTS_COLUMNS
+from ..services.patient_keys import KEY_COLUMNS
+from ..services.intake_index import intake_index, IntakeIndex
+from ..services.model_registry import model_registry, LoadedModel
 
 from ..services.dedupe import (
     LINK_T, REVIEW_T, prepare_input, rec_to_text, Embedder,
-    pair_features, pair_score_heuristic, digits_only, email_domain
+    pair_features, pair_score_heuristic, score_pairs_vectorized
 )
 
-import os, pickle
 from sklearn.metrics.pairwise import cosine_similarity
 from sqlalchemy import cast, Integer
 
@@ -48,80 +49,34 @@ def _patient_to_out_basic(p: Patient, cluster_id: Optional[str]) -> PatientOut:
 
 router = APIRouter(prefix="/intake", tags=["patients"])
 
-VEC_PATH = os.getenv("DEDUP_TFIDF_PATH", "models/latest_tfidf.pkl")
-
-def _load_vectorizer() -> Optional[Embedder]:
-    try:
-        with open(VEC_PATH, "rb") as f:
-            vec = pickle.load(f)
-        emb = Embedder()
-        emb.vec = vec
-        return emb
-    except Exception:
-        return None
-
-def _block_candidates(session: Session, p: PatientCreate, limit: int = 500) -> List[Patient]:
-    q = select(Patient).where(Patient.is_deleted == False)
-
-    conds = []
-
-    # exact email
-    if p.email:
-        conds.append(func.lower(Patient.email) == func.lower(p.email))
-
-        # same domain
-        dom = email_domain(p.email)
-        if dom:
-            conds.append(func.lower(Patient.email).like(f"%@{dom}"))
-
-    # exact SSN
-    if p.ssn:
-        conds.append(Patient.ssn == p.ssn)
-
-    # phone (last 4)
-    if p.phone_number:
-        last4 = digits_only(p.phone_number)[-4:]
-        if last4:
-            normalized_phone = func.replace(
-                func.replace(
-                    func.replace(Patient.phone_number, "-", ""),
-                    " ", ""
-                ),
-                "+", ""
-            )
-            conds.append(normalized_phone.like(f"%{last4}"))
-
-    # dob
-    if p.date_of_birth:
-        conds.append(Patient.date_of_birth == p.date_of_birth)
-
-    # name – fallback
-    name_like = []
-    fn = (p.first_name or "").strip().lower()
-    ln = (p.last_name or "").strip().lower()
-    full = (fn + " " + ln).strip()
-
-    if fn:
-        name_like.append(func.lower(Patient.first_name).like(f"%{fn}%"))
-    if ln:
-        name_like.append(func.lower(Patient.last_name).like(f"%{ln}%"))
-    if full:
-        full_name_expr = Patient.first_name + " " + Patient.last_name  # => SQLite "||"
-        name_like.append(func.lower(full_name_expr).like(f"%{full}%"))
-
-    # apply filters
-    if conds or name_like:
-        q = q.where(or_(*conds, *name_like))
-    else:
+def _block_candidates(session: Session, p: PatientCreate, limit: int = 500,
+                      model: Optional[LoadedModel] = None) -> List[Patient]:
+    """
+    Candidate records sharing an exact key (SSN, email, email domain, phone
+    last 4, DOB, phonetic name token) with p, looked up in the resident
+    intake index instead of a LIKE scan over the whole patient table.
+    """
+    model = model or model_registry.current(session)
+    intake_index.ensure_loaded(session, model.embedder, model.version)
+    rids = intake_index.lookup(p.model_dump(), limit=limit)
+    if not rids:
         return []
 
-    return session.exec(q.limit(limit)).all()
+    rows = session.exec(
+        select(Patient).where(Patient.record_id.in_(rids), Patient.is_deleted == False)
+    ).all()
+    by_rid = {r.record_id: r for r in rows}
+    return [by_rid[rid] for rid in rids if rid in by_rid]
 
 def _best_hits_for_new(new_row: dict,
                        candidates: List[Patient],
-                       embedder: Optional[Embedder]) -> List[Tuple[Patient, float, dict, str]]:
+                       embedder: Optional[Embedder],
+                       cand_embs=None,
+                       link_t: float = LINK_T,
+                       review_t: float = REVIEW_T) -> List[Tuple[Patient, float, dict, str]]:
     """
     Returns a hit list of (candidate, score, features, reason), sorted by score desc.
+    cand_embs: precomputed TF-IDF rows of the candidates (same order), if available.
     """
     # pregătește "r1" (noul)
     import pandas as pd
@@ -161,7 +116,10 @@ def _best_hits_for_new(new_row: dict,
 
     if embedder is not None:
         emb_new = embedder.transform([rec_to_text(df_new.iloc[0])])
-        emb_c   = embedder.transform([rec_to_text(r) for _, r in df_c.iterrows()])
+        if cand_embs is not None:
+            emb_c = cand_embs
+        else:
+            emb_c = embedder.transform([rec_to_text(r) for _, r in df_c.iterrows()])
     else:
         emb_new, emb_c = None, None
 
@@ -185,9 +143,9 @@ def _best_hits_for_new(new_row: dict,
             reason = "ssn_hard"
         else:
             score = pair_score_heuristic(feats)
-            if score >= LINK_T:
+            if score >= link_t:
                 decision = "match"; reason = "heur_link"
-            elif score >= REVIEW_T:
+            elif score >= review_t:
                 decision = "review"; reason = "heur_review"
             else:
                 decision = "non-match"; reason = "heur_below"
@@ -203,6 +161,7 @@ def _attach_to_cluster_without_recluster(session: Session, run_id: int,
                                          attach_to_record_id: str) -> str:
     """
     Mapping the new_record_id to the patient_id of attach_to_record_id in the given run_id.
+    Runs inside a writer job; the caller's batch commit persists the assignment.
     """
     target_assign = session.exec(
         select(ClusterAssignment).where(
@@ -214,7 +173,6 @@ def _attach_to_cluster_without_recluster(session: Session, run_id: int,
     if target_assign:
         pid = target_assign.patient_id
         session.add(ClusterAssignment(run_id=run_id, record_id=new_record_id, patient_id=pid))
-        session.commit()
         return pid
 
     last = session.exec(
@@ -234,7 +192,6 @@ def _attach_to_cluster_without_recluster(session: Session, run_id: int,
 
     session.add(ClusterAssignment(run_id=run_id, record_id=attach_to_record_id, patient_id=pid))
     session.add(ClusterAssignment(run_id=run_id, record_id=new_record_id, patient_id=pid))
-    session.commit()
     return pid
 
 @router.post("/add_or_check", response_model=IntakeResult, dependencies=[Depends(get_current_user)])
@@ -248,7 +205,8 @@ def add_or_check_patient(
     Add a patient after checking for duplicates.
     """
     rid = payload.record_id
-    if not rid:
+    auto_record_id = not rid
+    if auto_record_id:
         rid = _next_record_id(session)
         payload.record_id = rid
 
@@ -260,17 +218,22 @@ def add_or_check_patient(
 
     run_id = resolve_run_id(session, run_id)
 
+    # 0) scoring artifacts: one in-memory snapshot for the whole request
+    model = model_registry.current(session)
+
     # 1) blocking
-    candidates = _block_candidates(session, payload, limit=500)
+    candidates = _block_candidates(session, payload, limit=500, model=model)
 
-    # 2) local scoring
-    emb = _load_vectorizer()
+    # 2) local scoring (candidate TF-IDF rows come from the resident index)
+    cand_embs = (intake_index.embeddings_for([c.record_id for c in candidates], model.version)
+                 if candidates else None)
     new_row = payload.model_dump()
-    hits = _best_hits_for_new(new_row, candidates, emb)
+    hits = _best_hits_for_new(new_row, candidates, model.embedder, cand_embs,
+                              link_t=model.link_t, review_t=model.review_t)
 
     # 3) decision
-    match_hits = [h for h in hits if h[1] >= LINK_T]
-    review_hits = [h for h in hits if (REVIEW_T <= h[1] < LINK_T)]
+    match_hits = [h for h in hits if h[1] >= model.link_t]
+    review_hits = [h for h in hits if (model.review_t <= h[1] < model.link_t)]
 
     if match_hits:
         # choose the best match
@@ -312,6 +275,7 @@ def add_or_check_patient(
             decision="duplicate_found",
             patient_id=existing_pid,
             duplicates=top_hits,
+            model_version=model.version,
             message=(
                 "This profile appears to be a duplicate of an existing patient."
                 " A profile was not created."
@@ -326,22 +290,238 @@ def add_or_check_patient(
             record_id=payload.record_id,
             decision="review_required",
             patient_id=None,
-            duplicates=dups
+            duplicates=dups,
+            model_version=model.version,
         )
 
-    p = Patient(**new_row, is_deleted=False)
-    session.add(p)
-    session.commit()
+    def _create(s: Session) -> IntakeResult:
+        # allocate the id again on the writer so concurrent intakes cannot collide
+        if auto_record_id:
+            new_row["record_id"] = _next_record_id(s)
+        s.add(Patient(**new_row, is_deleted=False))
+        pid = _attach_to_cluster_without_recluster(s, run_id, new_row["record_id"], attach_to_record_id=new_row["record_id"])
+        return IntakeResult(
+            created=True,
+            record_id=new_row["record_id"],
+            decision="created",
+            patient_id=pid,
+            duplicates=[],
+            model_version=model.version,
+        )
 
-    pid = _attach_to_cluster_without_recluster(session, run_id, payload.record_id, attach_to_record_id=payload.record_id)
+    result = writer.run(_create)
+    intake_index.upsert(new_row)
+    return result
+
+def _fetch_by_record_ids(session: Session, rids: List[str], chunk: int = 900) -> dict:
+    """record_id -> live Patient, in IN-queries small enough for SQLite's parameter limit."""
+    out = {}
+    for i in range(0, len(rids), chunk):
+        rows = session.exec(
+            select(Patient).where(Patient.record_id.in_(rids[i:i + chunk]), Patient.is_deleted == False)
+        ).all()
+        out.update({r.record_id: r for r in rows})
+    return out
+
+def _taken_indexes(session: Session, payloads: List[PatientCreate], rids: List[str]) -> List[int]:
+    """Positions of the payloads whose explicit record_id is already in the table (deleted rows too)."""
+    taken = set()
+    for i in range(0, len(rids), 900):
+        taken.update(session.exec(select(Patient.record_id).where(Patient.record_id.in_(rids[i:i + 900]))).all())
+    return [i for i, p in enumerate(payloads) if p.record_id and p.record_id in taken]
+
+@router.post("/add_or_check_batch", response_model=List[IntakeResult], dependencies=[Depends(get_current_user)])
+def add_or_check_batch(
+    payloads: List[PatientCreate] = Body(...),
+    run_id: Optional[int] = Query(None, description="If omitted, the latest run is used"),
+    force_create_on_review: bool = Query(False, description="If review hits are found, create anyway"),
+    session: Session = Depends(get_session),
+):
+    """
+    Batch version of /add_or_check: one result per item, in input order.
+    All items are blocked and scored together; an item is also checked
+    against the earlier items of the same batch that get created. All
+    creations are committed in a single transaction.
+    """
+    import pandas as pd
 
-    return IntakeResult(
-        created=True,
-        record_id=payload.record_id,
-        decision="created",
-        patient_id=pid,
-        duplicates=[]
-    )
+    if not payloads:
+        return []
+    run_id = resolve_run_id(session, run_id)
+    model = model_registry.current(session)
+    intake_index.ensure_loaded(session, model.embedder, model.version)
+
+    # 0) explicit record_ids that already exist (deleted rows too) or repeat inside the batch;
+    # the writer checks again, this only spares scoring the items already known to fail
+    explicit = [p.record_id for p in payloads if p.record_id]
+    rejected = {i: "record_id deja există" for i in _taken_indexes(session, payloads, explicit)}
+    seen = set()
+    for i, p in enumerate(payloads):
+        if not p.record_id:
+            continue
+        if p.record_id in seen and i not in rejected:
+            rejected[i] = "record_id repeated in batch"
+        seen.add(p.record_id)
+
+    # batch rows get positional ids (#i) until real ids are allocated on the writer
+    rows = [{**p.model_dump(), "record_id": f"#{i}"} for i, p in enumerate(payloads)]
+    df_b = prepare_input(pd.DataFrame(rows, columns=PATIENTS_COLUMNS).fillna(""))
+    emb_b = (model.embedder.transform([rec_to_text(r) for _, r in df_b.iterrows()])
+             if model.embedder is not None else None)
+
+    # 1) blocking: resident index for DB candidates, a throwaway index for in-batch ones
+    db_cands = [intake_index.lookup(p.model_dump(), limit=500) if i not in rejected else []
+                for i, p in enumerate(payloads)]
+    db_rids = list(dict.fromkeys(rid for rids in db_cands for rid in rids))
+    by_rid = _fetch_by_record_ids(session, db_rids)
+    db_rids = [rid for rid in db_rids if rid in by_rid]
+    db_pos = {rid: k for k, rid in enumerate(db_rids)}
+
+    batch_index = IntakeIndex.from_records(rows)
+    db_l, db_r, in_l, in_r = [], [], [], []
+    for i in range(len(payloads)):
+        if i in rejected:
+            continue
+        for rid in db_cands[i]:
+            if rid in db_pos:
+                db_l.append(i); db_r.append(db_pos[rid])
+        for key in batch_index.lookup(rows[i], limit=500):
+            j = int(key[1:])
+            if j < i and j not in rejected:
+                in_l.append(i); in_r.append(j)
+
+    # 2) vectorized scoring of every (item, candidate) pair
+    db_scores = in_scores = None
+    if db_rids:
+        df_db = prepare_input(pd.DataFrame(
+            [{c: getattr(by_rid[rid], c) for c in PATIENTS_COLUMNS + KEY_COLUMNS} for rid in db_rids],
+            columns=PATIENTS_COLUMNS + KEY_COLUMNS,
+        ).fillna(""))
+        emb_db = None
+        if model.embedder is not None:
+            emb_db = intake_index.embeddings_for(db_rids, model.version)
+            if emb_db is None:
+                emb_db = model.embedder.transform([rec_to_text(r) for _, r in df_db.iterrows()])
+        db_scores = score_pairs_vectorized(df_b, df_db, db_l, db_r, emb_b, emb_db,
+                                           link_t=model.link_t, review_t=model.review_t)
+        db_scores = db_scores[db_scores["decision"] != "non-match"]
+    if in_l:
+        in_scores = score_pairs_vectorized(df_b, df_b, in_l, in_r, emb_b, emb_b,
+                                           link_t=model.link_t, review_t=model.review_t)
+        in_scores = in_scores[in_scores["decision"] != "non-match"]
+
+    def _hits_by_left(scores, kind):
+        out = {}
+        if scores is None:
+            return out
+        for r in scores.itertuples(index=False):
+            out.setdefault(int(r.left), []).append((kind, int(r.right), float(r.score), r.decision, r.reason))
+        return out
+
+    db_hits = _hits_by_left(db_scores, "db")
+    in_hits = _hits_by_left(in_scores, "batch")
+
+    hit_db_rids = {db_rids[h[1]] for hs in db_hits.values() for h in hs}
+    cluster_of = {}
+    if hit_db_rids:
+        for ca in session.exec(
+            select(ClusterAssignment).where(
+                ClusterAssignment.run_id == run_id,
+                ClusterAssignment.record_id.in_(list(hit_db_rids))
+            )
+        ).all():
+            cluster_of[ca.record_id] = ca.patient_id
+
+    new_rows = {}
+
+    def _create_all(s: Session) -> List[IntakeResult]:
+        # explicit ids taken since the check above conflict per item, not for the whole batch
+        # (local copies: the writer may run this job again after a failed commit)
+        refused = dict(rejected)
+        new_rows.clear()
+        for i in _taken_indexes(s, payloads, [p.record_id for i, p in enumerate(payloads)
+                                              if p.record_id and i not in refused]):
+            refused[i] = "record_id deja există"
+
+        # 3) decisions, in input order (in-batch hits only count against created items)
+        decisions = []
+        created = set()
+        for i in range(len(payloads)):
+            if i in refused:
+                decisions.append(("rejected", []))
+                continue
+            hits = db_hits.get(i, []) + [h for h in in_hits.get(i, []) if h[1] in created]
+            hits.sort(key=lambda h: (-h[2], h[0], h[1]))
+            match_hits = [h for h in hits if h[3] == "match"]
+            review_hits = [h for h in hits if h[3] == "review"]
+            if match_hits:
+                decisions.append(("duplicate_found", match_hits[:3]))
+            elif review_hits and not force_create_on_review:
+                decisions.append(("review_required", review_hits[:10]))
+            else:
+                decisions.append(("created", []))
+                created.add(i)
+
+        # ids are allocated in input order, skipping ids given explicitly in this batch;
+        # an item that is not created gets the next free id, as /add_or_check returns
+        final_rid, pid_of = {}, {}
+        next_id = None
+        for i, p in enumerate(payloads):
+            if p.record_id:
+                final_rid[i] = p.record_id
+                continue
+            if next_id is None:
+                next_id = int(_next_record_id(s))
+            while str(next_id) in seen:
+                next_id += 1
+            final_rid[i] = str(next_id)
+            if i in created:
+                next_id += 1
+        for i in sorted(created):
+            row = {**payloads[i].model_dump(), "record_id": final_rid[i]}
+            s.add(Patient(**row, is_deleted=False))
+            new_rows[i] = row
+            pid_of[i] = _attach_to_cluster_without_recluster(s, run_id, row["record_id"],
+                                                             attach_to_record_id=row["record_id"])
+
+        def _other(h):
+            kind, j, _sc, _dec, _rs = h
+            if kind == "db":
+                return db_rids[j], _patient_to_out_basic(by_rid[db_rids[j]], cluster_of.get(db_rids[j]))
+            return final_rid[j], PatientOut(**new_rows[j], cluster_id=pid_of[j], is_deleted=False)
+
+        results = []
+        for i, (decision, hits) in enumerate(decisions):
+            if decision == "created":
+                results.append(IntakeResult(
+                    created=True, record_id=final_rid[i], decision="created",
+                    patient_id=pid_of[i], duplicates=[], model_version=model.version,
+                ))
+                continue
+            dups = []
+            for h in hits:
+                other_rid, other = _other(h)
+                dups.append(DuplicateHit(
+                    other_record_id=other_rid, decision=h[3], score=h[2], reason=h[4],
+                    other_patient=other if decision == "duplicate_found" else None,
+                ))
+            result = IntakeResult(
+                created=False, record_id=final_rid[i], decision=decision,
+                duplicates=dups, model_version=model.version,
+            )
+            if decision == "duplicate_found":
+                result.patient_id = dups[0].other_patient.cluster_id
+                result.message = ("This profile appears to be a duplicate of an existing patient."
+                                  " A profile was not created.")
+            elif decision == "rejected":
+                result.message = refused[i]
+            results.append(result)
+        return results
+
+    results = writer.run(_create_all)
+    for row in new_rows.values():
+        intake_index.upsert(row)
+    return results
 
 @router.post("/force_add", response_model=PatientOut, dependencies=[Depends(get_current_user)])
 def force_add_patient(
@@ -354,35 +534,47 @@ def force_add_patient(
     """
     run_id = resolve_run_id(session, run_id)
 
-    new_rid = payload.record_id
-    if not new_rid:
-        new_rid = _next_record_id(session)
-
-    p = Patient(
-        record_id=new_rid,
-        original_record_id=payload.original_record_id,
-        first_name=payload.first_name,
-        last_name=payload.last_name,
-        gender=payload.gender,
-        date_of_birth=payload.date_of_birth,
-        address=payload.address,
-        city=payload.city,
-        county=payload.county,
-        ssn=payload.ssn,
-        phone_number=payload.phone_number,
-        email=payload.email,
-        is_deleted=False,
-    )
-    session.add(p)
-    session.commit()
-    session.refresh(p)
-
-    pid = _attach_to_cluster_without_recluster(
-        session=session,
-        run_id=run_id,
-        new_record_id=new_rid,
-        attach_to_record_id=new_rid,
-    )
+    def _create(s: Session) -> PatientOut:
+        new_rid = payload.record_id or _next_record_id(s)
+        p = Patient(
+            record_id=new_rid,
+            original_record_id=payload.original_record_id,
+            first_name=payload.first_name,
+            last_name=payload.last_name,
+            gender=payload.gender,
+            date_of_birth=payload.date_of_birth,
+            address=payload.address,
+            city=payload.city,
+            county=payload.county,
+            ssn=payload.ssn,
+            phone_number=payload.phone_number,
+            email=payload.email,
+            is_deleted=False,
+        )
+        s.add(p)
+        s.flush()
+
+        pid = _attach_to_cluster_without_recluster(
+            session=s,
+            run_id=run_id,
+            new_record_id=new_rid,
+            attach_to_record_id=new_rid,
+        )
+        return _patient_to_out_basic(p, pid)
+
+    out = writer.run(_create)
+    intake_index.upsert(out.model_dump())
+    return out
 
-    out = _patient_to_out_basic(p, pid)
-    return out
\ No newline at end of file
+
+@router.get("/model_status", dependencies=[Depends(get_current_user)])
+def intake_model_status(session: Session = Depends(get_session)):
+    """
+    Scoring artifacts currently loaded by this process (TF-IDF vectorizer
+    and thresholds) and the size of the resident intake index.
+    """
+    model_registry.current(session)
+    status = model_registry.status()
+    status["index_records"] = len(intake_index)
+    status["index_model_version"] = intake_index.model_version
+    return status
@@ -0,0 +1,34 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from ..services.auth_service import require_role
+from ..services.profiling import profile_store, summary, to_collapsed, to_speedscope
+
+router = APIRouter(prefix="/profiling", tags=["profiling"], dependencies=[Depends(require_role("admin"))])
+
+
+@router.get("/slowest")
+def slowest_profiles(route: Optional[str] = Query(None, description="Route template, e.g. /patients/all")):
+    """Slowest profiled requests per route (send X-Profile: 1 or ?profile=1 to profile a request)."""
+    return profile_store.slowest(route)
+
+
+@router.get("/{profile_id}")
+def get_profile(profile_id: int, format: str = Query("summary", pattern="^(summary|collapsed|speedscope)$")):
+    """One profile: its summary, collapsed stacks (flamegraph.pl) or speedscope JSON."""
+    p = profile_store.get(profile_id)
+    if p is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    if format == "collapsed":
+        return PlainTextResponse(to_collapsed(p))
+    if format == "speedscope":
+        return to_speedscope(p)
+    return summary(p)
+
+
+@router.delete("")
+def clear_profiles():
+    profile_store.clear()
+    return {"status": "cleared"}
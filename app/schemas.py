@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 
@@ -38,6 +39,29 @@ class IngestResponse(BaseModel):
     soft_deleted: int = 0
     unchanged: int = 0
     batch_id: Optional[int] = None
+    changed_record_ids: List[str] = Field(default_factory=list)   # inserted / updated / restored
+
+class IngestChanges(BaseModel):
+    since_seq: int
+    record_ids: List[str]
+    has_more: bool = False
+    next_seq: int
+
+class IngestBatchOut(BaseModel):
+    id: int
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    filename: Optional[str] = None
+    source: Optional[str] = None
+    chunk_size: int
+    status: str
+    chunks_committed: int
+    rows_committed: int
+    inserted: int
+    updated: int
+    restored: int
+    unchanged: int
+    error: Optional[str] = None
 
 class PatientOut(BaseModel):
     record_id: str
@@ -102,6 +126,37 @@ class MergeResponse(BaseModel):
     updated_clusters: int
     master_after: Optional["PatientOut"] = None
 
+class BulkMergeGroup(BaseModel):
+    master_record_id: str
+    duplicate_record_ids: List[str]
+    updates: Optional[PatientUpdate] = None     # field overrides applied to the master
+    reason: Optional[str] = None                # defaults to the request's reason
+
+class BulkMergeRequest(BaseModel):
+    groups: List[BulkMergeGroup]
+    reason: Optional[str] = None
+    run_id: Optional[int] = None                # recorded in PatientMergeHistory
+    hard_delete_duplicates: Optional[bool] = False
+    batch_size: Optional[int] = Field(default=None, ge=1, le=10000)   # groups per commit (MERGE_BULK_BATCH_SIZE)
+
+class BulkMergeGroupResult(BaseModel):
+    index: int                                  # position in the request
+    master: str
+    status: str                                 # merged | noop | error
+    merged: List[str] = []
+    skipped: List[str] = []                     # not found, already deleted/merged, or the master itself
+    updated_links: int = 0
+    updated_clusters: int = 0
+    error: Optional[str] = None
+
+class BulkMergeResponse(BaseModel):
+    total: int
+    merged: int
+    noop: int
+    failed: int
+    batches: int
+    results: List[BulkMergeGroupResult]
+
 class PatientCreate(BaseModel):
     record_id: Optional[str] = None
     original_record_id: Optional[str] = None
@@ -130,6 +185,7 @@ class IntakeResult(BaseModel):
     patient_id: Optional[str] = None
     duplicates: List[DuplicateHit] = Field(default_factory=list)
     message: Optional[str] = None
+    model_version: Optional[str] = None   # scoring artifacts used (e.g. "run-12")
 
 class PatientRecordInput(PatientOut):
     pass
@@ -145,4 +201,67 @@ class AIMergeSuggestionResponse(BaseModel):
     suggested_golden_record: PatientOut
     human_review_required: bool
     conflicts_resolved: List[AIFieldResolution]
-    processing_log: List[str]
\ No newline at end of file
+    processing_log: List[str]
+    # LLM calls behind this suggestion (tokens, latency, fixer retries, cache hits); absent when served precomputed
+    telemetry: Optional[Dict[str, Any]] = None
+class AISuggestionSummary(BaseModel):
+    id: int
+    cluster_key: str
+    record_ids: List[str]
+    status: str
+    human_review_required: Optional[bool] = None
+    elapsed_s: Optional[float] = None
+    error: Optional[str] = None
+    telemetry: Optional[Dict[str, Any]] = None
+
+class RunSuggestionsOut(BaseModel):
+    run_id: int
+    status: Optional[str] = None        # queued | running | done | failed (None: never precomputed)
+    total: Optional[int] = None
+    done: Optional[int] = None
+    items: List[AISuggestionSummary]
+
+class AutoMergePolicy(BaseModel):
+    # every link between members of a cluster must be a match that is either
+    # an SSN hard match (when accepted) or scored at least min_link_score
+    min_link_score: float = Field(default=0.95, ge=0.0, le=1.0)
+    accept_ssn_hard: bool = True
+    max_cluster_size: int = Field(default=20, ge=2)
+    skip_review_linked: bool = True             # skip clusters with a member in a review-band link
+    allow_unresolved_conflicts: bool = False    # otherwise clusters with rule-unresolvable conflicts are left to stewards
+    batch_size: Optional[int] = Field(default=None, ge=1, le=10000)   # groups per commit
+
+class AutoMergePlanGroup(BaseModel):
+    cluster_id: str
+    master_record_id: str
+    duplicate_record_ids: List[str]
+    updates: Dict[str, Any] = {}                # golden-record values that differ from the master
+    unresolved_fields: List[str] = []           # conflicts no rule settled (master value kept)
+
+class AutoMergePlanOut(BaseModel):
+    run_id: int
+    clusters_total: int
+    eligible: int
+    records_to_merge: int
+    skipped: Dict[str, int]                     # reason -> clusters
+    groups: List[AutoMergePlanGroup]            # first `limit` eligible groups
+
+class AutoMergeJobOut(BaseModel):
+    id: int
+    run_id: int
+    status: str
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    policy: Optional[Dict[str, Any]] = None
+    clusters_total: Optional[int] = None
+    groups_total: Optional[int] = None
+    groups_done: int = 0
+    records_merged: int = 0
+    errors: int = 0
+    error: Optional[str] = None
+
+class AutoMergeUndoOut(BaseModel):
+    job_id: int
+    groups_undone: int
+    records_restored: int
+    failed: List[str]                           # masters whose group changed since the merge
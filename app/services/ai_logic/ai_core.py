@@ -1,123 +1,253 @@
 import re
 import json
+import random
+import threading
 import time
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import lru_cache
+from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 
 # Importam configuratia si template-urile de prompt
-from .config import AI_PROVIDER, MODEL_PATH, LLM_CPU_THREADS, OPENAI_API_KEY, OPENAI_MODEL_NAME
-from .prompts import json_fixer_prompt_template
+from .config import (
+    AI_PROVIDER, MODEL_PATH, MODEL_FILE, LLM_CPU_THREADS, OPENAI_API_KEY, OPENAI_MODEL_NAME, AI_CONCURRENCY,
+    AI_INFERENCE_POOL, AI_INFERENCE_WORKERS, AI_INFERENCE_QUEUE_SIZE, AI_INFERENCE_TIMEOUT_S,
+    AI_INFERENCE_LOAD_TIMEOUT_S, AI_MOCK_LATENCY_S, AI_MOCK_MALFORMED_RATE, AI_CONSTRAINED_DECODING,
+    AI_CALL_DEADLINE_S, AI_OPENAI_MAX_RETRIES, AI_BREAKER_FAILURES, AI_BREAKER_SLOW_S, AI_BREAKER_OPEN_S,
+    AI_LLAMA_PROMPT_CACHE_MB
+)
+from .breaker import CircuitBreaker, LLMDeadlineExceeded, LLMSlotTimeout, LLMUnavailable
+from .inference_pool import InferencePool, InferenceQueueFull, InferenceTimeout, InferenceUnavailable
+from .prompts import json_fixer_prompt_template, decision_json_schema, prompt_stats, estimate_tokens
+from .telemetry import telemetry
 
 # =============================================================================
-# Sectiunea 1: Initializarea Conditionata a Provider-ului AI
+# Sectiunea 1: Initializarea Lenesa a Provider-ului AI
 # =============================================================================
 load_dotenv()
+
+# Provider-ul este construit la prima utilizare (get_provider) sau de warmup_provider()
+# la pornirea API-ului, nu la import: dedupe, CLI-ul si testele nu mai incarca modelul.
 llm_provider = None
+_provider_lock = threading.Lock()
+_provider_state: Dict[str, Any] = {"status": "not_loaded", "error": None, "load_s": None, "loaded_at": None}
+
 
-if AI_PROVIDER == "mock":
-    class MockLlama:
+class MockLlama:
+    """
+    O clasa mock care simuleaza Llama.cpp pentru dezvoltare rapida.
+    Returneaza un raspuns structurat instantaneu, bazat pe o logica simpla.
+    """
+
+    def __init__(self, *args, **kwargs):
+        print("\n" + "=" * 50)
+        print("--- INITIALIZARE MODUL AI IN MODUL MOCK ---")
+        print("--- RASPUNSURILE VOR FI INSTANTANEE SI SIMULATE ---")
+        print("=" * 50)
+
+    def __call__(self, prompt_text: str, *args, json_schema: Optional[dict] = None, **kwargs) -> Dict[str, Any]:
         """
-        O clasa mock care simuleaza Llama.cpp pentru dezvoltare rapida.
-        Returneaza un raspuns structurat instantaneu, bazat pe o logica simpla.
+        Simuleaza un apel catre LLM, parsand prompt-ul si generand un raspuns logic.
+        Fara json_schema (decodare neconstransa), o fractiune AI_MOCK_MALFORMED_RATE
+        din raspunsuri are JSON invalid, ca un model real.
         """
-
-        def __init__(self, *args, **kwargs):
-            print("\n" + "=" * 50)
-            print("--- INITIALIZARE MODUL AI IN MODUL MOCK ---")
-            print("--- RASPUNSURILE VOR FI INSTANTANEE SI SIMULATE ---")
-            print("=" * 50)
-
-        def __call__(self, prompt_text: str, *args, **kwargs) -> Dict[str, Any]:
-            """Simuleaza un apel catre LLM, parsand prompt-ul si generand un raspuns logic."""
-            time.sleep(0.1)  # Simulam o mica intarziere
-
-            # Simulare pentru prompt-ul de corectare JSON
-            if "### BROKEN JSON TEXT ###" in prompt_text:
-                match = re.search(r'\{.*\}', prompt_text, re.DOTALL)
-                if match:
-                    # O reparare simplista, dar suficienta pentru majoritatea cazurilor de test
-                    fixed_json_str = match.group(0).replace(",\nnant_value\"", ',\n"nant_value"').replace("ran",
-                                                                                                          "justification")
-                    return {"choices": [{"text": fixed_json_str}]}
-                return {"choices": [{"text": "{}"}]}
-
-            # Simulare pentru prompt-ul principal de analiza
-            conflicts_str_match = re.search(r'### CONFLICTING DATA ###\s*(\{.*?\})', prompt_text, re.DOTALL)
-            if not conflicts_str_match:
-                return {"choices": [{"text": '{"human_review_required": true, "resolved_conflicts": {}}'}]}
-
-            conflicts = json.loads(conflicts_str_match.group(1))
-            resolved = {}
-            human_review_needed = False
-
-            for field, values in conflicts.items():
-                val_a = values.get("value_A")
-                val_b = values.get("value_B")
-
-                if field == "email" and isinstance(val_a, str) and isinstance(val_b, str):
-                    user_a, _ = val_a.split('@', 1)
-                    user_b, _ = val_b.split('@', 1)
-                    if user_a != user_b:
-                        human_review_needed = True
-                        resolved[field] = {
-                            "chosen_value": "NEEDS_HUMAN_REVIEW",
-                            "justification": "MOCK: Usernames are different."
-                        }
-                    else:
-                        resolved[field] = {"chosen_value": val_b,
-                                           "justification": "MOCK: Email usernames match, chose value B."}
-                elif field == "first_name" and isinstance(val_a, str) and isinstance(val_b, str):
-                    chosen = val_b if len(val_b) >= len(val_a) else val_a
-                    resolved[field] = {"chosen_value": chosen, "justification": "MOCK: Chose longer name."}
+        time.sleep(AI_MOCK_LATENCY_S)  # Simulam o mica intarziere
+
+        # Simulare pentru prompt-ul de corectare JSON
+        if "### BROKEN JSON TEXT ###" in prompt_text:
+            match = re.search(r'### BROKEN JSON TEXT ###\s*(\{.*\})\s*### PARSING ERROR', prompt_text, re.DOTALL)
+            if match:
+                # Repara virgulele lipsa dintre perechile cheie/valoare (defectul simulat mai jos)
+                fixed_json_str = re.sub(r'(["}\d]|true|false|null)(\s*\n\s*")', r'\1,\2', match.group(1))
+                return {"choices": [{"text": fixed_json_str}]}
+            return {"choices": [{"text": "{}"}]}
+
+        # Simulare pentru prompt-ul principal de analiza
+        conflicts_str_match = re.search(r'### CONFLICTING DATA ###\s*(?=\{)', prompt_text)
+        if not conflicts_str_match:
+            return {"choices": [{"text": '{"human_review_required": true, "resolved_conflicts": {}}'}]}
+
+        # raw_decode citeste exact obiectul JSON (inclusiv obiectele imbricate)
+        conflicts, _ = json.JSONDecoder().raw_decode(prompt_text, conflicts_str_match.end())
+        resolved = {}
+        human_review_needed = False
+
+        for field, values in conflicts.items():
+            val_a = values.get("value_A")
+            val_b = values.get("value_B")
+
+            if field == "email" and isinstance(val_a, str) and isinstance(val_b, str):
+                user_a, _ = val_a.split('@', 1)
+                user_b, _ = val_b.split('@', 1)
+                if user_a != user_b:
+                    human_review_needed = True
+                    resolved[field] = {
+                        "chosen_value": "NEEDS_HUMAN_REVIEW",
+                        "justification": "MOCK: Usernames are different."
+                    }
                 else:
-                    resolved[field] = {"chosen_value": val_b, "justification": "MOCK: Default choice (value B)."}
+                    resolved[field] = {"chosen_value": val_b,
+                                       "justification": "MOCK: Email usernames match, chose value B."}
+            elif field == "first_name" and isinstance(val_a, str) and isinstance(val_b, str):
+                chosen = val_b if len(val_b) >= len(val_a) else val_a
+                resolved[field] = {"chosen_value": chosen, "justification": "MOCK: Chose longer name."}
+            else:
+                resolved[field] = {"chosen_value": val_b, "justification": "MOCK: Default choice (value B)."}
+
+        mock_response = {
+            "human_review_required": human_review_needed,
+            "resolved_conflicts": resolved
+        }
+        text = json.dumps(mock_response, indent=2)
+        if json_schema is None and random.random() < AI_MOCK_MALFORMED_RATE:
+            text = text.replace(",\n", "\n", 1)   # virgula lipsa
+        return {"choices": [{"text": text}]}
+
+
+class LocalLlamaModel:
+    """Llama.cpp cu decodare constransa: json_schema devine o gramatica GBNF (cache per schema)."""
+
+    def __init__(self, llama):
+        self.llama = llama
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _grammar(schema_json: str):
+        from llama_cpp import LlamaGrammar
+        return LlamaGrammar.from_json_schema(schema_json, verbose=False)
+
+    def __call__(self, prompt_text: str, json_schema: Optional[dict] = None, **kwargs) -> Dict[str, Any]:
+        """Generare in flux, pentru a masura timpul pana la primul token; raspunsul are forma obisnuita."""
+        if json_schema is not None:
+            kwargs["grammar"] = self._grammar(json.dumps(json_schema, sort_keys=True))
+        start = time.perf_counter()
+        ttft_ms = None
+        parts = []
+        for chunk in self.llama(prompt_text, stream=True, **kwargs):
+            if ttft_ms is None:
+                ttft_ms = (time.perf_counter() - start) * 1000
+            parts.append(chunk["choices"][0]["text"])
+        return {
+            "choices": [{"text": "".join(parts)}],
+            # fiecare fragment din flux este un token generat
+            "usage": {"prompt_tokens": len(self.llama.tokenize(prompt_text.encode("utf-8"))),
+                      "completion_tokens": len(parts)},
+            "timings": {"ttft_ms": ttft_ms},
+        }
+
+
+def use_inference_pool() -> bool:
+    """Modelele locale (si mock, la cerere) ruleaza in procese separate, nu pe thread-urile API."""
+    if AI_INFERENCE_POOL == "auto":
+        return AI_PROVIDER == "local"
+    return AI_INFERENCE_POOL in ("true", "1") and AI_PROVIDER in ("local", "mock")
+
+
+def _create_model(kind: str):
+    """Instanta de model in procesul curent ('local' sau 'mock'); folosita si de workerii din pool."""
+    if kind == "mock":
+        return MockLlama()
+    try:
+        from llama_cpp import Llama
+    except ImportError:
+        raise RuntimeError("Pachetul 'llama-cpp-python' nu este instalat.")
+    print("\nSe incarca modelul LLM local in memorie (poate dura)...")
+    model = Llama(
+        model_path=MODEL_PATH,
+        n_gpu_layers=0,
+        n_ctx=4096,
+        n_threads=LLM_CPU_THREADS,
+        verbose=False
+    )
+    if AI_LLAMA_PROMPT_CACHE_MB > 0:
+        # starea KV a prefixului fix al prompt-ului compact supravietuieste apelurilor intercalate (fixer)
+        from llama_cpp import LlamaRAMCache
+        model.set_cache(LlamaRAMCache(capacity_bytes=AI_LLAMA_PROMPT_CACHE_MB << 20))
+    print("Modelul local a fost incarcat cu succes.")
+    return LocalLlamaModel(model)
 
-            mock_response = {
-                "human_review_required": human_review_needed,
-                "resolved_conflicts": resolved
-            }
-            return {"choices": [{"text": json.dumps(mock_response, indent=2)}]}
+
+def _create_provider():
+    """Construieste provider-ul configurat; ridica o exceptie daca nu se poate."""
+    if AI_PROVIDER == "openai":
+        try:
+            from openai import OpenAI
+        except ImportError:
+            raise RuntimeError("Pachetul 'openai' nu este instalat. Rulati 'pip install openai'.")
+        if not OPENAI_API_KEY:
+            raise RuntimeError("Variabila de mediu 'OPENAI_API_KEY' nu este setata.")
+        print(f"\nINFO: Provider-ul AI este setat pe 'openai', folosind modelul '{OPENAI_MODEL_NAME}'.")
+        return OpenAI(api_key=OPENAI_API_KEY, max_retries=AI_OPENAI_MAX_RETRIES, timeout=AI_CALL_DEADLINE_S)
+
+    if AI_PROVIDER in ("local", "mock"):
+        if use_inference_pool():
+            print(f"INFO: Se pornesc {AI_INFERENCE_WORKERS} worker(i) de inferenta '{AI_PROVIDER}'.")
+            pool = InferencePool(AI_PROVIDER, AI_INFERENCE_WORKERS, AI_INFERENCE_QUEUE_SIZE, AI_INFERENCE_TIMEOUT_S)
+            return pool.start(wait_ready_s=AI_INFERENCE_LOAD_TIMEOUT_S)
+        return _create_model(AI_PROVIDER)
+
+    raise RuntimeError(
+        f"Provider-ul AI '{AI_PROVIDER}' nu este recunoscut. Optiuni valide: 'local', 'openai', 'mock'.")
+
+
+def get_provider():
+    """Returneaza provider-ul, construindu-l la primul apel. None daca initializarea a esuat."""
+    global llm_provider
+    if llm_provider is not None:
+        return llm_provider
+    with _provider_lock:
+        if llm_provider is not None or _provider_state["status"] == "failed":
+            return llm_provider
+        _provider_state.update(status="loading", error=None)
+        start = time.time()
+        try:
+            llm_provider = _create_provider()
+        except Exception as e:
+            print(f"EROARE: Provider-ul AI '{AI_PROVIDER}' nu a putut fi initializat: {e}")
+            _provider_state.update(status="failed", error=str(e))
+            return None
+        _provider_state.update(status="ready", load_s=round(time.time() - start, 3), loaded_at=time.time())
+        return llm_provider
 
 
-    llm_provider = MockLlama()
+def warmup_provider() -> threading.Thread:
+    """Incarca provider-ul pe un thread de fundal (apelat la pornirea API-ului)."""
+    t = threading.Thread(target=get_provider, name="ai-provider-warmup", daemon=True)
+    t.start()
+    return t
 
-elif AI_PROVIDER == "openai":
-    try:
-        from openai import OpenAI
 
-        if not OPENAI_API_KEY:
-            raise ValueError("Variabila de mediu 'OPENAI_API_KEY' nu este setata.")
-        llm_provider = OpenAI(api_key=OPENAI_API_KEY)
-        print(f"\nINFO: Provider-ul AI este setat pe 'openai', folosind modelul '{OPENAI_MODEL_NAME}'.")
-    except ImportError:
-        print("EROARE: Pachetul 'openai' nu este instalat. Rulati 'pip install openai'.")
-        llm_provider = None
-    except ValueError as e:
-        print(f"EROARE DE CONFIGURARE OPENAI: {e}")
+def reset_provider() -> None:
+    """Opreste si uita provider-ul (si o eventuala eroare); urmatorul apel il reconstruieste."""
+    global llm_provider
+    with _provider_lock:
+        if isinstance(llm_provider, InferencePool):
+            llm_provider.shutdown()
         llm_provider = None
+        _provider_state.update(status="not_loaded", error=None, load_s=None, loaded_at=None)
 
-elif AI_PROVIDER == "local":
-    try:
-        from llama_cpp import Llama
 
-        print("\nSe incarca modelul LLM local in memorie (poate dura)...")
-        llm_provider = Llama(
-            model_path=MODEL_PATH,
-            n_gpu_layers=0,
-            n_ctx=4096,
-            n_threads=LLM_CPU_THREADS,
-            verbose=False
-        )
-        print("Modelul local a fost incarcat cu succes.")
-    except ImportError:
-        print("EROARE: Pachetul 'llama-cpp-python' nu este instalat.")
-        llm_provider = None
-    except Exception as e:
-        print(f"EROARE CRITICA la incarcarea modelului local: {e}")
-        llm_provider = None
+def provider_status() -> Dict[str, Any]:
+    """Starea provider-ului pentru endpoint-ul de readiness."""
+    state = dict(_provider_state)
+    if llm_provider is not None:
+        state["status"] = "ready"   # provider injectat direct (ex. teste)
+    if isinstance(llm_provider, InferencePool) and not llm_provider.ready:
+        state["status"] = "degraded"   # pool pornit, dar niciun worker viu
+    return {"provider": AI_PROVIDER, "model": current_model_name(), "ready": state["status"] == "ready",
+            "inference_pool": use_inference_pool(), "breaker_state": breaker.stats()["state"], **state}
 
-else:
-    print(f"EROARE: Provider-ul AI '{AI_PROVIDER}' nu este recunoscut. Optiuni valide: 'local', 'openai', 'mock'.")
+
+def inference_stats() -> Dict[str, Any]:
+    """Adancimea cozii, latente si contoare ale pool-ului de inferenta (daca este folosit)."""
+    if isinstance(llm_provider, InferencePool):
+        stats = llm_provider.stats()
+    else:
+        stats = {"provider": AI_PROVIDER, "running": False, "inference_pool": use_inference_pool()}
+    stats["decoding"] = decoding_stats()
+    stats["prompt"] = prompt_stats()
+    stats["breaker"] = breaker.stats()
+    return stats
 
 
 # =============================================================================
@@ -138,38 +268,168 @@ def _parse_prompt_for_openai(prompt_text: str) -> list:
     ]
 
 
-def _run_openai_inference(prompt_text: str) -> Dict[str, Any]:
+def _run_openai_inference(provider, prompt_text: str, json_schema: Optional[dict] = None,
+                          timeout_s: Optional[float] = None) -> Dict[str, Any]:
     """Apeleaza API-ul OpenAI si formateaza raspunsul pentru a fi consistent."""
     messages = _parse_prompt_for_openai(prompt_text)
-    completion = llm_provider.chat.completions.create(
+    if json_schema is not None:
+        # structured outputs: raspunsul respecta schema, nu mai e nevoie de fixer
+        response_format = {"type": "json_schema",
+                           "json_schema": {"name": "merge_decision", "schema": json_schema, "strict": True}}
+    else:
+        response_format = {"type": "json_object"}
+    completion = provider.chat.completions.create(
         model=OPENAI_MODEL_NAME,
         messages=messages,
         temperature=0.0,
         max_tokens=1024,
-        response_format={"type": "json_object"}
+        response_format=response_format,
+        timeout=timeout_s
     )
     response_text = completion.choices[0].message.content
-    return {"choices": [{"text": response_text}]}
+    out = {"choices": [{"text": response_text}]}
+    if completion.usage is not None:
+        out["usage"] = {"prompt_tokens": completion.usage.prompt_tokens,
+                        "completion_tokens": completion.usage.completion_tokens}
+    return out
 
 
-def _run_local_llm_inference(prompt_text: str) -> Dict[str, Any]:
+def _run_local_llm_inference(provider, prompt_text: str, json_schema: Optional[dict] = None,
+                             **kwargs) -> Dict[str, Any]:
     """Apeleaza modelul local Llama.cpp (sau clasa mock)."""
-    return llm_provider(prompt_text, max_tokens=1024, temperature=0.0, stop=["<|end|>"])
+    if json_schema is not None:
+        kwargs["json_schema"] = json_schema
+    return provider(prompt_text, max_tokens=1024, temperature=0.0, stop=["<|end|>"], **kwargs)
+
+
+def provider_concurrency_limit() -> int:
+    if use_inference_pool():
+        return max(1, AI_INFERENCE_WORKERS)
+    return max(1, AI_CONCURRENCY.get(AI_PROVIDER, 1))
+
+
+# Limiteaza apelurile simultane catre provider, indiferent de unde vin (lot, arbore de fuziune).
+_provider_slots = threading.BoundedSemaphore(provider_concurrency_limit())
+# Apelurile in proces ruleaza aici, ca apelantul sa poata renunta la termen (thread-urile nu pot fi oprite)
+_call_pool = ThreadPoolExecutor(max_workers=provider_concurrency_limit(), thread_name_prefix="ai-call")
 
+breaker = CircuitBreaker(AI_BREAKER_FAILURES, AI_BREAKER_SLOW_S, AI_BREAKER_OPEN_S)
 
-def run_llm_inference(prompt_text: str) -> Dict[str, Any]:
+
+def _call_with_deadline(fn, deadline_s: float):
     """
-    Dispatcher-ul principal. Apeleaza provider-ul AI corect pe baza configuratiei.
+    Ruleaza fn(timp_ramas_s) pe un slot de provider, in cel mult deadline_s de la apel
+    (asteptarea slotului intra in termen); slotul ramane ocupat pana cand apelul chiar se termina.
     """
-    if not llm_provider:
-        raise RuntimeError(
-            f"Provider-ul AI '{AI_PROVIDER}' nu a fost initializat corect. Verificati configuratia si log-urile de la pornire.")
+    deadline = time.monotonic() + deadline_s
+    if not _provider_slots.acquire(timeout=deadline_s):
+        raise LLMSlotTimeout(f"No free AI provider slot within {deadline_s:g}s")
+    try:
+        fut = _call_pool.submit(fn, max(0.0, deadline - time.monotonic()))
+    except BaseException:
+        _provider_slots.release()
+        raise
+    fut.add_done_callback(lambda _f: _provider_slots.release())
+    try:
+        return fut.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        raise LLMDeadlineExceeded(f"AI provider did not answer within {deadline_s:g}s")
 
+
+def current_model_name() -> str:
+    """Identificatorul modelului folosit (parte din cheia cache-ului de decizii)."""
     if AI_PROVIDER == "openai":
-        return _run_openai_inference(prompt_text)
+        return f"openai:{OPENAI_MODEL_NAME}"
+    if AI_PROVIDER == "local":
+        return f"local:{MODEL_FILE}"
+    return AI_PROVIDER
+
+
+def _record_call(purpose: str, prompt_text: str, start: float, out: Optional[Dict[str, Any]] = None,
+                 error: Optional[BaseException] = None) -> None:
+    """Telemetria unui apel: tokeni (raportati de provider sau estimati), latente, rezultat."""
+    rec = {
+        "provider": AI_PROVIDER, "model": current_model_name(), "purpose": purpose,
+        "latency_ms": round((time.monotonic() - start) * 1000, 1),
+        "outcome": "ok" if error is None else type(error).__name__,
+        "prompt_tokens": None, "completion_tokens": None, "tokens_estimated": False,
+        "ttft_ms": None, "queue_wait_ms": None,
+    }
+    if out is not None:
+        usage = out.get("usage") or {}
+        timings = out.get("timings") or {}
+        rec["prompt_tokens"] = usage.get("prompt_tokens")
+        rec["completion_tokens"] = usage.get("completion_tokens")
+        if rec["prompt_tokens"] is None or rec["completion_tokens"] is None:
+            rec["prompt_tokens"] = estimate_tokens(prompt_text)
+            rec["completion_tokens"] = estimate_tokens(out["choices"][0]["text"] or "")
+            rec["tokens_estimated"] = True
+        for k in ("ttft_ms", "queue_wait_ms"):
+            if timings.get(k) is not None:
+                rec[k] = round(timings[k], 1)
+    telemetry.record_call(rec)
+
+
+def run_llm_inference(prompt_text: str, json_schema: Optional[dict] = None,
+                      purpose: str = "analysis") -> Dict[str, Any]:
+    """
+    Dispatcher-ul principal. Apeleaza provider-ul AI corect pe baza configuratiei.
+    json_schema (optional) constrange decodarea la schema data; purpose ('analysis'
+    sau 'fixer') eticheteaza apelul in telemetrie.
 
-    # 'local' si 'mock' au aceeasi interfata de apel
-    return _run_local_llm_inference(prompt_text)
+    Fiecare apel are termenul AI_CALL_DEADLINE_S (prin pool-ul de inferenta:
+    AI_INFERENCE_TIMEOUT_S, timeout-ul pool-ului) si trece prin circuit breaker;
+    LLMUnavailable (circuit deschis, termen depasit, provider indisponibil) ii
+    spune apelantului sa treaca pe varianta determinista.
+    """
+    provider = get_provider()
+    if not provider:
+        raise LLMUnavailable(
+            f"Provider-ul AI '{AI_PROVIDER}' nu a fost initializat corect: {_provider_state['error']}")
+
+    breaker.allow()
+    start = time.monotonic()
+    try:
+        if isinstance(provider, InferencePool):
+            # pool-ul are propria coada limitata (429 cand e plina) si timeout per cerere
+            # (AI_INFERENCE_TIMEOUT_S: modelul local poate avea nevoie de mai mult decat AI_CALL_DEADLINE_S)
+            out = _run_local_llm_inference(provider, prompt_text, json_schema)
+        elif AI_PROVIDER == "openai":
+            out = _call_with_deadline(
+                lambda left_s: _run_openai_inference(provider, prompt_text, json_schema, left_s),
+                AI_CALL_DEADLINE_S)
+        else:
+            # 'local' si 'mock' au aceeasi interfata de apel
+            out = _call_with_deadline(
+                lambda _left_s: _run_local_llm_inference(provider, prompt_text, json_schema), AI_CALL_DEADLINE_S)
+    except (InferenceQueueFull, LLMSlotTimeout) as e:
+        # presiune locala (coada plina / niciun slot liber), nu o defectiune a provider-ului:
+        # breaker-ul numara doar apelurile care au ajuns la provider
+        breaker.release()
+        _record_call(purpose, prompt_text, start, error=e)
+        raise
+    except InferenceTimeout as e:
+        breaker.record(time.monotonic() - start, e)
+        _record_call(purpose, prompt_text, start, error=e)
+        raise LLMDeadlineExceeded(str(e)) from e
+    except InferenceUnavailable as e:
+        breaker.record(time.monotonic() - start, e)
+        _record_call(purpose, prompt_text, start, error=e)
+        raise LLMUnavailable(str(e)) from e
+    except Exception as e:
+        breaker.record(time.monotonic() - start, e)
+        _record_call(purpose, prompt_text, start, error=e)
+        raise
+    breaker.record(time.monotonic() - start)
+    _record_call(purpose, prompt_text, start, out)
+    return out
+
+
+def decision_schema_for(conflicting_data: Dict[str, Any]) -> Optional[dict]:
+    """Schema folosita pentru decodarea constransa a deciziei, sau None daca e dezactivata."""
+    if not AI_CONSTRAINED_DECODING:
+        return None
+    return decision_json_schema(conflicting_data.keys())
 
 
 # =============================================================================
@@ -205,14 +465,45 @@ def validate_email_decision(decision: Dict[str, Any], conflicting_data: Dict[str
     return decision
 
 
-def parse_and_correct_response(initial_output: Dict[str, Any], conflicting_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Incearca sa parseze raspunsul. Daca esueaza, ruleaza ciclul de auto-corectare."""
+_decoding_lock = threading.Lock()
+_decoding_stats = {"responses": 0, "constrained": 0, "parse_failures": 0, "fixer_calls": 0, "fixer_failures": 0}
+
+
+def decoding_stats() -> Dict[str, Any]:
+    """Contoare de parsare: cate raspunsuri au avut nevoie de apelul suplimentar de corectare."""
+    with _decoding_lock:
+        s = dict(_decoding_stats)
+    s["fixer_rate"] = round(s["fixer_calls"] / s["responses"], 4) if s["responses"] else 0.0
+    s["constrained_decoding"] = AI_CONSTRAINED_DECODING
+    return s
+
+
+def _count(**inc) -> None:
+    with _decoding_lock:
+        for k, v in inc.items():
+            _decoding_stats[k] += v
+
+
+def parse_and_correct_response(initial_output: Dict[str, Any], conflicting_data: Dict[str, Any],
+                               json_schema: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Incearca sa parseze raspunsul. Daca esueaza, ruleaza ciclul de auto-corectare.
+    Un raspuns decodat dupa json_schema este deja JSON valid si se parseaza direct.
+    """
+    _count(responses=1, constrained=1 if json_schema is not None else 0)
     try:
         raw_response_text = initial_output['choices'][0]['text']
+        if json_schema is not None:
+            try:
+                decision = json.loads(raw_response_text)
+                return validate_email_decision(decision, conflicting_data)
+            except json.JSONDecodeError:
+                pass   # ex. raspuns trunchiat la max_tokens; continuam cu extragerea
         clean_json_str = extract_json_from_llm_output(raw_response_text)
         decision = json.loads(clean_json_str)
     except (json.JSONDecodeError, KeyError, IndexError) as e:
         print(f"INFO: Raspunsul initial nu a fost valid. Eroare: {e}. Se incearca auto-corectarea...")
+        _count(parse_failures=1, fixer_calls=1)
 
         fixer_prompt = json_fixer_prompt_template.format(
             broken_json_str=clean_json_str if 'clean_json_str' in locals() else raw_response_text,
@@ -220,12 +511,15 @@ def parse_and_correct_response(initial_output: Dict[str, Any], conflicting_data:
         )
 
         try:
-            fixer_output = run_llm_inference(fixer_prompt)
+            fixer_output = run_llm_inference(fixer_prompt, json_schema, purpose="fixer")
             corrected_text = fixer_output['choices'][0]['text']
             decision = json.loads(extract_json_from_llm_output(corrected_text))
             print("INFO: Auto-corectarea a reusit.")
+        except LLMUnavailable:
+            raise
         except (json.JSONDecodeError, KeyError, IndexError, RuntimeError) as final_e:
             print(f"EROARE: Auto-corectarea a esuat. Eroare finala: {final_e}")
+            _count(fixer_failures=1)
             return None
 
     return validate_email_decision(decision, conflicting_data)
\ No newline at end of file
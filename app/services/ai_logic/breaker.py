@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class LLMUnavailable(RuntimeError):
+    """The provider cannot answer right now; callers fall back to deterministic survivorship."""
+
+
+class LLMCircuitOpen(LLMUnavailable):
+    pass
+
+
+class LLMDeadlineExceeded(LLMUnavailable):
+    pass
+
+
+class LLMSlotTimeout(LLMDeadlineExceeded):
+    """No local provider slot freed up in time; the provider itself was never called."""
+
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker around the LLM provider.
+
+    closed    -> calls pass; failure_threshold consecutive failures (errors,
+                 deadline hits, or calls slower than slow_call_s) open it
+    open      -> calls are rejected at once for open_s seconds
+    half_open -> one probe call is let through; success closes the breaker,
+                 failure opens it again
+    """
+
+    def __init__(self, failure_threshold: int, slow_call_s: float, open_s: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_call_s = slow_call_s
+        self.open_s = open_s
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.metrics = {"calls": 0, "successes": 0, "failures": 0, "slow_calls": 0,
+                        "short_circuited": 0, "times_opened": 0}
+        self.last_error: Optional[str] = None
+
+    def allow(self) -> None:
+        """Raises LLMCircuitOpen when the call must not reach the provider."""
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.open_s:
+                    self.metrics["short_circuited"] += 1
+                    raise LLMCircuitOpen(f"AI provider circuit is open ({self.last_error})")
+                self._state = "half_open"
+            if self._state == "half_open":
+                if self._probe_in_flight:
+                    self.metrics["short_circuited"] += 1
+                    raise LLMCircuitOpen("AI provider circuit is half-open; probe call in flight")
+                self._probe_in_flight = True
+            self.metrics["calls"] += 1
+
+    def record(self, elapsed_s: float, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self._probe_in_flight = False
+            slow = error is None and elapsed_s > self.slow_call_s
+            if error is None and not slow:
+                self.metrics["successes"] += 1
+                self._consecutive = 0
+                self._state = "closed"
+                return
+            if slow:
+                self.metrics["slow_calls"] += 1
+                self.last_error = f"slow call: {elapsed_s:.1f}s"
+            else:
+                self.metrics["failures"] += 1
+                self.last_error = f"{type(error).__name__}: {error}"
+            self._consecutive += 1
+            if self._state == "half_open" or self._consecutive >= self.failure_threshold:
+                if self._state != "open":
+                    self.metrics["times_opened"] += 1
+                    print(f"INFO: Circuitul catre provider-ul AI s-a deschis ({self.last_error}).")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """The call was not attempted after allow() (e.g. rejected by the local queue)."""
+        with self._lock:
+            self._probe_in_flight = False
+            self.metrics["calls"] -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self._state
+            if state == "open" and time.monotonic() - self._opened_at >= self.open_s:
+                state = "half_open"   # the next call will probe
+            return {
+                "state": state, "consecutive_failures": self._consecutive,
+                "failure_threshold": self.failure_threshold, "slow_call_s": self.slow_call_s,
+                "open_s": self.open_s, "last_error": self.last_error, **self.metrics,
+            }
@@ -7,23 +7,73 @@ load_dotenv()
 # --- Configurare Provider AI ---
 # Provider-ul AI de utilizat. Optiuni: 'local', 'openai', 'mock'
 # Poate fi suprascris de variabila de mediu AI_PROVIDER
-# AI_PROVIDER = os.getenv("AI_PROVIDER", "local").lower()
+AI_PROVIDER = os.getenv("AI_PROVIDER", "openai").lower()
+# Provider-ul se incarca lenes; la pornirea API-ului poate fi "incalzit" pe un thread de fundal.
+AI_WARMUP_ON_STARTUP = os.getenv("AI_WARMUP_ON_STARTUP", "True").lower() in ("true", "1")
 
 # --- Configurare Model Local (Llama.cpp) ---
 MODEL_REPO = "microsoft/Phi-3-mini-4k-instruct-gguf"
 MODEL_FILE = "Phi-3-mini-4k-instruct-q4.gguf"
 MODEL_FOLDER = "models"
 MODEL_PATH = f"{MODEL_FOLDER}/{MODEL_FILE}"
-LLM_CPU_THREADS = 4
+LLM_CPU_THREADS = int(os.getenv("LLM_CPU_THREADS", "4"))
+
+# --- Pool de procese pentru inferenta locala ---
+# 'auto' = doar pentru provider-ul 'local'; 'true' = si pentru 'mock' (teste); 'false' = in proces.
+AI_INFERENCE_POOL = os.getenv("AI_INFERENCE_POOL", "auto").lower()
+# Fiecare worker tine o instanta a modelului si foloseste LLM_CPU_THREADS nuclee.
+AI_INFERENCE_WORKERS = int(os.getenv("AI_INFERENCE_WORKERS", str(max(1, (os.cpu_count() or 1) // LLM_CPU_THREADS))))
+AI_INFERENCE_QUEUE_SIZE = int(os.getenv("AI_INFERENCE_QUEUE_SIZE", "16"))        # cereri in asteptare peste workeri
+AI_INFERENCE_TIMEOUT_S = float(os.getenv("AI_INFERENCE_TIMEOUT_S", "120"))        # timeout per cerere
+AI_INFERENCE_LOAD_TIMEOUT_S = float(os.getenv("AI_INFERENCE_LOAD_TIMEOUT_S", "600"))  # incarcarea modelului
 
 # --- Configurare OpenAI ---
 # Cheia API trebuie setata ca variabila de mediu, NU direct in cod.
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
 
+# --- Cache pentru deciziile AI (LRU in memorie + tabel SQLite persistent) ---
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "True").lower() in ("true", "1")
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "ai_decision_cache.db")
+AI_CACHE_MEMORY_SIZE = int(os.getenv("AI_CACHE_MEMORY_SIZE", "2048"))      # intrari in LRU
+AI_CACHE_MAX_ROWS = int(os.getenv("AI_CACHE_MAX_ROWS", "200000"))          # randuri in tabelul SQLite
+AI_CACHE_TTL_S = float(os.getenv("AI_CACHE_TTL_S", str(30 * 24 * 3600)))   # 30 zile
+
+# --- Concurenta ---
+# Numar maxim de apeluri LLM simultane per provider (in tot procesul).
+# Llama.cpp nu este thread-safe, deci modelul local ruleaza un singur apel odata.
+AI_CONCURRENCY = {
+    "openai": int(os.getenv("AI_CONCURRENCY_OPENAI", "8")),
+    "local": int(os.getenv("AI_CONCURRENCY_LOCAL", "1")),
+    "mock": int(os.getenv("AI_CONCURRENCY_MOCK", "16")),
+}
+# --- Termene si circuit breaker pentru apelurile LLM ---
+# termen per apel catre provider, asteptarea slotului inclusa (apelurile prin pool-ul de
+# inferenta folosesc AI_INFERENCE_TIMEOUT_S)
+AI_CALL_DEADLINE_S = float(os.getenv("AI_CALL_DEADLINE_S", "30"))
+AI_OPENAI_MAX_RETRIES = int(os.getenv("AI_OPENAI_MAX_RETRIES", "1"))     # reincercari in clientul OpenAI
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))         # esecuri consecutive pana la deschidere
+AI_BREAKER_SLOW_S = float(os.getenv("AI_BREAKER_SLOW_S", "20"))          # un apel mai lent conteaza ca esec
+AI_BREAKER_OPEN_S = float(os.getenv("AI_BREAKER_OPEN_S", "30"))          # cat ramane deschis inainte de proba
+AI_BATCH_WORKERS = int(os.getenv("AI_BATCH_WORKERS", "32"))         # thread-uri pentru sugestii in lot
+AI_ITEM_TIMEOUT_S = float(os.getenv("AI_ITEM_TIMEOUT_S", "120"))    # timeout per cluster in lot
+
 # --- Configurare Mod Mock (suprascrie AI_PROVIDER daca e True) ---
 USE_MOCK_LLM = os.getenv("USE_MOCK_LLM", "False").lower() in ("true", "1")
+AI_MOCK_LATENCY_S = float(os.getenv("AI_MOCK_LATENCY_S", "0.1"))   # intarzierea simulata a unui apel mock
+# Fractiunea de raspunsuri mock ne-constranse emise cu JSON invalid (pentru a masura fixer-ul)
+AI_MOCK_MALFORMED_RATE = float(os.getenv("AI_MOCK_MALFORMED_RATE", "0.0"))
+
+# --- Decodare constransa ---
+# Modelul local decodeaza dupa o gramatica derivata din schema JSON a deciziei,
+# iar OpenAI foloseste structured outputs (json_schema strict).
+AI_CONSTRAINED_DECODING = os.getenv("AI_CONSTRAINED_DECODING", "True").lower() in ("true", "1")
+
+# --- Prompt compact ---
+# JSON minificat, doar contextul relevant pentru conflicte si un prefix de sistem fix
+# (refolosit din cache-ul KV de llama.cpp / prompt caching la OpenAI).
+AI_COMPACT_PROMPT = os.getenv("AI_COMPACT_PROMPT", "True").lower() in ("true", "1")
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "1200"))     # tokeni estimati per prompt
+AI_LLAMA_PROMPT_CACHE_MB = int(os.getenv("AI_LLAMA_PROMPT_CACHE_MB", "256"))  # 0 = fara cache de prefix
 if USE_MOCK_LLM:
     AI_PROVIDER = "mock"
-
-AI_PROVIDER = "openai"
\ No newline at end of file
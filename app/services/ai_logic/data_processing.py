@@ -47,3 +47,43 @@ def prepare_data_for_llm(rec_a, rec_b):
             conflicting_fields[key] = {"value_A": val_a, "value_B": val_b}
 
     return identical_fields, conflicting_fields
+
+
+# Campurile identice care ajuta la decizia unui conflict (vezi regulile din prompt).
+CONTEXT_FIELDS = {
+    "first_name": ("last_name", "email", "gender"),
+    "last_name": ("first_name", "email"),
+    "email": ("first_name", "last_name"),
+    "gender": ("first_name",),
+    "address": ("city", "county"),
+    "city": ("address", "county"),
+    "county": ("address", "city"),
+    "date_of_birth": ("ssn",),
+    "ssn": ("date_of_birth", "last_name"),
+}
+# Identificatori puternici: cand sunt identici, modelul are nevoie doar sa stie ca se potrivesc.
+STRONG_IDENTIFIERS = ("ssn", "date_of_birth", "phone_number", "email")
+
+
+def compact_context(conflicting_fields, identical_fields, with_agreement=True):
+    """
+    Contextul minim pentru prompt: valorile identice relevante pentru campurile
+    in conflict, iar restul identificatorilor puternici identici doar ca nume
+    (lista "also_identical"). Identificatorii interni si campurile goale lipsesc.
+    """
+    wanted = set()
+    for field in conflicting_fields:
+        wanted.update(CONTEXT_FIELDS.get(field, ()))
+    context = {}
+    agreeing = []
+    for key in sorted(identical_fields):
+        value = identical_fields[key]
+        if value is None or value == "" or key in conflicting_fields:
+            continue
+        if key in wanted:
+            context[key] = value
+        elif with_agreement and key in STRONG_IDENTIFIERS:
+            agreeing.append(key)
+    if agreeing:
+        context["also_identical"] = agreeing
+    return context
@@ -0,0 +1,268 @@
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .config import (
+    AI_CACHE_ENABLED, AI_CACHE_PATH, AI_CACHE_MEMORY_SIZE, AI_CACHE_MAX_ROWS, AI_CACHE_TTL_S
+)
+
+# Identical fields that do not influence the decision (identifiers, status flags);
+# everything else in the shared context is part of the cache key.
+CONTEXT_IGNORE = {"record_id", "original_record_id", "cluster_id", "merged_into", "is_deleted"}
+
+# Prune the SQLite table back to AI_CACHE_MAX_ROWS every this many stores.
+_PRUNE_EVERY = 500
+# Hits are counted in memory and written to the table in one transaction per this many
+# (or with the next store), so a lookup never writes.
+_FLUSH_HITS_EVERY = 200
+
+
+def _norm_value(v: Any) -> Any:
+    if v is None:
+        return None
+    if isinstance(v, str):
+        v = " ".join(v.split())
+        return v or None
+    return v
+
+
+def cache_key(conflicting_data: Dict[str, Any], identical_data: Dict[str, Any],
+              prompt_version: str, model_name: str) -> str:
+    """Canonical hash of the normalized conflict set, its relevant context, prompt version and model."""
+    conflicts = {
+        field: {"value_A": _norm_value(v.get("value_A")), "value_B": _norm_value(v.get("value_B"))}
+        for field, v in conflicting_data.items()
+    }
+    context = {
+        k: _norm_value(v) for k, v in identical_data.items()
+        if k not in CONTEXT_IGNORE and _norm_value(v) is not None
+    }
+    payload = json.dumps(
+        {"c": conflicts, "x": context, "p": prompt_version, "m": model_name},
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DecisionCache:
+    """
+    Two-tier cache of validated AI merge decisions: an in-process LRU in
+    front of a persistent SQLite table (shared by all workers on the host).
+    Entries expire after ttl_s; the LRU holds at most memory_size entries and
+    the table is pruned to max_rows, least recently used first.
+
+    The LRU has its own lock and never waits on SQLite: disk reads use one
+    connection per thread, outside any lock; writes (stores, batched hit
+    counts, pruning) go through a single connection under _db_lock.
+    """
+
+    def __init__(self, path: str = AI_CACHE_PATH, memory_size: int = AI_CACHE_MEMORY_SIZE,
+                 max_rows: int = AI_CACHE_MAX_ROWS, ttl_s: float = AI_CACHE_TTL_S,
+                 enabled: bool = AI_CACHE_ENABLED):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.ttl_s = ttl_s
+        self.enabled = enabled
+        self._lock = threading.Lock()        # LRU, pending hits, metrics
+        self._db_lock = threading.Lock()     # the write connection
+        self._lru: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._local = threading.local()      # per-thread read connections
+        self._pending_hits: Dict[str, Tuple[float, int]] = {}   # key -> (last hit, hits not yet written)
+        self._stores_since_prune = 0
+        self.metrics = {
+            "hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0,
+            "evictions_memory": 0, "evictions_disk": 0, "expired": 0, "errors": 0,
+        }
+
+    # ---------- storage ----------
+    def _db(self) -> sqlite3.Connection:
+        """The write connection (creates the table); callers hold _db_lock."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ai_decision_cache ("
+                " key TEXT PRIMARY KEY, decision TEXT NOT NULL, model TEXT, prompt_version TEXT,"
+                " created_at REAL NOT NULL, last_hit_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_ai_decision_cache_last_hit ON ai_decision_cache (last_hit_at)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._db_lock:
+                self._db()   # the table exists before the first read
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, created_at: float, decision: Dict[str, Any]) -> None:
+        self._lru[key] = (created_at, decision)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.memory_size:
+            self._lru.popitem(last=False)
+            self.metrics["evictions_memory"] += 1
+
+    def _note_hit(self, key: str, now: float) -> bool:
+        """Counts a hit (caller holds _lock); True when the pending hits should be flushed."""
+        _last, n = self._pending_hits.get(key, (now, 0))
+        self._pending_hits[key] = (now, n + 1)
+        return len(self._pending_hits) >= _FLUSH_HITS_EVERY
+
+    def _take_pending_hits(self) -> list:
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        return [(last, n, key) for key, (last, n) in pending.items()]
+
+    def _write_hits(self, db: sqlite3.Connection, hits: list) -> None:
+        if hits:
+            db.executemany(
+                "UPDATE ai_decision_cache SET last_hit_at = max(last_hit_at, ?), hits = hits + ? WHERE key = ?",
+                hits,
+            )
+
+    def flush_hits(self) -> None:
+        hits = self._take_pending_hits()
+        if not hits:
+            return
+        try:
+            with self._db_lock:
+                db = self._db()
+                self._write_hits(db, hits)
+                db.commit()
+        except sqlite3.Error as e:
+            with self._lock:
+                self.metrics["errors"] += 1
+            print(f"EROARE: Cache-ul de decizii AI nu poate fi scris: {e}")
+
+    # ---------- API ----------
+    def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """(decision, tier) on a hit, tier being 'memory' or 'disk'; (None, None) on a miss."""
+        if not self.enabled:
+            return None, None
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                created_at, decision = entry
+                if now - created_at <= self.ttl_s:
+                    self._lru.move_to_end(key)
+                    self.metrics["hits_memory"] += 1
+                    flush = self._note_hit(key, now)
+                    decision = copy.deepcopy(decision)
+                    tier = "memory"
+                else:
+                    del self._lru[key]
+                    self.metrics["expired"] += 1
+                    entry = None
+        if entry is None:
+            # disk tier, outside the LRU lock; expired rows are left to _prune
+            try:
+                row = self._reader().execute(
+                    "SELECT decision, created_at FROM ai_decision_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                row = None
+                with self._lock:
+                    self.metrics["errors"] += 1
+                print(f"EROARE: Cache-ul de decizii AI nu poate fi citit: {e}")
+            with self._lock:
+                if row is not None and now - row[1] > self.ttl_s:
+                    self.metrics["expired"] += 1
+                    row = None
+                if row is None:
+                    self.metrics["misses"] += 1
+                    return None, None
+                decision = json.loads(row[0])
+                self._remember(key, row[1], decision)
+                self.metrics["hits_disk"] += 1
+                flush = self._note_hit(key, now)
+                decision = copy.deepcopy(decision)
+                tier = "disk"
+        if flush:
+            self.flush_hits()
+        return decision, tier
+
+    def put(self, key: str, decision: Dict[str, Any], model_name: str = "", prompt_version: str = "") -> None:
+        if not self.enabled or not decision:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, copy.deepcopy(decision))
+            self.metrics["stores"] += 1
+        hits = self._take_pending_hits()
+        try:
+            with self._db_lock:
+                db = self._db()
+                db.execute(
+                    "INSERT OR REPLACE INTO ai_decision_cache"
+                    " (key, decision, model, prompt_version, created_at, last_hit_at, hits)"
+                    " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                    (key, json.dumps(decision, default=str), model_name, prompt_version, now, now),
+                )
+                self._write_hits(db, hits)
+                self._stores_since_prune += 1
+                if self._stores_since_prune >= _PRUNE_EVERY:
+                    self._stores_since_prune = 0
+                    self._prune(db, now)
+                db.commit()
+        except sqlite3.Error as e:
+            with self._lock:
+                self.metrics["errors"] += 1
+            print(f"EROARE: Cache-ul de decizii AI nu poate fi scris: {e}")
+
+    def _prune(self, db: sqlite3.Connection, now: float) -> None:
+        cur = db.execute("DELETE FROM ai_decision_cache WHERE created_at < ?", (now - self.ttl_s,))
+        expired = cur.rowcount
+        cur = db.execute(
+            "DELETE FROM ai_decision_cache WHERE key IN ("
+            " SELECT key FROM ai_decision_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+        with self._lock:
+            self.metrics["expired"] += expired
+            self.metrics["evictions_disk"] += cur.rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+            self._pending_hits.clear()
+        try:
+            with self._db_lock:
+                db = self._db()
+                db.execute("DELETE FROM ai_decision_cache")
+                db.commit()
+        except sqlite3.Error as e:
+            with self._lock:
+                self.metrics["errors"] += 1
+            print(f"EROARE: Cache-ul de decizii AI nu poate fi golit: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            m = dict(self.metrics)
+            m["memory_entries"] = len(self._lru)
+            m["pending_hits"] = sum(n for _last, n in self._pending_hits.values())
+        try:
+            m["disk_entries"] = self._reader().execute("SELECT COUNT(*) FROM ai_decision_cache").fetchone()[0]
+        except sqlite3.Error:
+            m["disk_entries"] = None
+        lookups = m["hits_memory"] + m["hits_disk"] + m["misses"]
+        m["hit_ratio"] = round((m["hits_memory"] + m["hits_disk"]) / lookups, 4) if lookups else 0.0
+        m["enabled"] = self.enabled
+        return m
+
+
+decision_cache = DecisionCache()
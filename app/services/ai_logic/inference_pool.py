@@ -0,0 +1,257 @@
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional
+
+
+class InferenceError(RuntimeError):
+    """Base for pool-level failures; status_code is the HTTP status the API answers with."""
+    status_code = 503
+
+
+class InferenceUnavailable(InferenceError):
+    """The pool is not running (not started, shutting down, or no live worker)."""
+    status_code = 503
+
+
+class InferenceQueueFull(InferenceError):
+    """Backpressure: every worker is busy and the request queue is full."""
+    status_code = 429
+
+
+class InferenceTimeout(InferenceError):
+    """No worker answered within the request timeout."""
+    status_code = 504
+
+
+def _worker_main(worker_id: int, provider_kind: str, requests, results) -> None:
+    """Worker process: loads its own model instance, then serves requests until it gets None."""
+    try:
+        from .ai_core import _create_model
+        model = _create_model(provider_kind)
+    except BaseException as e:  # noqa: BLE001 - reported to the parent, which decides
+        results.put(("failed", worker_id, repr(e)))
+        return
+    results.put(("ready", worker_id, None))
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        req_id, prompt, kwargs = item
+        picked_at = time.time()
+        try:
+            out = model(prompt, **kwargs)
+            results.put(("done", req_id, (True, out, picked_at, time.time())))
+        except Exception as e:
+            results.put(("done", req_id, (False, repr(e), picked_at, time.time())))
+
+
+class InferencePool:
+    """
+    N worker processes, each holding its own model instance: llama.cpp is not
+    safe for concurrent use, and a generation would otherwise tie up an API
+    thread for seconds.
+
+    Requests go through one bounded queue: at most workers + queue_size are
+    admitted, the rest are rejected right away with InferenceQueueFull (429)
+    instead of piling up. A caller waits at most timeout_s; a request that
+    times out keeps its admission slot until its worker finishes, so the
+    bound stays honest. Dead workers are restarted by the collector thread.
+
+    The pool is callable like a Llama instance: pool(prompt, **kwargs).
+    """
+
+    def __init__(self, provider_kind: str, workers: int, queue_size: int, timeout_s: float,
+                 start_method: str = "spawn"):
+        self.provider_kind = provider_kind
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.timeout_s = timeout_s
+        self._ctx = mp.get_context(start_method)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, tuple] = {}         # req_id -> (future, enqueued_at)
+        self._procs: List[Optional[mp.process.BaseProcess]] = []
+        self._ready: set = set()
+        self._failures: Dict[int, str] = {}
+        self._running = False
+        self._requests = None
+        self._results = None
+        self._collector: Optional[threading.Thread] = None
+        self._wait_ms: deque = deque(maxlen=1000)
+        self._service_ms: deque = deque(maxlen=1000)
+        self.metrics = {"submitted": 0, "completed": 0, "errors": 0, "rejected": 0,
+                        "timeouts": 0, "worker_restarts": 0}
+
+    # ---------- lifecycle ----------
+    def start(self, wait_ready_s: Optional[float] = None) -> "InferencePool":
+        """Spawn the workers; with wait_ready_s, block until one has loaded its model (or all failed)."""
+        with self._lock:
+            if self._running:
+                return self
+            self._requests = self._ctx.Queue()
+            self._results = self._ctx.Queue()
+            self._procs = [self._spawn(i) for i in range(self.workers)]
+            self._running = True
+            self._collector = threading.Thread(target=self._collect, name="ai-pool-collector", daemon=True)
+            self._collector.start()
+        if wait_ready_s:
+            deadline = time.time() + wait_ready_s
+            while time.time() < deadline:
+                with self._lock:
+                    if self._ready or len(self._failures) >= self.workers:
+                        break
+                time.sleep(0.05)
+            if not self._ready:
+                errors = "; ".join(sorted(set(self._failures.values()))) or "timed out loading the model"
+                self.shutdown()
+                raise InferenceUnavailable(f"No inference worker became ready: {errors}")
+        return self
+
+    def _spawn(self, worker_id: int):
+        p = self._ctx.Process(
+            target=_worker_main, args=(worker_id, self.provider_kind, self._requests, self._results),
+            name=f"ai-inference-{worker_id}", daemon=True,
+        )
+        p.start()
+        return p
+
+    def shutdown(self, timeout_s: float = 5.0) -> None:
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            procs = list(self._procs)
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for _ in procs:
+            self._requests.put(None)
+        for p in procs:
+            p.join(timeout_s)
+            if p.is_alive():
+                p.terminate()
+        for fut, _ in pending:
+            if not fut.done():
+                fut.set_exception(InferenceUnavailable("Inference pool shut down."))
+        self._ready.clear()
+
+    # ---------- results ----------
+    def _collect(self) -> None:
+        last_check = time.time()
+        while self._running:
+            try:
+                kind, ident, payload = self._results.get(timeout=0.5)
+            except queue.Empty:
+                kind = None
+            except (EOFError, OSError):
+                return
+            if kind == "ready":
+                with self._lock:
+                    self._ready.add(ident)
+                    self._failures.pop(ident, None)
+            elif kind == "failed":
+                with self._lock:
+                    self._failures[ident] = payload
+                print(f"EROARE: Worker-ul de inferenta {ident} nu a putut incarca modelul: {payload}")
+            elif kind == "done":
+                self._resolve(ident, payload)
+            if time.time() - last_check >= 1.0:
+                last_check = time.time()
+                self._restart_dead()
+
+    def _resolve(self, req_id: int, payload: tuple) -> None:
+        ok, out, picked_at, finished_at = payload
+        with self._lock:
+            entry = self._pending.pop(req_id, None)
+            if entry is None:
+                return
+            fut, enqueued_at = entry
+            self._wait_ms.append((picked_at - enqueued_at) * 1000)
+            self._service_ms.append((finished_at - picked_at) * 1000)
+            self.metrics["completed" if ok else "errors"] += 1
+        if fut.done():          # caller already timed out
+            return
+        if ok:
+            if isinstance(out, dict):
+                timings = out.setdefault("timings", {})
+                timings["queue_wait_ms"] = (picked_at - enqueued_at) * 1000
+            fut.set_result(out)
+        else:
+            fut.set_exception(RuntimeError(f"Inference failed in worker: {out}"))
+
+    def _restart_dead(self) -> None:
+        with self._lock:
+            if not self._running:
+                return
+            # requests lost with a crashed worker would otherwise hold their admission slot forever
+            stale = time.time() - 2 * self.timeout_s
+            for req_id in [r for r, (fut, t) in self._pending.items() if fut.done() and t < stale]:
+                del self._pending[req_id]
+            for i, p in enumerate(self._procs):
+                if p.is_alive() or i in self._failures:
+                    continue
+                # a crashed worker may have taken a request with it; that caller times out
+                print(f"INFO: Worker-ul de inferenta {i} (pid {p.pid}) s-a oprit; se reporneste.")
+                self._ready.discard(i)
+                self._procs[i] = self._spawn(i)
+                self.metrics["worker_restarts"] += 1
+
+    # ---------- API ----------
+    def submit(self, prompt: str, **kwargs) -> Future:
+        with self._lock:
+            if not self._running or not self._ready:
+                raise InferenceUnavailable("Inference pool is not ready.")
+            if len(self._pending) >= self.workers + self.queue_size:
+                self.metrics["rejected"] += 1
+                raise InferenceQueueFull(
+                    f"Inference queue is full ({len(self._pending)} requests in flight).")
+            req_id = next(self._ids)
+            fut: Future = Future()
+            self._pending[req_id] = (fut, time.time())
+            self.metrics["submitted"] += 1
+        self._requests.put((req_id, prompt, kwargs))
+        return fut
+
+    def __call__(self, prompt: str, timeout_s: Optional[float] = None, **kwargs) -> Dict[str, Any]:
+        fut = self.submit(prompt, **kwargs)
+        try:
+            return fut.result(timeout=timeout_s or self.timeout_s)
+        except FutureTimeout:
+            with self._lock:
+                self.metrics["timeouts"] += 1
+            fut.cancel()
+            raise InferenceTimeout(f"No inference result within {timeout_s or self.timeout_s:g}s.")
+
+    @property
+    def ready(self) -> bool:
+        return self._running and bool(self._ready)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._pending)
+            m = dict(self.metrics)
+            wait = sorted(self._wait_ms)
+            service = sorted(self._service_ms)
+            alive = sum(1 for p in self._procs if p.is_alive())
+            m.update(
+                provider=self.provider_kind, running=self._running,
+                workers=self.workers, workers_alive=alive, workers_ready=len(self._ready),
+                capacity=self.workers + self.queue_size, in_flight=in_flight,
+                # requests admitted but not yet picked up by a worker (approximate)
+                queue_depth=max(0, in_flight - len(self._ready)),
+                worker_errors=dict(self._failures),
+            )
+        m["queue_wait_ms"] = _percentiles(wait)
+        m["service_ms"] = _percentiles(service)
+        return m
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 2)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 2)}
@@ -1,9 +1,45 @@
 import json
 import time
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional
 from .data_processing import normalize_record, prepare_data_for_llm
-from .ai_core import run_llm_inference, parse_and_correct_response
-from .prompts import prompt_template
+from .ai_core import (
+    run_llm_inference, parse_and_correct_response, current_model_name, provider_concurrency_limit,
+    decision_schema_for
+)
+from .decision_cache import cache_key, decision_cache
+from .prompts import build_analysis_prompt, PROMPT_VERSION
+from .breaker import LLMUnavailable
+from .rules import pre_resolve_conflicts, survivorship_decision
+from .telemetry import collect, summarize, telemetry
+
+
+# on_event(name, data): notificari pe parcursul fuziunii (ex. pentru SSE). Poate fi apelat din
+# thread-urile de lucru ale arborelui, deci trebuie sa fie thread-safe.
+EventCallback = Callable[[str, Dict[str, Any]], None]
+
+
+# Un singur pool pentru perechile din arborii de fuziune, comun tuturor cererilor (si loturilor
+# care ruleaza deja pe thread-uri proprii): mai multe thread-uri decat sloturi de provider ar astepta degeaba.
+_merge_pool = ThreadPoolExecutor(max_workers=provider_concurrency_limit(), thread_name_prefix="ai-merge")
+
+
+def _emit(on_event: Optional[EventCallback], name: str, **data) -> None:
+    if on_event is None:
+        return
+    try:
+        on_event(name, data)
+    except Exception as e:  # un client deconectat nu trebuie sa opreasca fuziunea
+        print(f"EROARE: Callback-ul de evenimente a esuat ({name}): {e}")
+
+
+def _emit_resolutions(on_event: Optional[EventCallback], resolved: Dict[str, Any],
+                      conflicts: Dict[str, Any], source: str) -> None:
+    for field, res in resolved.items():
+        values = conflicts.get(field, {})
+        _emit(on_event, "field_resolved", field_name=field,
+              value_A=values.get("value_A"), value_B=values.get("value_B"),
+              chosen_value=res.get("chosen_value"), justification=res.get("justification"), source=source)
 
 
 def build_golden_record(identical_data: Dict[str, Any], validated_decision: Dict[str, Any]) -> Dict[str, Any]:
@@ -16,12 +52,27 @@ def build_golden_record(identical_data: Dict[str, Any], validated_decision: Dict
     return golden_record
 
 
-def run_single_merge_iteration(record_a: Dict[str, Any], record_b: Dict[str, Any]) -> (Dict[str, Any], Dict[str, Any],
-                                                                                       List[str]):
+def run_single_merge_iteration(record_a: Dict[str, Any], record_b: Dict[str, Any],
+                               stats: Optional[Dict[str, Any]] = None,
+                               on_event: Optional[EventCallback] = None) -> (Dict[str, Any], Dict[str, Any], List[str]):
     """
     Ruleaza o singura iteratie de fuziune si returneaza rezultatul detaliat:
     (golden_record, decizie_validata, log-uri).
+    stats (optional) primeste numarul de apeluri LLM facute ("llm_calls") si
+    telemetria lor ("calls", "cache_hits", "cache_misses");
+    on_event (optional) primeste field_resolved / cache_hit pe masura ce apar.
     """
+    with collect() as sink:
+        result = _merge_two_records(record_a, record_b, stats, on_event)
+    if stats is not None:
+        stats.setdefault("calls", []).extend(sink["calls"])
+        stats["cache_hits"] = stats.get("cache_hits", 0) + sink["cache_hits"]
+        stats["cache_misses"] = stats.get("cache_misses", 0) + sink["cache_misses"]
+    return result
+
+
+def _merge_two_records(record_a: Dict[str, Any], record_b: Dict[str, Any],
+                       stats: Optional[Dict[str, Any]], on_event: Optional[EventCallback]):
     log_messages = []
     log_messages.append("Initiating AI merge analysis for a pair of records...")
 
@@ -38,21 +89,66 @@ def run_single_merge_iteration(record_a: Dict[str, Any], record_b: Dict[str, Any
 
     log_messages.append(f"INFO: Conflicts detected: {list(conflicting_data.keys())}")
 
-    analysis_prompt = prompt_template.format(
-        conflicting_data_str=json.dumps(conflicting_data, indent=2),
-        identical_data_str=json.dumps(identical_data, indent=2)
-    )
+    # Formatting-only conflicts (blank vs. filled, case, phone/DOB format,
+    # gender spelling, street abbreviations) are settled by rules; the LLM
+    # only sees what is left.
+    all_conflicts = conflicting_data
+    rule_resolved, conflicting_data = pre_resolve_conflicts(conflicting_data)
+    if rule_resolved:
+        log_messages.append(f"INFO: Resolved by rules: {list(rule_resolved.keys())}")
+        _emit_resolutions(on_event, rule_resolved, all_conflicts, "rule")
+        identical_data = {**identical_data, **{f: r["chosen_value"] for f, r in rule_resolved.items()}}
+
+    if not conflicting_data:
+        log_messages.append("INFO: All conflicts resolved by rules; LLM call skipped.")
+        validated_decision = {"resolved_conflicts": {}}
+    else:
+        # Same conflict set + context + prompt + model => reuse the earlier validated decision
+        model_name = current_model_name()
+        key = cache_key(conflicting_data, identical_data, PROMPT_VERSION, model_name)
+        validated_decision, tier = decision_cache.get(key)
+        telemetry.record_cache(validated_decision is not None, tier)
 
-    start_time = time.time()
-    initial_output = run_llm_inference(analysis_prompt)
-    inference_time = time.time() - start_time
-    log_messages.append(f"INFO: AI analysis completed in {inference_time:.2f} seconds.")
+        if validated_decision is not None:
+            log_messages.append(f"INFO: AI decision served from cache ({tier}).")
+            _emit(on_event, "cache_hit", tier=tier, fields=list(conflicting_data.keys()))
+            source = "cache"
+        else:
+            source = "llm"
+            analysis_prompt, prompt_info = build_analysis_prompt(conflicting_data, identical_data)
+            log_messages.append(
+                f"INFO: Prompt ~{prompt_info['tokens_verbose']} tokens verbose -> ~{prompt_info['tokens']} sent"
+                f"{' (compact)' if prompt_info['compact'] else ''}.")
+            if prompt_info["over_budget"]:
+                log_messages.append("WARNING: Prompt exceeds the token budget even after trimming.")
 
-    validated_decision = parse_and_correct_response(initial_output, conflicting_data)
+            schema = decision_schema_for(conflicting_data)
+            start_time = time.time()
+            try:
+                initial_output = run_llm_inference(analysis_prompt, json_schema=schema)
+                if stats is not None:
+                    stats["llm_calls"] = stats.get("llm_calls", 0) + 1
+                validated_decision = parse_and_correct_response(initial_output, conflicting_data, schema)
+            except LLMUnavailable as e:
+                # provider lent / cazut / circuit deschis: supravietuire determinista, marcata pentru revizuire
+                log_messages.append(f"WARNING: AI unavailable ({e}); deterministic survivorship used.")
+                if stats is not None:
+                    stats["fallbacks"] = stats.get("fallbacks", 0) + 1
+                validated_decision = survivorship_decision(conflicting_data, "AI unavailable")
+                source = "fallback"
+            else:
+                inference_time = time.time() - start_time
+                log_messages.append(f"INFO: AI analysis completed in {inference_time:.2f} seconds.")
 
-    if not validated_decision:
-        log_messages.append("ERROR: AI process failed to produce a valid decision.")
-        return None, None, log_messages
+                if not validated_decision:
+                    log_messages.append("ERROR: AI process failed to produce a valid decision.")
+                    return None, None, log_messages
+                decision_cache.put(key, validated_decision, model_name=model_name, prompt_version=PROMPT_VERSION)
+        _emit_resolutions(on_event, validated_decision.get("resolved_conflicts", {}), all_conflicts, source)
+
+    if rule_resolved:
+        validated_decision = dict(validated_decision)
+        validated_decision["resolved_conflicts"] = {**rule_resolved, **validated_decision.get("resolved_conflicts", {})}
 
     final_golden_record = build_golden_record(identical_data, validated_decision)
     # Prefill unresolved fields with anchor values to avoid blanks in UI, while keeping HUMAN_REVIEW
@@ -71,10 +167,13 @@ def run_single_merge_iteration(record_a: Dict[str, Any], record_b: Dict[str, Any
     return final_golden_record, validated_decision, log_messages
 
 
-def get_ai_merge_suggestion(list_of_records: List[dict]) -> dict:
+def get_ai_merge_suggestion(list_of_records: List[dict], on_event: Optional[EventCallback] = None) -> dict:
     """
-    Functia principala apelata de serviciu. Fuzioneaza iterativ o lista de inregistrari
-    si returneaza o sugestie de Golden Record impreuna cu detalii pentru revizuire.
+    Functia principala apelata de serviciu. Fuzioneaza o lista de inregistrari intr-un
+    arbore echilibrat (perechile de pe acelasi nivel ruleaza concurent) si returneaza
+    o sugestie de Golden Record impreuna cu detalii pentru revizuire.
+    on_event (optional) primeste evenimentele fuziunii pe masura ce apar:
+    level_start, iteration_start, field_resolved, cache_hit, iteration_done.
     """
     if not list_of_records:
         return {
@@ -96,8 +195,7 @@ def get_ai_merge_suggestion(list_of_records: List[dict]) -> dict:
             "processing_log": ["INFO: Only one record provided, no merge needed."]
         }
 
-    golden_record = list_of_records[0]
-    full_log = [f"Starting iterative merge for {len(list_of_records)} records."]
+    full_log = [f"Starting tree merge for {len(list_of_records)} records."]
     # Accumulate per-field AI resolutions across iterations
     decisions_map: Dict[str, Dict[str, Any]] = {}
     # Pre-compute unique original values per field for reporting
@@ -109,43 +207,94 @@ def get_ai_merge_suggestion(list_of_records: List[dict]) -> dict:
             if v is not None and v not in unique_values[k]:
                 unique_values[k].append(v)
 
-    for i, next_record in enumerate(list_of_records[1:], start=1):
-        full_log.append(f"--- Iteration #{i}: Merging current Golden Record with Record #{i} ---")
-
-        updated_gr, decision, log = run_single_merge_iteration(golden_record, next_record)
-        full_log.extend(log)
-
-        if updated_gr is None:
-            # Daca o iteratie esueaza, ne oprim si returnam o eroare clara
-            return {
-                "suggested_golden_record": golden_record,
-                "human_review_required": True,
-                "conflicts_resolved": [{
-                    "field_name": "merge_process",
-                    "value_A": "current_golden_record",
-                    "value_B": f"record_{i}",
-                    "chosen_value": "PROCESS_HALTED",
-                    "justification": "A critical error occurred during the AI merge process."
-                }],
-                "processing_log": full_log
-            }
-        golden_record = updated_gr
-        # accumulate per-field decisions
-        try:
-            if decision and isinstance(decision.get("resolved_conflicts"), dict):
-                for field, res in decision["resolved_conflicts"].items():
-                    if field in {"record_id", "original_record_id", "cluster_id", "merged_into"}:
-                        continue
-                    decisions_map[field] = {
-                        "chosen_value": res.get("chosen_value"),
-                        "justification": res.get("justification") or "Resolved by AI",
-                    }
-        except Exception:
-            pass
+    # Balanced tree instead of a left-to-right fold: (0,1), (2,3), ... are
+    # merged concurrently, then their results, and so on. N records need
+    # ceil(log2 N) sequential rounds instead of N-1. The left operand stays
+    # the anchor, so record 0 keeps its record_id as before.
+    level_groups = [(rec, [i]) for i, rec in enumerate(list_of_records)]
+    level = 0
+    stats_total = {"llm_calls": 0, "merges": 0, "fallbacks": 0, "cache_hits": 0, "cache_misses": 0}
+    calls: List[Dict[str, Any]] = []
+    while len(level_groups) > 1:
+        level += 1
+        pairs = [(level_groups[j], level_groups[j + 1]) for j in range(0, len(level_groups) - 1, 2)]
+        carry = level_groups[-1] if len(level_groups) % 2 else None
+        full_log.append(f"--- Level #{level}: {len(pairs)} concurrent pair merge(s) ---")
+        _emit(on_event, "level_start", level=level, pairs=len(pairs))
+
+        def _merge_pair(pair, st, level=level):
+            (left, left_ids), (right, right_ids) = pair
+            pair_event = None
+            if on_event is not None:
+                pair_event = lambda name, data: on_event(
+                    name, {"level": level, "left_ids": left_ids, "right_ids": right_ids, **data})
+            _emit(pair_event, "iteration_start")
+            result = run_single_merge_iteration(left, right, st, pair_event)
+            _emit(pair_event, "iteration_done", ok=result[0] is not None, llm_calls=st.get("llm_calls", 0),
+                  fallback=bool(st.get("fallbacks")))
+            return result
+
+        pair_stats = [{} for _ in pairs]
+        if len(pairs) == 1:
+            results = [_merge_pair(pairs[0], pair_stats[0])]
+        else:
+            results = list(_merge_pool.map(_merge_pair, pairs, pair_stats))
+
+        next_groups = []
+        for ((left, left_ids), (right, right_ids)), (updated_gr, decision, log), st in zip(pairs, results, pair_stats):
+            full_log.append(f"Merging records {left_ids} with records {right_ids}")
+            full_log.extend(log)
+            stats_total["merges"] += 1
+            stats_total["llm_calls"] += st.get("llm_calls", 0)
+            stats_total["fallbacks"] += st.get("fallbacks", 0)
+            stats_total["cache_hits"] += st.get("cache_hits", 0)
+            stats_total["cache_misses"] += st.get("cache_misses", 0)
+            calls.extend(st.get("calls", []))
+
+            if updated_gr is None:
+                # Daca o fuziune esueaza, ne oprim si returnam o eroare clara
+                return {
+                    "suggested_golden_record": list_of_records[0],
+                    "human_review_required": True,
+                    "conflicts_resolved": [{
+                        "field_name": "merge_process",
+                        "value_A": f"records_{left_ids}",
+                        "value_B": f"records_{right_ids}",
+                        "chosen_value": "PROCESS_HALTED",
+                        "justification": "A critical error occurred during the AI merge process."
+                    }],
+                    "processing_log": full_log
+                }
+            # accumulate per-field decisions (later levels override earlier ones)
+            try:
+                if decision and isinstance(decision.get("resolved_conflicts"), dict):
+                    for field, res in decision["resolved_conflicts"].items():
+                        if field in {"record_id", "original_record_id", "cluster_id", "merged_into"}:
+                            continue
+                        decisions_map[field] = {
+                            "chosen_value": res.get("chosen_value"),
+                            "justification": res.get("justification") or "Resolved by AI",
+                        }
+            except Exception:
+                pass
+            next_groups.append((updated_gr, left_ids + right_ids))
+        if carry is not None:
+            next_groups.append(carry)
+        level_groups = next_groups
+
+    golden_record = level_groups[0][0]
+    full_log.append(
+        f"INFO: Tree merge used {stats_total['llm_calls']} LLM call(s) for {stats_total['merges']} pair merge(s) "
+        f"over {level} level(s) (a sequential fold needs {len(list_of_records) - 1} rounds)."
+    )
+    print(f"INFO: AI merge of {len(list_of_records)} records: {stats_total['llm_calls']} LLM calls, {level} levels.")
 
     # Build detailed field-level resolutions from accumulated AI decisions
     final_conflicts_details = []
-    human_review_required = False
+    # a deterministic fallback stands in for the AI, so a human has to confirm it
+    human_review_required = stats_total["fallbacks"] > 0
+    if stats_total["fallbacks"]:
+        full_log.append(f"WARNING: {stats_total['fallbacks']} pair merge(s) used the deterministic fallback.")
     for field, res in decisions_map.items():
         vals = unique_values.get(field, [])
         value_a = vals[0] if len(vals) > 0 else None
@@ -162,7 +311,7 @@ def get_ai_merge_suggestion(list_of_records: List[dict]) -> dict:
             "justification": justif,
         })
 
-    full_log.append("--- Iterative merge process completed. ---")
+    full_log.append("--- Tree merge process completed. ---")
 
     # Final safety: ensure record_id is present and string
     if not isinstance(golden_record.get("record_id", ""), str):
@@ -173,5 +322,6 @@ def get_ai_merge_suggestion(list_of_records: List[dict]) -> dict:
         "suggested_golden_record": golden_record,
         "human_review_required": human_review_required,
         "conflicts_resolved": final_conflicts_details,
-        "processing_log": full_log
+        "processing_log": full_log,
+        "telemetry": summarize(calls, stats_total["cache_hits"], stats_total["cache_misses"]),
     }
@@ -1,3 +1,12 @@
+import hashlib
+import json
+import re
+import threading
+from typing import Any, Dict, Tuple
+
+from .config import AI_COMPACT_PROMPT, AI_PROMPT_TOKEN_BUDGET
+from .data_processing import compact_context
+
 prompt_template = """<|system|>
 You are a hyper-focused Data Steward AI. Your sole purpose is to resolve the specific data conflicts presented to you, using the shared context as clues.
 
@@ -39,6 +48,34 @@ For each conflicting field, provide a chosen value or flag it for human review.
 <|assistant|>
 """
 
+# Varianta compacta: tot ce e static (reguli + structura raspunsului) sta intr-un prefix
+# fix, iar datele variabile vin la final, ca llama.cpp sa refoloseasca prefixul din
+# cache-ul KV (iar OpenAI din prompt caching). Datele sunt JSON minificat.
+compact_prompt_prefix = """<|system|>
+You are a hyper-focused Data Steward AI. Resolve only the data conflicts given, using the shared context as clues.
+Rules:
+1. Strict Focus: only resolve fields listed under ### CONFLICTING DATA ###.
+2. Contextual Clues: use ### SHARED CONTEXT ### (identical values) to support decisions; "also_identical" lists further identifiers that are identical in both records.
+3. Typo & OCR Robustness: prefer obvious typo/keyboard/OCR corrections over HUMAN_REVIEW when other strong signals agree. Examples: missing vowels ("Bnnnie" -> "Bonnie"), letter proximity ("Brvwn" -> "Brown"), transposed letters ("Rihcard" -> "Richard"), duplicated/missed letters ("Jonh" -> "John"), digit noise in phones, minor punctuation/case differences in addresses. If SSN, email, DOB and phone align, resolve likely typos without HUMAN_REVIEW.
+4. Name vs. Email Alignment: prefer the name variant matching the email username tokens (ian.stanley@... implies first_name="Ian", last_name="Stanley"). Correct swapped names when other high-confidence fields match.
+5. Email Rule: only correct obvious domain typos. If usernames differ substantively, flag for HUMAN_REVIEW (unless one exactly matches the full name tokens and the other is clearly noise).
+6. Phone Rule: compare digits only; equal digits mean identical.
+7. Uncertainty Protocol: if several options remain genuinely plausible, return 'NEEDS_HUMAN_REVIEW'.
+8. Output Purity: output one valid JSON object, no extra keys:
+{"human_review_required": boolean, "resolved_conflicts": {"<field>": {"chosen_value": "<value or NEEDS_HUMAN_REVIEW>", "justification": "<why>"}}}
+9. Justification Specificity: cite specific clues (e.g. "email username matches 'ian.stanley'", "DOB+SSN identical; 'Brvwn' is a vowel-drop typo of 'Brown'").
+<|end|>
+<|user|>
+"""
+
+compact_prompt_template = compact_prompt_prefix.replace("{", "{{").replace("}", "}}") + """### CONFLICTING DATA ###
+{conflicting_data_str}
+### SHARED CONTEXT ###
+{identical_data_str}
+<|end|>
+<|assistant|>
+"""
+
 # Prompt-ul secundar pentru auto-corectarea JSON-ului
 json_fixer_prompt_template = """<|system|>
 You are a JSON correction utility. Your task is to fix the provided broken JSON text so that it becomes syntactically valid. Do not add, remove, or change any of the data values if possible; only fix the structure (e.g., missing commas, incorrect quotes, invalid keys). Output ONLY the corrected, valid JSON object and nothing else.<|end|>
@@ -54,3 +91,114 @@ Correct the JSON text based on the error message.
 <|end|>
 <|assistant|>
 """
+
+def decision_json_schema(fields) -> dict:
+    """
+    Schema JSON a raspunsului asteptat pentru campurile in conflict date:
+    exact aceste chei in resolved_conflicts, fiecare cu chosen_value si justification.
+    Compatibila cu structured outputs 'strict' (toate cheile obligatorii, fara chei extra).
+    """
+    resolution = {
+        "type": "object",
+        "properties": {"chosen_value": {"type": "string"}, "justification": {"type": "string"}},
+        "required": ["chosen_value", "justification"],
+        "additionalProperties": False,
+    }
+    fields = sorted(fields)
+    return {
+        "type": "object",
+        "properties": {
+            "human_review_required": {"type": "boolean"},
+            "resolved_conflicts": {
+                "type": "object",
+                "properties": {f: resolution for f in fields},
+                "required": fields,
+                "additionalProperties": False,
+            },
+        },
+        "required": ["human_review_required", "resolved_conflicts"],
+        "additionalProperties": False,
+    }
+
+
+_active_template = compact_prompt_template if AI_COMPACT_PROMPT else prompt_template
+
+# Versiunea prompt-ului principal; se schimba automat la orice editare a template-ului
+# (sau la comutarea modului compact), deci deciziile din cache produse cu un prompt
+# vechi nu mai sunt refolosite.
+PROMPT_VERSION = hashlib.sha1(_active_template.encode("utf-8")).hexdigest()[:12]
+
+_TOKEN_RE = re.compile(r"[A-Za-z]{1,4}|\d{1,3}|[^\sA-Za-z\d]")
+# Valorile mai lungi de atat sunt trunchiate doar cand prompt-ul depaseste bugetul.
+_MAX_VALUE_CHARS = 120
+
+_prompt_stats = {"prompts": 0, "tokens_verbose": 0, "tokens_sent": 0, "over_budget": 0}
+_prompt_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimare a numarului de tokeni BPE (fara tokenizer-ul modelului, care traieste
+    in procesele de inferenta): bucati de <=4 litere, <=3 cifre, fiecare semn separat.
+    """
+    return len(_TOKEN_RE.findall(text))
+
+
+def _minified(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _truncated(conflicting_data: Dict[str, Any]) -> Dict[str, Any]:
+    cut = lambda v: v[:_MAX_VALUE_CHARS] + "..." if isinstance(v, str) and len(v) > _MAX_VALUE_CHARS else v
+    return {f: {k: cut(v) for k, v in vals.items()} for f, vals in conflicting_data.items()}
+
+
+def build_analysis_prompt(conflicting_data: Dict[str, Any],
+                          identical_data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Prompt-ul de analiza si informatii despre el: tokens_verbose (prompt-ul clasic,
+    indentat, cu tot contextul), tokens (cel trimis), compact, over_budget.
+    In modul compact, peste AI_PROMPT_TOKEN_BUDGET se renunta pe rand la lista
+    also_identical, la context si apoi se trunchiaza valorile lungi.
+    """
+    verbose = prompt_template.format(
+        conflicting_data_str=json.dumps(conflicting_data, indent=2),
+        identical_data_str=json.dumps(identical_data, indent=2),
+    )
+    tokens_verbose = estimate_tokens(verbose)
+    prompt = verbose
+    if AI_COMPACT_PROMPT:
+        attempts = (
+            (conflicting_data, compact_context(conflicting_data, identical_data)),
+            (conflicting_data, compact_context(conflicting_data, identical_data, with_agreement=False)),
+            (conflicting_data, {}),
+            (_truncated(conflicting_data), {}),
+        )
+        for conflicts, context in attempts:
+            prompt = compact_prompt_template.format(conflicting_data_str=_minified(conflicts),
+                                                    identical_data_str=_minified(context))
+            if estimate_tokens(prompt) <= AI_PROMPT_TOKEN_BUDGET:
+                break
+    tokens = estimate_tokens(prompt)
+    over_budget = AI_COMPACT_PROMPT and tokens > AI_PROMPT_TOKEN_BUDGET
+    with _prompt_stats_lock:
+        _prompt_stats["prompts"] += 1
+        _prompt_stats["tokens_verbose"] += tokens_verbose
+        _prompt_stats["tokens_sent"] += tokens
+        _prompt_stats["over_budget"] += int(over_budget)
+    return prompt, {"tokens_verbose": tokens_verbose, "tokens": tokens,
+                    "compact": AI_COMPACT_PROMPT, "over_budget": over_budget}
+
+
+def prompt_stats() -> Dict[str, Any]:
+    with _prompt_stats_lock:
+        s = dict(_prompt_stats)
+    n = s["prompts"]
+    s.update(
+        compact=AI_COMPACT_PROMPT, token_budget=AI_PROMPT_TOKEN_BUDGET,
+        prefix_tokens=estimate_tokens(compact_prompt_prefix),
+        avg_tokens_verbose=round(s["tokens_verbose"] / n, 1) if n else None,
+        avg_tokens_sent=round(s["tokens_sent"] / n, 1) if n else None,
+        saved_fraction=round(1 - s["tokens_sent"] / s["tokens_verbose"], 3) if s["tokens_verbose"] else None,
+    )
+    return s
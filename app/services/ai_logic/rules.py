@@ -0,0 +1,170 @@
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, Optional, Tuple
+
+from ..patient_keys import dob_iso, phone_digits
+
+# Street suffix / unit abbreviations (the variants data_gen/introduce_errors.py injects,
+# plus the common unit designators). Both forms map to the full word.
+STREET_SUFFIXES = {
+    "st": "street", "ave": "avenue", "dr": "drive", "ln": "lane", "rd": "road",
+    "blvd": "boulevard", "ct": "court", "pl": "place", "ter": "terrace",
+    "apt": "apartment", "ste": "suite",
+}
+
+_GENDER = {
+    "m": "M", "male": "M", "masculin": "M", "masc": "M",
+    "f": "F", "female": "F", "feminin": "F", "fem": "F",
+    "o": "O", "other": "O", "non-binary": "O", "nonbinary": "O", "nb": "O",
+}
+
+_lock = threading.Lock()
+_stats = {
+    "pair_merges": 0,          # pair merges that had at least one conflict
+    "llm_calls_avoided": 0,    # ... of which every conflict was settled by rules
+    "fields_resolved": 0,
+    "fields_sent_to_llm": 0,
+}
+
+
+def _blank(v: Any) -> bool:
+    return v is None or (isinstance(v, str) and not v.strip())
+
+
+def _squash(v: Any) -> str:
+    return " ".join(str(v).split())
+
+
+def _fold(v: Any) -> str:
+    return _squash(v).casefold()
+
+
+def _address_key(v: Any) -> str:
+    tokens = re.sub(r"[.,#]", " ", _fold(v)).split()
+    return " ".join(STREET_SUFFIXES.get(t, t) for t in tokens)
+
+
+def _mixed_case(s: str) -> bool:
+    return s != s.upper() and s != s.lower()
+
+
+def _prefer_formatted(a: str, b: str) -> str:
+    """Of two spellings that differ only in case/whitespace, keep the mixed-case one (else A)."""
+    a, b = _squash(a), _squash(b)
+    if not _mixed_case(a) and _mixed_case(b):
+        return b
+    return a
+
+
+def resolve_conflict(field: str, val_a: Any, val_b: Any) -> Optional[Dict[str, str]]:
+    """A {chosen_value, justification} when a deterministic rule settles the conflict, else None."""
+    if _blank(val_a) and not _blank(val_b):
+        return {"chosen_value": val_b, "justification": "RULE: value A is blank; kept the filled value B."}
+    if _blank(val_b) and not _blank(val_a):
+        return {"chosen_value": val_a, "justification": "RULE: value B is blank; kept the filled value A."}
+    if _blank(val_a) and _blank(val_b):
+        return {"chosen_value": val_a, "justification": "RULE: both values are blank."}
+
+    if field == "phone_number":
+        da, db = phone_digits(val_a), phone_digits(val_b)
+        if len(da) == 11 and da.startswith("1"):
+            da = da[1:]
+        if len(db) == 11 and db.startswith("1"):
+            db = db[1:]
+        if da and da == db:
+            return {"chosen_value": da, "justification": "RULE: non-digits removed; digits equal."}
+        return None
+
+    if field == "date_of_birth":
+        ia, ib = dob_iso(val_a), dob_iso(val_b)
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", ia) and ia == ib:
+            return {"chosen_value": ia, "justification": "RULE: same date in different formats; kept ISO form."}
+        return None
+
+    if field == "gender":
+        ga, gb = _GENDER.get(_fold(val_a)), _GENDER.get(_fold(val_b))
+        if ga and ga == gb:
+            return {"chosen_value": ga, "justification": f"RULE: both values mean '{ga}'."}
+        return None
+
+    if field == "email":
+        if _fold(val_a) == _fold(val_b):
+            return {"chosen_value": _fold(val_a), "justification": "RULE: emails differ only in case/whitespace."}
+        return None
+
+    if _fold(val_a) == _fold(val_b):
+        return {"chosen_value": _prefer_formatted(val_a, val_b),
+                "justification": "RULE: values differ only in case/whitespace."}
+
+    if field == "address" and _address_key(val_a) == _address_key(val_b):
+        # keep the properly cased, spelled-out form (the one most source records use)
+        a, b = _squash(val_a), _squash(val_b)
+        chosen = max((a, b), key=lambda s: (_mixed_case(s), len(s)))
+        return {"chosen_value": _squash(chosen),
+                "justification": "RULE: addresses equal after expanding street suffix abbreviations."}
+
+    if field in ("first_name", "last_name", "city", "county"):
+        strip = lambda s: "".join(c for c in unicodedata.normalize("NFKD", _fold(s)) if not unicodedata.combining(c))
+        if strip(val_a) == strip(val_b):
+            # the accented spelling carries more information
+            chosen = val_a if _fold(val_a) != strip(val_a) else val_b
+            return {"chosen_value": _squash(chosen), "justification": "RULE: values differ only in diacritics."}
+    return None
+
+
+def pre_resolve_conflicts(conflicting_data: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, str]], Dict[str, Any]]:
+    """
+    Splits conflicting_data into (resolved_by_rules, still_conflicting). Only
+    the second part needs the LLM; resolved entries use the same
+    {chosen_value, justification} shape as an LLM decision.
+    """
+    resolved, remaining = {}, {}
+    for field, values in conflicting_data.items():
+        res = resolve_conflict(field, values.get("value_A"), values.get("value_B"))
+        if res is None:
+            remaining[field] = values
+        else:
+            resolved[field] = res
+    if conflicting_data:
+        with _lock:
+            _stats["pair_merges"] += 1
+            _stats["fields_resolved"] += len(resolved)
+            _stats["fields_sent_to_llm"] += len(remaining)
+            if not remaining:
+                _stats["llm_calls_avoided"] += 1
+    return resolved, remaining
+
+
+def rules_stats() -> Dict[str, Any]:
+    with _lock:
+        s = dict(_stats)
+    s["llm_calls_avoided_fraction"] = round(s["llm_calls_avoided"] / s["pair_merges"], 4) if s["pair_merges"] else 0.0
+    total_fields = s["fields_resolved"] + s["fields_sent_to_llm"]
+    s["fields_resolved_fraction"] = round(s["fields_resolved"] / total_fields, 4) if total_fields else 0.0
+    return s
+
+
+# Free-text fields where the longer spelling is usually the more complete one;
+# for the others the anchor record (A) survives.
+_PREFER_LONGER = {"first_name", "last_name", "address", "city", "county"}
+
+
+def survivorship_decision(conflicting_data: Dict[str, Any], reason: str) -> Dict[str, Any]:
+    """
+    Deterministic stand-in for the LLM decision when the provider is
+    unavailable: filled over blank, longer over shorter for free-text
+    fields, otherwise the anchor's value. Always flagged for human review.
+    """
+    resolved = {}
+    for field, values in conflicting_data.items():
+        a, b = values.get("value_A"), values.get("value_B")
+        if _blank(a) and not _blank(b):
+            chosen, why = b, "value A is blank"
+        elif field in _PREFER_LONGER and not _blank(b) and len(_squash(b)) > len(_squash(a)):
+            chosen, why = b, "longer (more complete) value"
+        else:
+            chosen, why = a, "anchor record value"
+        resolved[field] = {"chosen_value": chosen,
+                           "justification": f"FALLBACK: {reason}; kept the {why}. Needs human review."}
+    return {"human_review_required": True, "resolved_conflicts": resolved}
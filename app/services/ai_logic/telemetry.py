@@ -0,0 +1,126 @@
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from ..metrics import llm_call_duration, llm_decision_cache_total, llm_tokens_total
+from .inference_pool import _percentiles
+
+# Per-merge sink: run_llm_inference appends its call records here when a merge
+# iteration is collecting (set on the thread that runs the iteration).
+_sink: ContextVar[Optional[Dict[str, Any]]] = ContextVar("ai_telemetry_sink", default=None)
+
+
+@contextmanager
+def collect() -> Iterator[Dict[str, Any]]:
+    """Collects the LLM calls and cache lookups made on this thread inside the block."""
+    sink = {"calls": [], "cache_hits": 0, "cache_misses": 0}
+    token = _sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _sink.reset(token)
+
+
+class Telemetry:
+    """
+    In-memory aggregate of every LLM call, per provider and model: tokens,
+    latency / time-to-first-token / queue-wait percentiles over the last
+    `window` calls, fixer retries, and decision cache hits and misses.
+    """
+
+    def __init__(self, window: int = 2000):
+        self._lock = threading.Lock()
+        self._window = window
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self._cache = {"hits": 0, "misses": 0, "by_tier": defaultdict(int)}
+
+    def _model(self, provider: str, model: str) -> Dict[str, Any]:
+        key = f"{provider}|{model}"
+        m = self._models.get(key)
+        if m is None:
+            m = self._models[key] = {
+                "provider": provider, "model": model, "calls": 0, "errors": 0, "fixer_retries": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "estimated_token_calls": 0,
+                "latency_s_total": 0.0, "outcomes": defaultdict(int),
+                "latency_ms": deque(maxlen=self._window), "ttft_ms": deque(maxlen=self._window),
+                "queue_wait_ms": deque(maxlen=self._window),
+            }
+        return m
+
+    def record_call(self, rec: Dict[str, Any]) -> None:
+        with self._lock:
+            m = self._model(rec["provider"], rec["model"])
+            m["calls"] += 1
+            m["outcomes"][rec["outcome"]] += 1
+            if rec["outcome"] != "ok":
+                m["errors"] += 1
+            if rec["purpose"] == "fixer":
+                m["fixer_retries"] += 1
+            m["prompt_tokens"] += rec.get("prompt_tokens") or 0
+            m["completion_tokens"] += rec.get("completion_tokens") or 0
+            m["estimated_token_calls"] += int(bool(rec.get("tokens_estimated")))
+            m["latency_s_total"] += rec["latency_ms"] / 1000
+            m["latency_ms"].append(rec["latency_ms"])
+            for k in ("ttft_ms", "queue_wait_ms"):
+                if rec.get(k) is not None:
+                    m[k].append(rec[k])
+        provider, model = rec["provider"], rec["model"]
+        llm_call_duration.observe(rec["latency_ms"] / 1000, provider, model, rec["purpose"], rec["outcome"])
+        llm_tokens_total.inc(provider, model, "prompt", amount=rec.get("prompt_tokens") or 0)
+        llm_tokens_total.inc(provider, model, "completion", amount=rec.get("completion_tokens") or 0)
+        sink = _sink.get()
+        if sink is not None:
+            sink["calls"].append(rec)
+
+    def record_cache(self, hit: bool, tier: Optional[str] = None) -> None:
+        with self._lock:
+            self._cache["hits" if hit else "misses"] += 1
+            if hit and tier:
+                self._cache["by_tier"][tier] += 1
+        llm_decision_cache_total.inc("hit" if hit else "miss")
+        sink = _sink.get()
+        if sink is not None:
+            sink["cache_hits" if hit else "cache_misses"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = []
+            for m in self._models.values():
+                out = {k: v for k, v in m.items() if not isinstance(v, deque)}
+                out["outcomes"] = dict(m["outcomes"])
+                out["latency_s_total"] = round(m["latency_s_total"], 3)
+                # decode throughput for capacity planning (tokens generated per busy second)
+                out["completion_tokens_per_s"] = (
+                    round(m["completion_tokens"] / m["latency_s_total"], 1) if m["latency_s_total"] else None)
+                for k in ("latency_ms", "ttft_ms", "queue_wait_ms"):
+                    out[k] = _percentiles(sorted(m[k]))
+                models.append(out)
+            lookups = self._cache["hits"] + self._cache["misses"]
+            cache = {"hits": self._cache["hits"], "misses": self._cache["misses"],
+                     "hit_rate": round(self._cache["hits"] / lookups, 4) if lookups else None,
+                     "by_tier": dict(self._cache["by_tier"])}
+        return {"models": models, "decision_cache": cache}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self._cache = {"hits": 0, "misses": 0, "by_tier": defaultdict(int)}
+
+
+telemetry = Telemetry()
+
+
+def summarize(calls: List[Dict[str, Any]], cache_hits: int = 0, cache_misses: int = 0) -> Dict[str, Any]:
+    """Per-suggestion totals stored next to the suggestion."""
+    return {
+        "llm_calls": len(calls),
+        "fixer_retries": sum(1 for c in calls if c["purpose"] == "fixer"),
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+        "prompt_tokens": sum(c.get("prompt_tokens") or 0 for c in calls),
+        "completion_tokens": sum(c.get("completion_tokens") or 0 for c in calls),
+        "llm_latency_ms": round(sum(c["latency_ms"] for c in calls), 1),
+        "calls": calls,
+    }
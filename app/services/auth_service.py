@@ -38,7 +38,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)) -> Dict[str, str]:
+# async (nothing here blocks): a sync dependency would need a threadpool thread on every
+# authenticated request, including the async read endpoints
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> Dict[str, str]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -54,7 +56,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)) -> Dict[str, str]:
     
     
 def require_role(required_role: str):
-    def checker(user=Depends(get_current_user)):
+    async def checker(user=Depends(get_current_user)):
         if user["role"] != required_role:
             raise HTTPException(status_code=403, detail="Operation not permitted!")
         return user
@@ -0,0 +1,355 @@
+import json
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, insert, update
+from sqlmodel import Session, select
+
+from ..db import engine, next_change_seqs, writer
+from ..models import AutoMergeJob, ClusterAssignment, DedupeRun, Link, Patient, PatientMergeHistory
+from ..schemas import (AutoMergePlanGroup, AutoMergePlanOut, AutoMergePolicy, AutoMergeUndoOut, BulkMergeGroup,
+                       BulkMergeRequest, PatientUpdate)
+from ..utils import PATIENTS_COLUMNS
+from .ai_logic.rules import _blank, resolve_conflict
+from .bulk_merge import MERGE_BULK_BATCH_SIZE, _chunks, merge_bulk
+from .intake_index import intake_index
+
+# Fields the golden record is built from (identifiers stay the master's).
+SURVIVORSHIP_FIELDS = [c for c in PATIENTS_COLUMNS if c not in ("record_id", "original_record_id")]
+
+# One auto-merge job at a time; merges go through the single writer anyway.
+_jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="auto-merge")
+
+
+def _rid_key(rid: str) -> tuple:
+    return (0, int(rid), "") if rid.isdigit() else (1, 0, rid)
+
+
+def pick_master(records: List[dict]) -> dict:
+    """The most complete record (most filled fields); ties go to the lowest record_id."""
+    return min(records, key=lambda r: (-sum(not _blank(r.get(f)) for f in SURVIVORSHIP_FIELDS),
+                                       _rid_key(r["record_id"])))
+
+
+def golden_record(master: dict, others: List[dict]) -> Tuple[Dict[str, object], List[str]]:
+    """
+    Rule-based survivorship, folding each duplicate into the master's values
+    with the same rules the AI steward applies before calling the LLM.
+    Returns (values differing from the master, fields no rule could settle);
+    unsettled fields keep the master's value.
+    """
+    updates: Dict[str, object] = {}
+    unresolved: List[str] = []
+    for field in SURVIVORSHIP_FIELDS:
+        current = master.get(field)
+        for other in others:
+            value = other.get(field)
+            if value == current or (_blank(value) and _blank(current)):
+                continue
+            res = resolve_conflict(field, current, value)
+            if res is None:
+                unresolved.append(field)
+                current = master.get(field)
+                break
+            current = res["chosen_value"]
+        if current != master.get(field):
+            updates[field] = current
+    return updates, unresolved
+
+
+def _qualifies(decision: str, reason: Optional[str], score: Optional[float], policy: AutoMergePolicy) -> bool:
+    if decision != "match":
+        return False
+    return (policy.accept_ssn_hard and reason == "ssn_hard") or (score or 0.0) >= policy.min_link_score
+
+
+def plan_auto_merge(session: Session, run_id: int,
+                    policy: AutoMergePolicy) -> Tuple[int, List[AutoMergePlanGroup], Dict[str, int]]:
+    """
+    (clusters_total, eligible groups, skip reason counts) for the multi-record
+    clusters of run_id under policy. Members merged or deleted since the run
+    are left out; masters are picked deterministically (pick_master).
+    """
+    members: Dict[str, Set[str]] = defaultdict(set)
+    for rid, pid in session.exec(
+        select(ClusterAssignment.record_id, ClusterAssignment.patient_id).where(ClusterAssignment.run_id == run_id)
+    ):
+        members[pid].add(rid)
+    clusters = {pid: rids for pid, rids in members.items() if len(rids) > 1}
+    cluster_of = {rid: pid for pid, rids in clusters.items() for rid in rids}
+    skipped: Counter = Counter()
+
+    ids = sorted(cluster_of)
+    records: Dict[str, dict] = {}
+    for part in _chunks(ids):
+        for p in session.exec(select(Patient).where(
+                Patient.record_id.in_(part), Patient.is_deleted == False, Patient.merged_into.is_(None))):
+            records[p.record_id] = {c: getattr(p, c) for c in PATIENTS_COLUMNS}
+
+    intra: Dict[str, List[tuple]] = defaultdict(list)      # cluster -> (r1, r2, qualifies)
+    review_linked: Set[str] = set()
+    lt = Link.__table__
+    seen: Set[int] = set()
+    for part in _chunks(ids):
+        for col in (lt.c.record_id1, lt.c.record_id2):
+            for lid, r1, r2, decision, reason, score in session.execute(
+                select(lt.c.id, lt.c.record_id1, lt.c.record_id2, lt.c.decision, lt.c.reason, lt.c.score)
+                .where(lt.c.run_id == run_id, col.in_(part))
+            ):
+                if lid in seen:
+                    continue
+                seen.add(lid)
+                if decision == "review":
+                    review_linked.update(cluster_of[r] for r in (r1, r2) if r in cluster_of)
+                c1, c2 = cluster_of.get(r1), cluster_of.get(r2)
+                if c1 is not None and c1 == c2:
+                    intra[c1].append((r1, r2, _qualifies(decision, reason, score, policy)))
+
+    groups: List[AutoMergePlanGroup] = []
+    for pid in sorted(clusters):
+        rids = clusters[pid]
+        if len(rids) > policy.max_cluster_size:
+            skipped["too_large"] += 1
+            continue
+        if policy.skip_review_linked and pid in review_linked:
+            skipped["review_link"] += 1
+            continue
+        links = intra.get(pid, [])
+        if not all(ok for _, _, ok in links):
+            skipped["weak_link"] += 1
+            continue
+        live = sorted((r for r in rids if r in records), key=_rid_key)
+        if len(live) < 2:
+            skipped["already_merged"] += 1
+            continue
+        # the qualifying links must connect every live member
+        parent = {r: r for r in rids}
+
+        def _find(x: str) -> str:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        for r1, r2, _ in links:
+            parent[_find(r1)] = _find(r2)
+        if len({_find(r) for r in live}) > 1:
+            skipped["not_connected"] += 1
+            continue
+        master = pick_master([records[r] for r in live])
+        others = [records[r] for r in live if r != master["record_id"]]
+        updates, unresolved = golden_record(master, others)
+        if unresolved and not policy.allow_unresolved_conflicts:
+            skipped["unresolved_conflicts"] += 1
+            continue
+        groups.append(AutoMergePlanGroup(
+            cluster_id=pid, master_record_id=master["record_id"],
+            duplicate_record_ids=[o["record_id"] for o in others], updates=updates, unresolved_fields=unresolved,
+        ))
+    return len(clusters), groups, dict(skipped)
+
+
+def dry_run(run_id: int, policy: AutoMergePolicy, limit: int = 100) -> AutoMergePlanOut:
+    with Session(engine) as s:
+        if s.get(DedupeRun, run_id) is None:
+            raise ValueError(f"Run {run_id} not found")
+        total, groups, skipped = plan_auto_merge(s, run_id, policy)
+    return AutoMergePlanOut(run_id=run_id, clusters_total=total, eligible=len(groups),
+                            records_to_merge=sum(len(g.duplicate_record_ids) for g in groups),
+                            skipped=skipped, groups=groups[:limit])
+
+
+def _set_job(job_id: int, **values) -> None:
+    def _job(s: Session) -> None:
+        s.execute(update(AutoMergeJob).where(AutoMergeJob.id == job_id).values(**values))
+    writer.run(_job)
+
+
+def start_auto_merge(run_id: int, policy: AutoMergePolicy) -> Tuple[int, bool]:
+    """(job_id, queued): an auto-merge job already queued or running for the run is returned as is."""
+    with Session(engine) as s:
+        if s.get(DedupeRun, run_id) is None:
+            raise ValueError(f"Run {run_id} not found")
+        active = s.exec(select(AutoMergeJob.id).where(
+            AutoMergeJob.run_id == run_id, AutoMergeJob.status.in_(("queued", "running")))).first()
+        if active is not None:
+            return active, False
+
+    def _create(s: Session) -> int:
+        job = AutoMergeJob(run_id=run_id, policy=policy.model_dump_json())
+        s.add(job)
+        s.flush()
+        return job.id
+
+    job_id = writer.run(_create)
+    _jobs.submit(_run_safely, job_id)
+    return job_id, True
+
+
+def recover_interrupted_jobs() -> int:
+    """
+    Marks the jobs left queued / running by a previous process as failed, at
+    startup: their worker thread died with it, and undo_auto_merge refuses
+    jobs that look active. Assumes one API process runs auto-merge jobs (the
+    job executor is per process).
+    """
+    def _job(s: Session) -> int:
+        return s.execute(
+            update(AutoMergeJob).where(AutoMergeJob.status.in_(("queued", "running")))
+            .values(status="failed", error="interrupted by a restart; undo to revert its merged groups",
+                    finished_at=datetime.utcnow())
+        ).rowcount
+    n = writer.run(_job)
+    if n:
+        print(f"INFO: {n} auto-merge job(s) interrupted by a restart marked failed.")
+    return n
+
+
+def _run_safely(job_id: int) -> None:
+    try:
+        run_auto_merge(job_id)
+    except Exception as e:
+        print(f"EROARE: Auto-merge job {job_id} a esuat: {e}")
+        _set_job(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+
+
+def run_auto_merge(job_id: int) -> None:
+    """Plans the job's run under its policy and applies the groups in batches, updating progress per batch."""
+    with Session(engine) as s:
+        job = s.get(AutoMergeJob, job_id)
+        run_id = job.run_id
+        policy = AutoMergePolicy.model_validate_json(job.policy)
+        total, groups, skipped = plan_auto_merge(s, run_id, policy)
+    _set_job(job_id, status="running", clusters_total=total, groups_total=len(groups))
+    print(f"INFO: Auto-merge job {job_id} (run {run_id}): {len(groups)} of {total} clusters eligible; "
+          f"skipped {skipped}.")
+
+    req = BulkMergeRequest(
+        groups=[BulkMergeGroup(master_record_id=g.master_record_id, duplicate_record_ids=g.duplicate_record_ids,
+                               updates=PatientUpdate(**g.updates) if g.updates else None)
+                for g in groups],
+        reason=f"auto-merge run {run_id} (job {job_id})", run_id=run_id, batch_size=policy.batch_size,
+    )
+    progress = Counter()
+
+    def _on_batch(results) -> None:
+        for r in results:
+            progress["done"] += 1
+            progress["merged"] += len(r.merged)
+            progress["errors"] += r.status == "error"
+        _set_job(job_id, groups_done=progress["done"], records_merged=progress["merged"], errors=progress["errors"])
+
+    merge_bulk(req, job_id=job_id, on_batch=_on_batch)
+    _set_job(job_id, status="done", finished_at=datetime.utcnow())
+
+
+def _undo_batch(session: Session, rows: List[PatientMergeHistory], now: datetime) -> Tuple[List[str], List[str], List[dict]]:
+    """Reverts the groups whose first history rows are given; (undone masters, failed masters, rows to re-index)."""
+    by_master: Dict[str, List[str]] = {}
+    undo: Dict[str, dict] = {}
+    first_id: Dict[str, int] = {}
+    for h in rows:
+        undo[h.target_record] = json.loads(h.undo)
+        first_id[h.target_record] = h.id
+    for master, source in session.exec(
+        select(PatientMergeHistory.target_record, PatientMergeHistory.source_record).where(
+            PatientMergeHistory.job_id == rows[0].job_id,
+            PatientMergeHistory.target_record.in_(list(undo)), PatientMergeHistory.undone_at.is_(None))
+    ):
+        by_master.setdefault(master, []).append(source)
+
+    dups = [d for ds in by_master.values() for d in ds]
+    state = {}
+    for part in _chunks(dups):
+        for rid, merged_into, is_deleted in session.exec(
+            select(Patient.record_id, Patient.merged_into, Patient.is_deleted).where(Patient.record_id.in_(part))
+        ):
+            state[rid] = (merged_into, is_deleted)
+    done, failed = [], []
+    for master, ds in by_master.items():
+        ok = all(state.get(d) == (master, True) for d in ds)
+        (done if ok else failed).append(master)
+    if not done:
+        return done, failed, []
+
+    restore = [{"b_rid": d} for m in done for d in by_master[m]]
+    for r, q in zip(restore, next_change_seqs(session, len(restore))):
+        r["b_seq"] = q
+    pt = Patient.__table__
+    session.execute(
+        update(pt).where(pt.c.record_id == bindparam("b_rid"))
+        .values(is_deleted=False, deleted_at=None, merged_into=None, updated_at=now, change_seq=bindparam("b_seq")),
+        restore,
+    )
+    ct, lt = ClusterAssignment.__table__, Link.__table__
+    assignments = [{"b_id": int(i), "b_rid": rid} for m in done for i, rid in undo[m]["cluster_assignments"].items()]
+    if assignments:
+        session.execute(update(ct).where(ct.c.id == bindparam("b_id")).values(record_id=bindparam("b_rid")),
+                        assignments)
+    # a link touched by several groups returns to its oldest snapshot: walk the
+    # groups newest first and let each older one override
+    links: Dict[int, dict] = {}
+    for m in sorted(done, key=lambda m: -first_id[m]):
+        cols = undo[m]["link_columns"]
+        for values in undo[m]["links_deleted"]:
+            row = dict(zip(cols, values))
+            links[row["id"]] = {"row": row, "b_r1": row["record_id1"], "b_r2": row["record_id2"]}
+        for i, r1, r2 in undo[m]["links_moved"]:
+            links.setdefault(i, {"row": None}).update(b_r1=r1, b_r2=r2)
+    moved = [{"b_id": i, "b_r1": e["b_r1"], "b_r2": e["b_r2"]} for i, e in links.items() if e["row"] is None]
+    if moved:
+        session.execute(update(lt).where(lt.c.id == bindparam("b_id"))
+                        .values(record_id1=bindparam("b_r1"), record_id2=bindparam("b_r2")), moved)
+    deleted = [{**e["row"], "record_id1": e["b_r1"], "record_id2": e["b_r2"]} for e in links.values() if e["row"]]
+    if deleted:
+        session.execute(insert(lt), deleted)
+    before = {m: undo[m]["master_before"] for m in done if undo[m]["master_before"]}
+    for part in _chunks(sorted(before)):
+        for p in session.exec(select(Patient).where(Patient.record_id.in_(part))).all():
+            for field, value in before[p.record_id].items():
+                setattr(p, field, value)
+            session.add(p)
+    session.flush()
+    session.execute(
+        update(PatientMergeHistory)
+        .where(PatientMergeHistory.job_id == rows[0].job_id, PatientMergeHistory.target_record.in_(done))
+        .values(undone_at=now)
+    )
+    reindex = [d["b_rid"] for d in restore] + done
+    out = []
+    for part in _chunks(reindex):
+        for p in session.exec(select(Patient).where(Patient.record_id.in_(part))):
+            out.append({c: getattr(p, c) for c in PATIENTS_COLUMNS})
+    return done, failed, out
+
+
+def undo_auto_merge(job_id: int) -> AutoMergeUndoOut:
+    """
+    Reverts an auto-merge job from the undo data in PatientMergeHistory.
+    Groups whose duplicates no longer point at their master (edited, merged
+    again or hard deleted since) are left as they are and reported.
+    """
+    with Session(engine) as s:
+        job = s.get(AutoMergeJob, job_id)
+        if job is None:
+            raise ValueError(f"Auto-merge job {job_id} not found")
+        if job.status in ("queued", "running"):
+            raise RuntimeError(f"Auto-merge job {job_id} is still {job.status}")
+        firsts = s.exec(select(PatientMergeHistory).where(
+            PatientMergeHistory.job_id == job_id, PatientMergeHistory.undo.is_not(None),
+            PatientMergeHistory.undone_at.is_(None)).order_by(PatientMergeHistory.id.desc())).all()
+
+    undone, failed, restored = 0, [], 0
+    for batch in _chunks(firsts, MERGE_BULK_BATCH_SIZE):
+        now = datetime.utcnow()
+        done, bad, reindex = writer.run(lambda s, batch=batch: _undo_batch(s, batch, now))
+        undone += len(done)
+        failed.extend(bad)
+        restored += len(reindex) - len(done)
+        for rec in reindex:
+            intake_index.upsert(rec)
+    if undone:
+        _set_job(job_id, status="undone")
+    print(f"INFO: Auto-merge job {job_id}: {undone} groups undone, {len(failed)} left unchanged.")
+    return AutoMergeUndoOut(job_id=job_id, groups_undone=undone, records_restored=restored, failed=failed)
@@ -0,0 +1,236 @@
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, delete, insert, update
+from sqlmodel import Session, select
+
+from ..db import count_patient_deletes, next_change_seqs, writer
+from ..models import ClusterAssignment, Link, Patient, PatientMergeHistory
+from ..schemas import BulkMergeGroup, BulkMergeGroupResult, BulkMergeRequest, BulkMergeResponse
+from ..utils import PATIENTS_COLUMNS
+from .intake_index import intake_index
+
+# Groups applied per writer job, i.e. per commit.
+MERGE_BULK_BATCH_SIZE = int(os.getenv("MERGE_BULK_BATCH_SIZE", "500"))
+# Bound for IN (...) lists (SQLite's default variable limit is 999).
+_CHUNK = 900
+
+
+def _chunks(items: List, size: int = _CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _check_overlaps(groups: List[BulkMergeGroup]) -> Dict[int, BulkMergeGroupResult]:
+    """
+    Groups that reuse a record already claimed by an earlier group of the same
+    request fail as a whole: applying them after the earlier merge would chain
+    masters or merge a record twice.
+    """
+    failed: Dict[int, BulkMergeGroupResult] = {}
+    claimed: Set[str] = set()
+    for i, g in enumerate(groups):
+        members = {g.master_record_id, *g.duplicate_record_ids}
+        if not g.master_record_id:
+            failed[i] = BulkMergeGroupResult(index=i, master="", status="error", error="Missing master_record_id")
+            continue
+        overlap = sorted(members & claimed)
+        if overlap:
+            failed[i] = BulkMergeGroupResult(
+                index=i, master=g.master_record_id, status="error",
+                error=f"Record(s) {', '.join(overlap)} already used by an earlier group")
+            continue
+        claimed |= members
+    return failed
+
+
+def _apply_batch(session: Session, batch: List[Tuple[int, BulkMergeGroup]], req: BulkMergeRequest,
+                 now: datetime, job_id: Optional[int] = None
+                 ) -> Tuple[List[BulkMergeGroupResult], List[Tuple[dict, List[str]]]]:
+    """
+    One writer job for a batch of non-overlapping groups: a fixed number of
+    set-based statements whatever the number of groups. Returns the group
+    results and (master row, merged ids) pairs for the intake index.
+    With a job_id, each group's first history row also stores what undo
+    needs: the master's overridden values, the moved cluster assignments and
+    the links as they were before re-pointing.
+    """
+    ids = sorted({rid for _, g in batch for rid in (g.master_record_id, *g.duplicate_record_ids)})
+    live: Set[str] = set()
+    for part in _chunks(ids):
+        live.update(session.exec(
+            select(Patient.record_id).where(
+                Patient.record_id.in_(part), Patient.is_deleted == False, Patient.merged_into.is_(None))
+        ).all())
+
+    results: List[BulkMergeGroupResult] = []
+    target: Dict[str, str] = {}              # duplicate -> master
+    history: Dict[str, List[dict]] = defaultdict(list)    # master -> history rows
+    overrides: Dict[str, dict] = {}
+    for i, g in batch:
+        master = g.master_record_id
+        if master not in live:
+            results.append(BulkMergeGroupResult(index=i, master=master, status="error",
+                                                error=f"Master patient {master} not found or deleted"))
+            continue
+        merged = [d for d in dict.fromkeys(g.duplicate_record_ids) if d != master and d in live]
+        skipped = [d for d in g.duplicate_record_ids if d not in merged]
+        payload = g.updates.model_dump(exclude_unset=True) if g.updates else {}
+        if payload:
+            overrides[master] = payload
+        for d in merged:
+            target[d] = master
+            history[master].append({"created_at": now, "source_record": d, "target_record": master,
+                                    "run_id": req.run_id, "reason": g.reason or req.reason,
+                                    "job_id": job_id, "undo": None})
+        results.append(BulkMergeGroupResult(index=i, master=master, merged=merged, skipped=skipped,
+                                            status="merged" if merged or payload else "noop"))
+    by_master = {r.master: r for r in results if r.status != "error"}
+    link_columns = [c.name for c in Link.__table__.columns]
+    undo = {m: {"master_before": {}, "cluster_assignments": {}, "links_moved": [],
+                "link_columns": link_columns, "links_deleted": []} for m in by_master}
+
+    dups = sorted(target)
+    if dups:
+        # 1) duplicates: soft delete pointing at their master (or hard delete)
+        pt = Patient.__table__
+        if req.hard_delete_duplicates:
+            for part in _chunks(dups):
+                count_patient_deletes(session, session.execute(delete(pt).where(pt.c.record_id.in_(part))).rowcount)
+        else:
+            seqs = next_change_seqs(session, len(target))
+            session.execute(
+                update(pt).where(pt.c.record_id == bindparam("b_rid"))
+                .values(is_deleted=True, deleted_at=now, merged_into=bindparam("b_master"), updated_at=now,
+                        change_seq=bindparam("b_seq")),
+                [{"b_rid": d, "b_master": m, "b_seq": q} for (d, m), q in zip(target.items(), seqs)],
+            )
+        # 2) links: re-point duplicates to their master, drop self-links, keep
+        # pairs canonical (record_id1 < record_id2) and keep the best link per
+        # (run, pair, decision) among the moved and the master's own links
+        lt = Link.__table__
+        endpoints = dups + list(by_master)
+        rows = {}
+        for part in _chunks(endpoints):
+            for col in (lt.c.record_id1, lt.c.record_id2):
+                for row in session.execute(select(lt).where(col.in_(part))):
+                    rows[row.id] = row
+        best: Dict[tuple, tuple] = {}        # key -> (id, score, r1, r2)
+        drop: List[int] = []
+        for row in rows.values():
+            r1, r2 = target.get(row.record_id1, row.record_id1), target.get(row.record_id2, row.record_id2)
+            if r1 == r2:
+                drop.append(row.id)
+                continue
+            if r1 > r2:
+                r1, r2 = r2, r1
+            key = (row.run_id, r1, r2, row.decision)
+            keep = best.get(key)
+            if keep is None or (row.score or 0.0) > (keep[1] or 0.0):
+                if keep is not None:
+                    drop.append(keep[0])
+                best[key] = (row.id, row.score, r1, r2)
+            else:
+                drop.append(row.id)
+        for part in _chunks(drop):
+            session.execute(delete(lt).where(lt.c.id.in_(part)))
+        moved = [{"b_id": lid, "b_r1": r1, "b_r2": r2} for lid, _, r1, r2 in best.values()
+                 if (rows[lid].record_id1, rows[lid].record_id2) != (r1, r2)]
+        if job_id is not None:
+            def _group(row) -> str:
+                r1 = target.get(row.record_id1, row.record_id1)
+                return r1 if r1 in undo else target.get(row.record_id2, row.record_id2)
+            for lid in drop:
+                undo[_group(rows[lid])]["links_deleted"].append(list(rows[lid]))
+            for m in moved:
+                row = rows[m["b_id"]]
+                undo[_group(row)]["links_moved"].append([row.id, row.record_id1, row.record_id2])
+        if moved:
+            session.execute(
+                update(lt).where(lt.c.id == bindparam("b_id"))
+                .values(record_id1=bindparam("b_r1"), record_id2=bindparam("b_r2")),
+                moved,
+            )
+        for _, _, r1, r2 in best.values():
+            for rid in {r1, r2}:
+                if rid in by_master:
+                    by_master[rid].updated_links += 1
+
+        # 3) cluster assignments follow the duplicates to their master
+        ct = ClusterAssignment.__table__
+        for part in _chunks(dups):
+            for ca_id, rid in session.execute(select(ct.c.id, ct.c.record_id).where(ct.c.record_id.in_(part))):
+                by_master[target[rid]].updated_clusters += 1
+                undo[target[rid]]["cluster_assignments"][ca_id] = rid
+        session.execute(
+            update(ct).where(ct.c.record_id == bindparam("b_rid")).values(record_id=bindparam("b_master")),
+            [{"b_rid": d, "b_master": m} for d, m in target.items()],
+        )
+
+    # 4) survivorship overrides on the masters (ORM, so the key columns stay in sync)
+    if overrides:
+        for part in _chunks(sorted(overrides)):
+            for p in session.exec(select(Patient).where(Patient.record_id.in_(part))).all():
+                for field, value in overrides[p.record_id].items():
+                    undo[p.record_id]["master_before"][field] = getattr(p, field)
+                    setattr(p, field, value)
+                session.add(p)
+        session.flush()
+
+    rows_out = []
+    for master, rows_m in history.items():
+        if job_id is not None:
+            rows_m[0]["undo"] = json.dumps(undo[master], default=str)
+        rows_out.extend(rows_m)
+    if rows_out:
+        session.execute(insert(PatientMergeHistory.__table__), rows_out)
+
+    index_updates = []
+    changed = sorted(r.master for r in by_master.values() if r.status == "merged")
+    for part in _chunks(changed):
+        pt = Patient.__table__
+        for row in session.execute(select(*[pt.c[c] for c in PATIENTS_COLUMNS]).where(pt.c.record_id.in_(part))):
+            rec = dict(row._mapping)
+            index_updates.append((rec, by_master[rec["record_id"]].merged))
+    return results, index_updates
+
+
+def merge_bulk(req: BulkMergeRequest, job_id: Optional[int] = None,
+               on_batch: Optional[Callable[[List[BulkMergeGroupResult]], None]] = None) -> BulkMergeResponse:
+    """
+    Applies many {master, duplicates, overrides} merges, batch_size groups per
+    commit. A batch that fails rolls back on its own; its groups are reported
+    as errors and the remaining batches still run. job_id tags the history
+    rows (with undo data); on_batch receives each batch's results.
+    """
+    failed = _check_overlaps(req.groups)
+    todo = [(i, g) for i, g in enumerate(req.groups) if i not in failed]
+    size = req.batch_size or MERGE_BULK_BATCH_SIZE
+    results: Dict[int, BulkMergeGroupResult] = dict(failed)
+    batches = 0
+    for batch in _chunks(todo, size):
+        batches += 1
+        now = datetime.utcnow()
+        try:
+            out, index_updates = writer.run(lambda s, batch=batch: _apply_batch(s, batch, req, now, job_id))
+        except Exception as e:
+            print(f"EROARE: Lotul de fuziuni {batches} a esuat: {e}")
+            out = [BulkMergeGroupResult(index=i, master=g.master_record_id, status="error",
+                                        error=f"Batch failed: {e}") for i, g in batch]
+            index_updates = []
+        for r in out:
+            results[r.index] = r
+        for master, merged in index_updates:
+            intake_index.merge(master, merged)
+        if on_batch is not None:
+            on_batch(out)
+
+    ordered = [results[i] for i in range(len(req.groups))]
+    count = defaultdict(int)
+    for r in ordered:
+        count[r.status] += 1
+    return BulkMergeResponse(total=len(ordered), merged=count["merged"], noop=count["noop"],
+                             failed=count["error"], batches=batches, results=ordered)
@@ -1,10 +1,17 @@
+import asyncio
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from rapidfuzz import fuzz
-from typing import List
+from typing import AsyncIterator, List, Optional
+from .patient_keys import dob_iso, email_norm, phone_digits
 from .ai_logic.orchestrator import get_ai_merge_suggestion as get_ai_suggestion
+from .ai_logic.ai_core import provider_concurrency_limit
+from .ai_logic.config import AI_BATCH_WORKERS, AI_ITEM_TIMEOUT_S
+from .metrics import dedupe_candidate_pairs_total, dedupe_pairs_total, dedupe_stage_duration
 
 # =============================
 # Config
@@ -95,6 +102,16 @@ def gender_sim(a, b) -> float:
 # =============================
 # Input preparation
 # =============================
+def _key_column(df, key_col, raw_col, derive):
+    if key_col not in df.columns:
+        return df[raw_col].map(lambda v: derive(_to_str(v)))
+    out = df[key_col].fillna("").astype(str)
+    missing = out == ""
+    if missing.any():
+        out = out.copy()
+        out[missing] = df.loc[missing, raw_col].map(lambda v: derive(_to_str(v)))
+    return out
+
 def prepare_input(df):
     """Maps CSV schema to internal fields used in scoring/embedding."""
     for col in ["record_id", "first_name", "last_name", "gender", "date_of_birth",
@@ -106,9 +123,10 @@ def prepare_input(df):
     df["__first_name"] = df["first_name"].fillna("").astype(str).str.strip()
     df["__last_name"]  = df["last_name"].fillna("").astype(str).str.strip()
     df["__full_name"]  = (df["__first_name"] + " " + df["__last_name"]).str.strip()
-    df["__dob"]     = df["date_of_birth"]
-    df["__email"]   = df["email"]
-    df["__phone"]   = df["phone_number"]
+    # normalized keys: the stored Patient shadow columns when present, derived otherwise
+    df["__dob"]     = _key_column(df, "dob_iso", "date_of_birth", dob_iso)
+    df["__email"]   = _key_column(df, "email_norm", "email", email_norm)
+    df["__phone"]   = _key_column(df, "phone_digits", "phone_number", phone_digits)
     df["__gender"]  = df["gender"]  # păstrăm originalul și vom normaliza la comparare
     df["__address"] = (
         df["address"].fillna("").astype(str).str.strip()
@@ -225,6 +243,70 @@ def pair_score_heuristic(feats: dict) -> float:
         s = min(1.0, s + 0.02)
     return float(s)
 
+# =============================
+# Vectorized pair scoring (batch intake)
+# =============================
+def score_pairs_vectorized(df_left, df_right, left_idx, right_idx,
+                           emb_left=None, emb_right=None,
+                           link_t=LINK_T, review_t=REVIEW_T):
+    """
+    Scores many (left_idx[k], right_idx[k]) pairs at once; both frames must
+    come from prepare_input. Features match pair_features / pair_score_heuristic,
+    but name similarity, cosine and the weighted sum are computed column-wise.
+    Returns a DataFrame with one row per pair: left, right, features, score,
+    decision, reason.
+    """
+    from rapidfuzz.process import cpdist
+    from sklearn.preprocessing import normalize
+
+    li = np.asarray(left_idx, dtype=np.int64)
+    ri = np.asarray(right_idx, dtype=np.int64)
+    if len(li) == 0:
+        return pd.DataFrame(columns=["left", "right", *FEATURE_ORDER, "score", "decision", "reason"])
+
+    def col(df, name, idx):
+        return [_to_str(v) for v in df[name].to_numpy()[idx]]
+
+    name_l, name_r = col(df_left, "__full_name", li), col(df_right, "__full_name", ri)
+    email_l, email_r = col(df_left, "__email", li), col(df_right, "__email", ri)
+    phone_l, phone_r = col(df_left, "__phone", li), col(df_right, "__phone", ri)
+    addr_l, addr_r = col(df_left, "__address", li), col(df_right, "__address", ri)
+    dob_l, dob_r = col(df_left, "__dob", li), col(df_right, "__dob", ri)
+    gen_l, gen_r = col(df_left, "__gender", li), col(df_right, "__gender", ri)
+    ssn_l, ssn_r = col(df_left, "__ssn", li), col(df_right, "__ssn", ri)
+
+    f = pd.DataFrame({"left": li, "right": ri})
+    f["sim_name"] = np.asarray(cpdist(name_l, name_r, scorer=fuzz.WRatio, workers=1), dtype=float) / 100.0
+    f["sim_email"] = [email_sim(a, b) for a, b in zip(email_l, email_r)]
+    f["sim_phone4"] = [phone_sim(a, b, last_digits=4) for a, b in zip(phone_l, phone_r)]
+    f["sim_addr"] = [address_sim(a, b) for a, b in zip(addr_l, addr_r)]
+    f["sim_dob"] = [1.0 if a and a == b else 0.0 for a, b in zip(dob_l, dob_r)]
+    f["same_domain"] = [1.0 if email_domain(a) == email_domain(b) else 0.0 for a, b in zip(email_l, email_r)]
+    if emb_left is not None and emb_right is not None:
+        # rows are L2-normalized, so the row-wise dot product is the cosine
+        el, er = normalize(emb_left[li]), normalize(emb_right[ri])
+        f["cos_emb"] = np.asarray(el.multiply(er).sum(axis=1)).ravel().astype(float)
+    else:
+        f["cos_emb"] = 0.0
+    f["same_gender"] = [gender_sim(a, b) for a, b in zip(gen_l, gen_r)]
+    f["ssn_hard"] = [1.0 if a and a == b else 0.0 for a, b in zip(ssn_l, ssn_r)]
+
+    score = np.zeros(len(f))
+    for k, w in WEIGHTS.items():
+        score += w * f[k].to_numpy(dtype=float)
+    bonus = (f["same_domain"].to_numpy() == 1.0) & (f["sim_name"].to_numpy() >= 0.90)
+    score = np.where(bonus, np.minimum(1.0, score + 0.02), score)
+
+    hard = f["ssn_hard"].to_numpy() == 1.0
+    f["score"] = np.where(hard, 1.0, score)
+    f["decision"] = np.select(
+        [hard, score >= link_t, score >= review_t], ["match", "match", "review"], default="non-match"
+    )
+    f["reason"] = np.select(
+        [hard, score >= link_t, score >= review_t], ["ssn_hard", "heur_link", "heur_review"], default="heur_below"
+    )
+    return f
+
 # =============================
 # Scorare perechi & decizie
 # =============================
@@ -344,30 +426,41 @@ def cluster_records(df, links_df):
 # =============================
 # Main pipeline (cu clustering)
 # =============================
-def run_pipeline(df, k_neighbors=DEFAULT_K):
+def run_pipeline(df, k_neighbors=DEFAULT_K, embedder=None):
     """
     Returns: links_df, clusters_df
+    embedder: optional Embedder fitted in place, so the caller can persist it.
     """
-    df = prepare_input(df)
+    with dedupe_stage_duration.time("prepare"):
+        df = prepare_input(df)
 
     # 1) Embedding TF-IDF char (neschimbat)
-    texts = [rec_to_text(r) for _, r in df.iterrows()]
-    embedder = Embedder()
-    embs = embedder.fit_transform(texts)   # CSR
+    with dedupe_stage_duration.time("embed"):
+        texts = [rec_to_text(r) for _, r in df.iterrows()]
+        if embedder is None:
+            embedder = Embedder()
+        embs = embedder.fit_transform(texts)   # CSR
 
     # map record_id -> index
     ids = df["record_id"].tolist()
     id_to_idx = {rid: i for i, rid in enumerate(ids)}
 
     # 2) ANN candidates (neschimbat)
-    index = build_ann(embs)
-    candidates = build_candidates(index, embs, ids, k=k_neighbors)
+    with dedupe_stage_duration.time("candidates"):
+        index = build_ann(embs)
+        candidates = build_candidates(index, embs, ids, k=k_neighbors)
+    dedupe_candidate_pairs_total.inc(amount=len(candidates))
 
     # 3) Scorare euristică pe perechi + decizie
-    links_df = score_pairs(candidates, df, embs, id_to_idx)
+    with dedupe_stage_duration.time("score"):
+        links_df = score_pairs(candidates, df, embs, id_to_idx)
+    if not links_df.empty:
+        for decision, n in links_df["decision"].value_counts().items():
+            dedupe_pairs_total.inc(decision, amount=int(n))
 
     # 4) Clustering pe muchiile "match"
-    clusters_df = cluster_records(df, links_df)
+    with dedupe_stage_duration.time("cluster"):
+        clusters_df = cluster_records(df, links_df)
 
     # 4.1) Atașăm patient_id1/2 (clusterele) în links_df
     rec2pid = dict(zip(clusters_df["record_id"], clusters_df["patient_id"]))
@@ -415,14 +508,101 @@ def main():
     print(f"- Clusters: {clusters_df['cluster_id'].nunique()} "
           f"(med size ~ {clusters_df['cluster_size'].mean():.2f})")
 
-def suggest_ai_merge(records: List[dict]) -> dict:
+def suggest_ai_merge(records: List[dict], on_event=None) -> dict:
     """
     Wrapper de serviciu care primeste o lista de inregistrari dintr-un cluster
-    si returneaza o sugestie de fuziune generata de AI.
+    si returneaza o sugestie de fuziune generata de AI. on_event(name, data)
+    primeste progresul fuziunii (vezi get_ai_merge_suggestion).
     """
     # Aici se poate adauga logica suplimentara, ex: logging in DB
-    suggestion = get_ai_suggestion(records)
+    suggestion = get_ai_suggestion(records, on_event=on_event)
     return suggestion
 
+# Thread-uri dedicate pentru sugestiile in lot (nu ocupa threadpool-ul serverului)
+_ai_batch_pool = ThreadPoolExecutor(max_workers=AI_BATCH_WORKERS, thread_name_prefix="ai-batch")
+
+async def suggest_ai_merge_events(records: List[dict]) -> AsyncIterator[tuple]:
+    """
+    Runs suggest_ai_merge on a worker thread and yields (event, data) as the
+    merge progresses, ending with ("result", suggestion) or ("error", {detail}).
+    Events raised on the merge threads are handed to the event loop, so the
+    first field decision reaches the client as soon as it is made.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def _on_event(name: str, data: dict) -> None:
+        loop.call_soon_threadsafe(events.put_nowait, (name, data))
+
+    def _run() -> dict:
+        try:
+            return suggest_ai_merge(records, on_event=_on_event)
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, done)
+
+    fut = loop.run_in_executor(_ai_batch_pool, _run)
+    yield "start", {"records": len(records)}
+    while True:
+        item = await events.get()
+        if item is done:
+            break
+        yield item
+    try:
+        suggestion = await fut
+    except Exception as e:
+        yield "error", {"detail": str(e), "status_code": getattr(e, "status_code", 500)}
+        return
+    if not suggestion or not suggestion.get("suggested_golden_record"):
+        yield "error", {"detail": "A aparut o eroare in timpul generarii sugestiei AI.", "status_code": 500}
+        return
+    yield "result", suggestion
+
+async def suggest_ai_merge_batch(clusters: List[List[dict]],
+                                 item_timeout_s: Optional[float] = None) -> AsyncIterator[dict]:
+    """
+    Runs suggest_ai_merge for many clusters concurrently and yields one result
+    per cluster as soon as it completes: {index, status: ok|timeout|error,
+    elapsed_s, suggestion | error}.
+
+    At most provider_concurrency_limit() clusters are in flight, so the
+    per-item timeout only counts running time, not time spent queued. A
+    cluster that times out keeps its slot until its provider call returns
+    (threads cannot be cancelled), which keeps the provider limit honest.
+    """
+    timeout = item_timeout_s or AI_ITEM_TIMEOUT_S
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(provider_concurrency_limit())
+
+    async def _one(i: int, records: List[dict]) -> dict:
+        if len(records) < 2:
+            return {"index": i, "status": "error", "elapsed_s": 0.0,
+                    "error": "Este necesar un minim de 2 inregistrari pentru o sugestie de fuziune."}
+        await slots.acquire()
+        start = time.monotonic()
+        fut = loop.run_in_executor(_ai_batch_pool, suggest_ai_merge, records)
+        fut.add_done_callback(lambda _f: slots.release())
+        try:
+            suggestion = await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            return {"index": i, "status": "timeout", "elapsed_s": round(time.monotonic() - start, 3),
+                    "error": f"No suggestion within {timeout:g}s"}
+        except Exception as e:
+            return {"index": i, "status": "error", "elapsed_s": round(time.monotonic() - start, 3),
+                    "error": str(e)}
+        elapsed = round(time.monotonic() - start, 3)
+        if not suggestion or not suggestion.get("suggested_golden_record"):
+            return {"index": i, "status": "error", "elapsed_s": elapsed,
+                    "error": "A aparut o eroare in timpul generarii sugestiei AI."}
+        return {"index": i, "status": "ok", "elapsed_s": elapsed, "suggestion": suggestion}
+
+    tasks = [asyncio.ensure_future(_one(i, recs)) for i, recs in enumerate(clusters)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for t in tasks:
+            t.cancel()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,221 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+import pandas as pd
+import scipy.sparse as sp
+from sqlmodel import Session, select
+
+from ..db import change_counters
+from ..models import Patient
+from ..utils import PATIENTS_COLUMNS
+from .dedupe import Embedder, prepare_input, rec_to_text
+from .metrics import intake_blocking_candidates
+from .patient_keys import KEY_COLUMNS, blocking_keys
+
+# Strong keys (ssn / email) rank a candidate far above weak ones (a shared
+# domain, DOB or phonetic name token), so the scoring budget goes to the
+# most plausible records first.
+KEY_WEIGHTS = {
+    "ssn": 100,
+    "email": 50,
+    "last4": 5,
+    "dob": 5,
+    "name": 3,
+    "domain": 1,
+}
+STRONG_KEYS = {"ssn", "email"}
+
+# A weak key shared by more records than this (e.g. "gmail.com") is treated
+# like a stop word: it would only add noise and cost O(n) per lookup.
+MAX_WEAK_POSTING = 2000
+
+# Rebuild (compact) once removed / replaced positions outnumber this share of all positions.
+MAX_TOMBSTONE_RATIO = 0.5
+# More changes than this since the last sync are cheaper to rebuild than to replay row by row.
+MAX_REPLAY_CHANGES = 2000
+
+
+class IntakeIndex:
+    """
+    Process-resident blocking index for /intake/add_or_check.
+
+    Hash maps go from (key kind, key value) to record positions, and a
+    TF-IDF matrix holds one row per position, so candidate lookup is
+    O(matches) instead of a full LIKE scan of the patient table. The index
+    is built lazily from the DB (and rebuilt when the scoring model changes)
+    and kept current through the insert / update / merge / delete hooks
+    called by the routers. Each API process holds its own copy: before
+    every lookup ensure_loaded() compares the DB change counters with the
+    ones the index has seen and replays the patients changed since
+    (change_seq), so writes made by other processes are picked up too; a
+    hard delete elsewhere triggers a rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._loaded = False
+        self.model_version: Optional[str] = None
+        self._seq = 0                                  # last change_seq applied
+        self._deletes = 0                              # hard-delete counter at build time
+        self._tombstones = 0                           # positions whose record was removed or replaced
+        self._postings: Dict[tuple, Set[int]] = defaultdict(set)
+        self._rids: List[Optional[str]] = []          # position -> record_id (None once removed)
+        self._pos_by_rid: Dict[str, int] = {}
+        self._keys_by_pos: Dict[int, Set[tuple]] = {}
+        self.embedder: Optional[Embedder] = None
+        self._matrix = None                            # TF-IDF rows for positions [0, n_base)
+        self._extra_rows: Dict[int, object] = {}       # rows of positions added after the build
+
+    @classmethod
+    def from_records(cls, records: List[dict], embedder: Optional[Embedder] = None) -> "IntakeIndex":
+        """Throwaway index over in-memory records (e.g. the items of one intake batch)."""
+        index = cls()
+        index._build(records, embedder)
+        return index
+
+    # ---------- lifecycle ----------
+    def invalidate(self) -> None:
+        """Drop everything; the next lookup rebuilds from the DB."""
+        with self._lock:
+            self._reset()
+
+    def ensure_loaded(self, session: Session, embedder: Optional[Embedder] = None,
+                      model_version: Optional[str] = None) -> None:
+        """
+        Build the index if needed (a different model_version rebuilds the
+        TF-IDF matrix), otherwise catch up with the patient changes committed
+        since the last call, by this process or any other.
+        """
+        seq, deletes = change_counters(session)
+        with self._lock:
+            stale = (not self._loaded or self.model_version != model_version or deletes != self._deletes
+                     or seq - self._seq > max(MAX_REPLAY_CHANGES, len(self._pos_by_rid) // 10)
+                     or self._tombstones > MAX_TOMBSTONE_RATIO * max(len(self._rids), 1000))
+            if stale:
+                rows = session.exec(select(Patient).where(Patient.is_deleted == False)).all()
+                self._build([{c: getattr(r, c) for c in PATIENTS_COLUMNS + KEY_COLUMNS} for r in rows], embedder)
+                self.model_version = model_version
+                self._seq, self._deletes = seq, deletes
+            elif seq > self._seq:
+                # replayed through the hooks; changes this process already applied are re-applied harmlessly
+                changed = session.exec(select(Patient).where(Patient.change_seq > self._seq)).all()
+                for r in changed:
+                    self.upsert({c: getattr(r, c) for c in PATIENTS_COLUMNS + KEY_COLUMNS + ["is_deleted", "merged_into"]})
+                self._seq = seq
+
+    def _build(self, records: List[dict], embedder: Optional[Embedder]) -> None:
+        self._reset()
+        self.embedder = embedder
+        for rec in records:
+            self._add_keys(rec)
+        if self.embedder is not None and records:
+            self._matrix = self.embedder.transform(_texts(records)).tocsr()
+        self._loaded = True
+
+    # ---------- hooks ----------
+    def upsert(self, rec: dict) -> None:
+        """Insert or update hook (rec holds the PatientOut / Patient fields)."""
+        with self._lock:
+            if not self._loaded:
+                return
+            rid = str(rec["record_id"])
+            if rec.get("is_deleted") or rec.get("merged_into"):
+                self._remove(rid)
+                return
+            self._remove(rid)
+            pos = self._add_keys(rec)
+            if self.embedder is not None:
+                self._extra_rows[pos] = self.embedder.transform(_texts([rec])).tocsr()
+
+    def remove(self, record_ids: Iterable[str]) -> None:
+        """Delete / merge hook: the records stop being intake candidates."""
+        with self._lock:
+            if not self._loaded:
+                return
+            for rid in record_ids:
+                self._remove(str(rid))
+
+    def merge(self, master: dict, duplicate_ids: Iterable[str]) -> None:
+        with self._lock:
+            self.remove(duplicate_ids)
+            self.upsert(master)
+
+    def _add_keys(self, rec: dict) -> int:
+        pos = len(self._rids)
+        rid = str(rec["record_id"])
+        self._rids.append(rid)
+        self._pos_by_rid[rid] = pos
+        keys = blocking_keys(rec)
+        self._keys_by_pos[pos] = keys
+        for k in keys:
+            self._postings[k].add(pos)
+        return pos
+
+    def _remove(self, rid: str) -> None:
+        pos = self._pos_by_rid.pop(rid, None)
+        if pos is None:
+            return
+        for k in self._keys_by_pos.pop(pos, ()):
+            posting = self._postings.get(k)
+            if posting is not None:
+                posting.discard(pos)
+                if not posting:
+                    del self._postings[k]
+        self._rids[pos] = None
+        self._tombstones += 1
+        self._extra_rows.pop(pos, None)
+
+    # ---------- queries ----------
+    def lookup(self, rec: dict, limit: int = 500) -> List[str]:
+        """Record ids sharing at least one blocking key with rec, best-ranked first."""
+        with self._lock:
+            weight: Dict[int, int] = defaultdict(int)
+            for kind, value in blocking_keys(rec):
+                posting = self._postings.get((kind, value))
+                if not posting:
+                    continue
+                if kind not in STRONG_KEYS and len(posting) > MAX_WEAK_POSTING:
+                    continue
+                w = KEY_WEIGHTS[kind]
+                for pos in posting:
+                    weight[pos] += w
+            ranked = sorted(weight.items(), key=lambda kv: (-kv[1], self._rids[kv[0]]))
+        intake_blocking_candidates.observe(len(ranked))
+        return [self._rids[pos] for pos, _ in ranked[:limit]]
+
+    def embeddings_for(self, record_ids: List[str], model_version: Optional[str] = None):
+        """
+        TF-IDF rows for record_ids (same order). None without a vectorizer, or
+        when the index was meanwhile rebuilt for a different model_version.
+        """
+        with self._lock:
+            if self.embedder is None or self.model_version != model_version:
+                return None
+            rows = []
+            for rid in record_ids:
+                pos = self._pos_by_rid.get(rid)
+                if pos is None:
+                    return None
+                if pos in self._extra_rows:
+                    rows.append(self._extra_rows[pos])
+                else:
+                    rows.append(self._matrix[pos])
+            if not rows:
+                return None
+            return sp.vstack(rows).tocsr()
+
+    def __len__(self) -> int:
+        return len(self._pos_by_rid)
+
+
+def _texts(records: List[dict]) -> List[str]:
+    cols = PATIENTS_COLUMNS + [c for c in KEY_COLUMNS if c in records[0]]
+    df = prepare_input(pd.DataFrame(records, columns=cols).fillna(""))
+    return [rec_to_text(r) for _, r in df.iterrows()]
+
+
+intake_index = IntakeIndex()
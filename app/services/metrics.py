@@ -0,0 +1,230 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Prometheus text exposition (format 0.0.4) without a client dependency.
+# Every metric is a dict of label values -> numbers behind one lock, so an
+# observation costs a tuple lookup and a bisect.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() in ("true", "1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        return tuple(str(v) for v in labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_num(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, ([*v[0]], v[1], v[2])) for k, v in self._values.items()]
+        for key, (counts, total, n) in sorted(items):
+            cumulative = 0
+            for bound, c in zip((*self.buckets, float("inf")), counts):
+                cumulative += c
+                le = f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return lines
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def add_collector(self, fn: Callable[[], List[str]]) -> None:
+        """fn() returns exposition lines computed at scrape time (gauges read from other components)."""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        for fn in self._collectors:
+            try:
+                lines.extend(fn())
+            except Exception as e:  # a broken collector must not break the scrape
+                lines.append(f"# collector {getattr(fn, '__name__', fn)} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- HTTP ---
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template, method and status.",
+    ("method", "route", "status"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served.")
+http_request_db_queries = Histogram(
+    "http_request_db_queries", "DB queries issued while serving a request.", ("route",), COUNT_BUCKETS)
+http_request_db_seconds = Histogram(
+    "http_request_db_seconds", "Time spent in DB queries while serving a request.", ("route",))
+
+# --- DB ---
+db_queries_total = Counter("db_queries_total", "DB queries executed (all callers).")
+db_query_seconds_total = Counter("db_query_seconds_total", "Time spent executing DB queries (all callers).")
+
+# --- dedupe pipeline ---
+dedupe_stage_duration = Histogram(
+    "dedupe_stage_duration_seconds", "Duration of each /dedupe/run stage.", ("stage",), SLOW_BUCKETS)
+dedupe_candidate_pairs_total = Counter("dedupe_candidate_pairs_total", "Candidate pairs produced by ANN blocking.")
+dedupe_pairs_total = Counter("dedupe_pairs_total", "Scored pairs by decision.", ("decision",))
+
+# --- intake ---
+intake_blocking_candidates = Histogram(
+    "intake_blocking_candidates", "Candidates returned by the intake blocking index per lookup.", (),
+    COUNT_BUCKETS)
+
+# --- LLM ---
+llm_call_duration = Histogram(
+    "llm_call_duration_seconds", "LLM provider call latency by outcome ('ok' or the error type).",
+    ("provider", "model", "purpose", "outcome"), SLOW_BUCKETS)
+llm_tokens_total = Counter("llm_tokens_total", "Prompt and completion tokens.", ("provider", "model", "kind"))
+llm_decision_cache_total = Counter("llm_decision_cache_total", "AI decision cache lookups.", ("result",))
+
+
+# Per-request DB accounting: the middleware sets a [queries, seconds] cell;
+# the cursor listeners (db.py) add to it from whichever thread runs the query.
+_request_db: ContextVar[Optional[list]] = ContextVar("request_db", default=None)
+
+
+def record_query(elapsed_s: float) -> None:
+    db_queries_total.inc()
+    db_query_seconds_total.inc(amount=elapsed_s)
+    cell = _request_db.get()
+    if cell is not None:
+        cell[0] += 1
+        cell[1] += elapsed_s
+
+
+class MetricsMiddleware:
+    """ASGI middleware (not BaseHTTPMiddleware, so streaming responses pass through untouched)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        cell = [0, 0.0]
+        token = _request_db.set(cell)
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            _request_db.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            http_request_duration.observe(elapsed, scope["method"], path, str(status[0]))
+            http_request_db_queries.observe(cell[0], path)
+            http_request_db_seconds.observe(cell[1], path)
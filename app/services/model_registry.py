@@ -0,0 +1,164 @@
+import os
+import pickle
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from sqlmodel import Session, select
+
+from ..models import DedupeRun
+from .dedupe import Embedder, LINK_T, REVIEW_T, WEIGHTS
+
+MODELS_DIR = os.getenv("DEDUP_MODELS_DIR", "models")
+# Legacy single-file location; still written after every run and used as a
+# fallback when no DedupeRun has an artifact yet.
+VEC_PATH = os.getenv("DEDUP_TFIDF_PATH", os.path.join(MODELS_DIR, "latest_tfidf.pkl"))
+# How often (seconds) a request may look for a newer DedupeRun artifact
+# written by another process. The check is a single indexed DB query.
+MODEL_CHECK_INTERVAL_S = float(os.getenv("DEDUP_MODEL_CHECK_INTERVAL_S", "30"))
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    version: str
+    run_id: Optional[int] = None
+    path: Optional[str] = None
+    embedder: Optional[Embedder] = None
+    link_t: float = LINK_T
+    review_t: float = REVIEW_T
+    weights: dict = field(default_factory=lambda: dict(WEIGHTS))
+    loaded_at: datetime = field(default_factory=datetime.utcnow)
+
+
+NO_MODEL = LoadedModel(version="none")
+
+
+def save_run_artifacts(run_id: int, embedder: Embedder) -> str:
+    """Pickle the fitted vectorizer and scoring thresholds of a run; returns the artifact path."""
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    path = os.path.join(MODELS_DIR, f"tfidf_run_{run_id}.pkl")
+    payload = {
+        "run_id": run_id,
+        "vectorizer": embedder.vec,
+        "link_t": LINK_T,
+        "review_t": REVIEW_T,
+        "weights": dict(WEIGHTS),
+    }
+    for target in (path, VEC_PATH):
+        tmp = f"{target}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(payload, f)
+        os.replace(tmp, target)  # readers never see a half-written file
+    return path
+
+
+def _load_artifact(path: str, run_id: Optional[int] = None) -> LoadedModel:
+    with open(path, "rb") as f:
+        obj = pickle.load(f)
+    emb = Embedder()
+    if isinstance(obj, dict):
+        emb.vec = obj["vectorizer"]
+        run_id = obj.get("run_id", run_id)
+        return LoadedModel(
+            version=f"run-{run_id}" if run_id is not None else f"file-{int(os.path.getmtime(path))}",
+            run_id=run_id,
+            path=path,
+            embedder=emb,
+            link_t=obj.get("link_t", LINK_T),
+            review_t=obj.get("review_t", REVIEW_T),
+            weights=obj.get("weights", dict(WEIGHTS)),
+        )
+    # legacy format: the bare TfidfVectorizer
+    emb.vec = obj
+    return LoadedModel(version=f"file-{int(os.path.getmtime(path))}", run_id=run_id, path=path, embedder=emb)
+
+
+class ModelRegistry:
+    """
+    Process-wide holder of the intake scoring artifacts. They are loaded once
+    (first use) and swapped atomically when a newer DedupeRun artifact shows up.
+    Readers take a snapshot with current() and never touch the disk.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model: Optional[LoadedModel] = None
+        self._last_check = 0.0
+        self.last_error: Optional[str] = None
+
+    def current(self, session: Optional[Session] = None) -> LoadedModel:
+        model = self._model
+        if model is None:
+            with self._lock:
+                if self._model is None:
+                    self._swap(self._load_latest(session))
+            return self._model
+        if session is not None and time.monotonic() - self._last_check >= MODEL_CHECK_INTERVAL_S:
+            self._check_for_newer(session)
+        return self._model
+
+    def publish(self, run_id: int, path: str) -> LoadedModel:
+        """Called in-process right after a run saved its artifacts."""
+        with self._lock:
+            model = _load_artifact(path, run_id)
+            self._swap(model)
+            return model
+
+    def status(self) -> dict:
+        m = self._model
+        return {
+            "loaded": m is not None and m.embedder is not None,
+            "version": m.version if m else None,
+            "run_id": m.run_id if m else None,
+            "path": m.path if m else None,
+            "loaded_at": m.loaded_at if m else None,
+            "link_t": m.link_t if m else LINK_T,
+            "review_t": m.review_t if m else REVIEW_T,
+            "last_error": self.last_error,
+        }
+
+    def _check_for_newer(self, session: Session) -> None:
+        self._last_check = time.monotonic()
+        latest = self._latest_run_with_artifact(session)
+        if latest is None:
+            return
+        current = self._model
+        if current is not None and current.run_id is not None and latest.id <= current.run_id:
+            return
+        with self._lock:
+            current = self._model
+            if current is not None and current.run_id is not None and latest.id <= current.run_id:
+                return
+            try:
+                self._swap(_load_artifact(latest.artifact_path, latest.id))
+            except Exception as e:
+                self.last_error = f"{latest.artifact_path}: {e}"
+
+    @staticmethod
+    def _latest_run_with_artifact(session: Session) -> Optional[DedupeRun]:
+        return session.exec(
+            select(DedupeRun)
+            .where(DedupeRun.artifact_path != None)  # noqa: E711
+            .order_by(DedupeRun.id.desc())
+        ).first()
+
+    def _load_latest(self, session: Optional[Session]) -> LoadedModel:
+        self._last_check = time.monotonic()
+        try:
+            if session is not None:
+                latest = self._latest_run_with_artifact(session)
+                if latest is not None and os.path.exists(latest.artifact_path):
+                    return _load_artifact(latest.artifact_path, latest.id)
+            if os.path.exists(VEC_PATH):
+                return _load_artifact(VEC_PATH)
+        except Exception as e:
+            self.last_error = str(e)
+        return NO_MODEL
+
+    def _swap(self, model: LoadedModel) -> None:
+        self._model = model  # single reference assignment: readers see old or new, never a mix
+
+
+model_registry = ModelRegistry()
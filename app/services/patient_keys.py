@@ -0,0 +1,119 @@
+import hashlib
+import re
+from datetime import datetime
+from typing import Set
+
+import jellyfish
+
+# Normalized lookup keys derived from a patient record. Blocking (intake index)
+# and exact-key matching use these instead of re-deriving values in SQL.
+
+DOB_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d", "%d.%m.%Y")
+
+
+def _s(x) -> str:
+    return "" if x is None else str(x).strip()
+
+def phone_digits(x) -> str:
+    return re.sub(r"\D", "", _s(x))
+
+def phone_last4(x) -> str:
+    d = phone_digits(x)
+    return d[-4:] if len(d) >= 4 else ""
+
+def email_norm(x) -> str:
+    return _s(x).lower()
+
+def email_domain(x) -> str:
+    e = email_norm(x)
+    return e.split("@", 1)[1] if "@" in e else ""
+
+def name_norm(first, last) -> str:
+    return " ".join(f"{_s(first)} {_s(last)}".lower().split())
+
+def dob_iso(x) -> str:
+    """DOB as YYYY-MM-DD when it parses with one of DOB_FORMATS, else the trimmed input."""
+    v = _s(x)
+    for fmt in DOB_FORMATS:
+        try:
+            return datetime.strptime(v, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return v
+
+def phonetic_key(token) -> str:
+    t = re.sub(r"[^a-z]", "", _s(token).lower())
+    if len(t) < 2:
+        return ""
+    return jellyfish.metaphone(t)
+
+def name_keys(first, last) -> Set[str]:
+    """Metaphone codes of every first/last name token (order-free, so swapped names still block)."""
+    keys = set()
+    for tok in f"{_s(first)} {_s(last)}".split():
+        k = phonetic_key(tok)
+        if k:
+            keys.add(k)
+    return keys
+
+
+# Persisted, indexed copies of the keys above (Patient shadow columns).
+# name_phonetic holds the sorted metaphone codes separated by spaces.
+KEY_COLUMNS = [
+    "phone_digits", "phone_last4", "email_norm", "email_domain",
+    "name_norm", "name_phonetic", "dob_iso",
+]
+
+
+def key_columns(rec: dict) -> dict:
+    """Shadow column values derived from the raw fields of a patient record."""
+    email = email_norm(rec.get("email"))
+    return {
+        "phone_digits": phone_digits(rec.get("phone_number")),
+        "phone_last4": phone_last4(rec.get("phone_number")),
+        "email_norm": email,
+        "email_domain": email_domain(email),
+        "name_norm": name_norm(rec.get("first_name"), rec.get("last_name")),
+        "name_phonetic": " ".join(sorted(name_keys(rec.get("first_name"), rec.get("last_name")))),
+        "dob_iso": dob_iso(rec.get("date_of_birth")),
+    }
+
+
+def _stored_or_derived(rec: dict) -> dict:
+    # rows read from the DB carry the shadow columns; payloads do not
+    if all(rec.get(c) is not None for c in KEY_COLUMNS):
+        return rec
+    return key_columns(rec)
+
+
+def blocking_keys(rec: dict) -> Set[tuple]:
+    """All (kind, value) blocking keys of a record; kinds match IntakeIndex.KEY_WEIGHTS."""
+    k = _stored_or_derived(rec)
+    keys: Set[tuple] = set()
+    ssn = _s(rec.get("ssn"))
+    if ssn:
+        keys.add(("ssn", ssn))
+    if k["email_norm"]:
+        keys.add(("email", k["email_norm"]))
+        if k["email_domain"]:
+            keys.add(("domain", k["email_domain"]))
+    if k["phone_last4"]:
+        keys.add(("last4", k["phone_last4"]))
+    if k["dob_iso"]:
+        keys.add(("dob", k["dob_iso"]))
+    for code in k["name_phonetic"].split():
+        keys.add(("name", code))
+    return keys
+
+
+# Fields covered by Patient.content_hash (the ingest CSV columns minus record_id)
+CONTENT_FIELDS = [
+    "original_record_id", "first_name", "last_name", "gender", "date_of_birth",
+    "address", "city", "county", "ssn", "phone_number", "email",
+]
+
+
+def content_hash(rec: dict) -> str:
+    """Stable digest of the patient's content; equal hashes mean a re-sent row changes nothing."""
+    payload = "\x1f".join(_s(rec.get(f)) for f in CONTENT_FIELDS)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
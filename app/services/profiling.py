@@ -0,0 +1,276 @@
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+from .auth_service import get_current_user, require_role
+
+# Opt-in per-request sampling profiler. An admin sends `X-Profile: 1` (or
+# `?profile=1`); the request is sampled, the profile is stored and its id is
+# returned in the `X-Profile-Id` response header.
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "True").lower() in ("true", "1")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "2"))
+# Slowest profiled requests kept per route, and for how long.
+PROFILE_KEEP_SLOWEST = int(os.getenv("PROFILE_KEEP_SLOWEST", "5"))
+PROFILE_RETENTION_S = int(os.getenv("PROFILE_RETENTION_S", "86400"))
+# Most recent profiles kept by id, whatever their route.
+PROFILE_MAX_RECENT = int(os.getenv("PROFILE_MAX_RECENT", "50"))
+_MAX_DEPTH = 200
+
+# Set to the request's _Sampler for everything the request runs, including
+# the threadpool calls made on its behalf (they copy the context).
+_active: ContextVar[Optional["_Sampler"]] = ContextVar("profiled_request", default=None)
+
+
+def _runner_codes() -> Dict[Any, str]:
+    """
+    Code objects that run a callback inside a contextvars.Context, mapped to
+    how to find that context in their frame. The sampler uses them to tell
+    which thread is working for which request.
+    """
+    import asyncio.events
+    codes = {asyncio.events.Handle._run.__code__: "handle"}
+    try:
+        from anyio._backends._asyncio import WorkerThread
+        codes[WorkerThread.run.__code__] = "worker"
+    except (ImportError, AttributeError):
+        pass
+    return codes
+
+
+_RUNNERS = _runner_codes()
+
+
+def _frame_context(frame, kind: str):
+    try:
+        local = frame.f_locals
+        return local["self"]._context if kind == "handle" else local.get("context")
+    except Exception:
+        return None
+
+
+def _frame_key(code) -> Tuple[str, str, int]:
+    return code.co_qualname, code.co_filename, code.co_firstlineno
+
+
+class _Sampler:
+    """Samples the stacks of every thread running in this request's context."""
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()     # (thread name, frame keys root->leaf) -> samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _loop(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval_s):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid != me:
+                    self._sample(names.get(tid, str(tid)), frame)
+
+    def _sample(self, thread_name: str, leaf) -> None:
+        codes = []
+        frame = leaf
+        while frame is not None and len(codes) < _MAX_DEPTH:
+            kind = _RUNNERS.get(frame.f_code)
+            if kind is not None:
+                ctx = _frame_context(frame, kind)
+                if ctx is not None and ctx.get(_active) is self and codes:
+                    self.stacks[(thread_name, tuple(_frame_key(c) for c in reversed(codes)))] += 1
+                    self.samples += 1
+                # the innermost runner decides: this thread works for another request (or none)
+                return
+            codes.append(frame.f_code)
+            frame = frame.f_back
+
+
+def _short(filename: str) -> str:
+    for root in sorted((p for p in sys.path if p), key=len, reverse=True):
+        if filename.startswith(root.rstrip(os.sep) + os.sep):
+            return filename[len(root.rstrip(os.sep)) + 1:]
+    return filename
+
+
+def _frame_name(key: Tuple[str, str, int]) -> str:
+    name, filename, line = key
+    return f"{name} ({_short(filename)}:{line})"
+
+
+class ProfileStore:
+    """Recent profiles by id, plus the slowest PROFILE_KEEP_SLOWEST per route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._recent: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._slowest: Dict[str, List[Dict[str, Any]]] = {}
+
+    def new_id(self) -> int:
+        return next(self._ids)
+
+    def add(self, profile: Dict[str, Any]) -> None:
+        with self._lock:
+            self._recent[profile["id"]] = profile
+            while len(self._recent) > PROFILE_MAX_RECENT:
+                self._recent.popitem(last=False)
+            kept = self._slowest.setdefault(profile["route"], [])
+            kept.append(profile)
+            kept.sort(key=lambda p: -p["duration_ms"])
+            del kept[PROFILE_KEEP_SLOWEST:]
+
+    def _expire(self) -> None:
+        cutoff = time.time() - PROFILE_RETENTION_S
+        for route in list(self._slowest):
+            self._slowest[route] = [p for p in self._slowest[route] if p["ts"] >= cutoff]
+            if not self._slowest[route]:
+                del self._slowest[route]
+
+    def get(self, profile_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            p = self._recent.get(profile_id)
+            if p is None:
+                p = next((p for kept in self._slowest.values() for p in kept if p["id"] == profile_id), None)
+            return p
+
+    def slowest(self, route: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            self._expire()
+            return {r: [summary(p) for p in kept] for r, kept in sorted(self._slowest.items())
+                    if route is None or r == route}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._recent.clear()
+            self._slowest.clear()
+
+
+profile_store = ProfileStore()
+
+
+def summary(p: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: p[k] for k in ("id", "route", "method", "path", "status", "duration_ms",
+                              "samples", "interval_ms", "started_at")}
+
+
+def to_collapsed(p: Dict[str, Any]) -> str:
+    """Brendan Gregg's collapsed stacks ("thread;outer;...;inner count"), for flamegraph.pl / speedscope."""
+    lines = []
+    for (thread, frames), n in sorted(p["stacks"].items()):
+        names = [thread] + [_frame_name(k).replace(";", ":") for k in frames]
+        lines.append(f"{';'.join(names)} {n}")
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(p: Dict[str, Any]) -> Dict[str, Any]:
+    """speedscope's file format: one sampled profile per thread, weights in milliseconds."""
+    frames: List[Dict[str, Any]] = []
+    index: Dict[Any, int] = {}
+
+    def _idx(key) -> int:
+        if key not in index:
+            index[key] = len(frames)
+            if isinstance(key, str):
+                frames.append({"name": key})
+            else:
+                frames.append({"name": key[0], "file": _short(key[1]), "line": key[2]})
+        return index[key]
+
+    by_thread: Dict[str, List[Tuple[List[int], int]]] = {}
+    for (thread, stack), n in sorted(p["stacks"].items()):
+        by_thread.setdefault(thread, []).append(([_idx(k) for k in stack], n))
+    profiles = []
+    for thread, rows in by_thread.items():
+        weights = [round(n * p["interval_ms"], 3) for _, n in rows]
+        profiles.append({
+            "type": "sampled", "name": f"{p['method']} {p['route']} [{thread}]", "unit": "milliseconds",
+            "startValue": 0, "endValue": round(sum(weights), 3),
+            "samples": [stack for stack, _ in rows], "weights": weights,
+        })
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"profile {p['id']}: {p['method']} {p['path']} ({p['duration_ms']} ms)",
+        "exporter": "patients-dedupe-api", "activeProfileIndex": 0,
+        "shared": {"frames": frames}, "profiles": profiles,
+    }
+
+
+def _wants_profile(scope) -> bool:
+    for name, value in scope.get("headers", ()):
+        if name == b"x-profile":
+            return value.strip().lower() in (b"1", b"true")
+    qs = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return qs.get("profile", [""])[-1].lower() in ("1", "true")
+
+
+async def _check_admin(scope) -> None:
+    """The same check as Depends(require_role("admin")); raises HTTPException."""
+    auth = next((v.decode("latin-1") for k, v in scope.get("headers", ()) if k == b"authorization"), "")
+    scheme, _, token = auth.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    await require_role("admin")(await get_current_user(token))
+
+
+class ProfilingMiddleware:
+    """ASGI middleware: samples the requests that ask for it; everything else passes straight through."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _wants_profile(scope):
+            return await self.app(scope, receive, send)
+        try:
+            await _check_admin(scope)
+        except HTTPException as e:
+            return await JSONResponse({"detail": e.detail}, status_code=e.status_code)(scope, receive, send)
+
+        profile_id = profile_store.new_id()
+        status = [500]
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", str(profile_id).encode())]
+            await send(message)
+
+        sampler = _Sampler(PROFILE_INTERVAL_MS / 1000)
+        token = _active.set(sampler)
+        started_at = datetime.utcnow()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            sampler.stop()
+            _active.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            profile_store.add({
+                "id": profile_id, "route": route, "method": scope["method"], "path": scope["path"],
+                "status": status[0], "duration_ms": round(duration_ms, 2), "samples": sampler.samples,
+                "interval_ms": PROFILE_INTERVAL_MS, "started_at": started_at, "ts": time.time(),
+                "stacks": dict(sampler.stacks),
+            })
+            print(f"INFO: Profile {profile_id}: {scope['method']} {route} {duration_ms:.0f} ms, "
+                  f"{sampler.samples} samples.")
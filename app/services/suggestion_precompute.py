@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import update
+from sqlmodel import Session, select
+
+from ..db import engine, writer
+from ..models import AISuggestion, ClusterAssignment, DedupeRun, Link, Patient
+from ..utils import PATIENTS_COLUMNS
+from .ai_logic.ai_core import provider_concurrency_limit
+from .dedupe import suggest_ai_merge
+from .patient_keys import content_hash
+
+# At most this many clusters per run, review clusters first.
+AI_PRECOMPUTE_MAX_CLUSTERS = int(os.getenv("AI_PRECOMPUTE_MAX_CLUSTERS", "1000"))
+# Larger clusters are left to the live path (a tree merge of many records is slow and rarely reviewed as a whole).
+AI_PRECOMPUTE_MAX_CLUSTER_SIZE = int(os.getenv("AI_PRECOMPUTE_MAX_CLUSTER_SIZE", "12"))
+# Concurrent suggestions; 0 = the provider's concurrency limit.
+AI_PRECOMPUTE_CONCURRENCY = int(os.getenv("AI_PRECOMPUTE_CONCURRENCY", "0"))
+# Results are written in batches of this many rows.
+AI_PRECOMPUTE_FLUSH_EVERY = 20
+# Keep the per-suggestion LLM telemetry (tokens, latency, fixer retries) in AISuggestion.telemetry.
+AI_TELEMETRY_PERSIST = os.getenv("AI_TELEMETRY_PERSIST", "True").lower() in ("true", "1")
+
+# One precompute job at a time; each job fans out to its own bounded pool.
+_jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai-precompute")
+
+
+def _halted(suggestion: dict) -> bool:
+    """Failed merges and deterministic fallbacks (AI unavailable) are not worth keeping."""
+    return any(
+        c.get("chosen_value") == "PROCESS_HALTED" or str(c.get("justification", "")).startswith("FALLBACK:")
+        for c in suggestion.get("conflicts_resolved", [])
+    )
+
+
+def _serialize(suggestion: dict) -> Tuple[str, Optional[str]]:
+    """(suggestion JSON, telemetry JSON or None); the telemetry describes this computation, not the suggestion."""
+    suggestion = dict(suggestion)
+    tel = suggestion.pop("telemetry", None)
+    tel_json = json.dumps(tel, default=str) if tel is not None and AI_TELEMETRY_PERSIST else None
+    return json.dumps(suggestion, default=str), tel_json
+
+
+def records_hash(records: List[dict]) -> str:
+    """Order-independent digest of a cluster's members and their content."""
+    lines = sorted(f"{r['record_id']}:{content_hash(r)}" for r in records)
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+def select_clusters(session: Session, run_id: int) -> List[Tuple[str, List[str]]]:
+    """
+    (cluster_key, record_ids) the stewards will open for this run: the two
+    clusters joined by each review-band link, then multi-record match
+    clusters. Duplicated member sets and oversized clusters are skipped.
+    """
+    members: Dict[str, List[str]] = defaultdict(list)
+    for rid, pid in session.exec(
+        select(ClusterAssignment.record_id, ClusterAssignment.patient_id).where(ClusterAssignment.run_id == run_id)
+    ):
+        members[pid].append(rid)
+
+    groups: List[Tuple[str, List[str]]] = []
+    seen = set()
+
+    def _add(key: str, rids: List[str]) -> None:
+        rids = sorted(set(rids))
+        if len(rids) < 2 or len(rids) > AI_PRECOMPUTE_MAX_CLUSTER_SIZE:
+            return
+        fs = frozenset(rids)
+        if fs in seen:
+            return
+        seen.add(fs)
+        groups.append((key, rids))
+
+    review = session.exec(
+        select(Link.record_id1, Link.record_id2, Link.patient_id1, Link.patient_id2)
+        .where(Link.run_id == run_id, Link.decision == "review")
+        .order_by(Link.score.desc())
+    ).all()
+    for rid1, rid2, pid1, pid2 in review:
+        rids = members.get(pid1, [rid1]) + members.get(pid2, [rid2])
+        _add(f"review:{pid1}+{pid2}", rids)
+
+    for pid, rids in sorted(members.items()):
+        _add(pid, rids)
+    return groups[:AI_PRECOMPUTE_MAX_CLUSTERS]
+
+
+def _load_records(session: Session, record_ids: List[str], chunk: int = 900) -> Dict[str, dict]:
+    """Live (not deleted, not merged) patients by record_id."""
+    out: Dict[str, dict] = {}
+    for i in range(0, len(record_ids), chunk):
+        rows = session.exec(
+            select(Patient).where(
+                Patient.record_id.in_(record_ids[i:i + chunk]),
+                Patient.is_deleted == False,
+                Patient.merged_into.is_(None),
+            )
+        ).all()
+        for p in rows:
+            out[p.record_id] = {c: getattr(p, c) for c in PATIENTS_COLUMNS}
+    return out
+
+
+def _set_run(run_id: int, **values) -> None:
+    def _job(s: Session) -> None:
+        s.execute(update(DedupeRun).where(DedupeRun.id == run_id).values(**values))
+    writer.run(_job)
+
+
+def start_precompute(run_id: int) -> bool:
+    """Queue the precompute stage for a run; False when it is already queued or running."""
+    with Session(engine) as s:
+        run = s.get(DedupeRun, run_id)
+        if run is None:
+            raise ValueError(f"Run {run_id} not found")
+        if run.suggestions_status in ("queued", "running"):
+            return False
+    _set_run(run_id, suggestions_status="queued", suggestions_total=None, suggestions_done=0)
+    _jobs.submit(_precompute_safely, run_id)
+    return True
+
+
+def _precompute_safely(run_id: int) -> None:
+    try:
+        precompute_run_suggestions(run_id)
+    except Exception as e:
+        print(f"EROARE: Precalcularea sugestiilor AI pentru run {run_id} a esuat: {e}")
+        _set_run(run_id, suggestions_status="failed")
+
+
+def precompute_run_suggestions(run_id: int) -> Dict[str, int]:
+    """
+    Computes and stores a suggestion for every selected cluster of run_id.
+    Clusters whose current content already has a suggestion (e.g. from an
+    earlier run) reuse it without an LLM call.
+    """
+    with Session(engine) as s:
+        groups = select_clusters(s, run_id)
+        records = _load_records(s, sorted({rid for _, rids in groups for rid in rids}))
+        work = []
+        for key, rids in groups:
+            recs = [records[r] for r in rids if r in records]
+            if len(recs) >= 2:
+                work.append((key, recs, records_hash(recs)))
+        known = {}
+        hashes = [h for _, _, h in work]
+        for i in range(0, len(hashes), 900):
+            for h, sug, hr in s.exec(
+                select(AISuggestion.records_hash, AISuggestion.suggestion, AISuggestion.human_review_required)
+                .where(AISuggestion.records_hash.in_(hashes[i:i + 900]), AISuggestion.status == "ok")
+            ):
+                known[h] = (sug, hr)
+
+    _set_run(run_id, suggestions_status="running", suggestions_total=len(work), suggestions_done=0)
+    counts = {"total": len(work), "computed": 0, "reused": 0, "errors": 0}
+    pending: List[AISuggestion] = []
+    done = 0
+
+    def _flush() -> None:
+        nonlocal pending
+        rows, pending = pending, []
+
+        def _job(s: Session) -> None:
+            s.add_all(rows)
+            s.execute(update(DedupeRun).where(DedupeRun.id == run_id).values(suggestions_done=done))
+        writer.run(_job)
+
+    def _row(key: str, recs: List[dict], h: str, **fields) -> AISuggestion:
+        return AISuggestion(run_id=run_id, cluster_key=key, records_hash=h,
+                            record_ids=",".join(r["record_id"] for r in recs), **fields)
+
+    to_compute = []
+    for key, recs, h in work:
+        if h in known:
+            sug, hr = known[h]
+            pending.append(_row(key, recs, h, suggestion=sug, human_review_required=hr, elapsed_s=0.0))
+            counts["reused"] += 1
+            done += 1
+        else:
+            to_compute.append((key, recs, h))
+
+    def _one(recs: List[dict]) -> Tuple[Optional[dict], float, Optional[str]]:
+        start = time.monotonic()
+        try:
+            sug = suggest_ai_merge(recs)
+        except Exception as e:
+            return None, time.monotonic() - start, str(e)
+        if not sug or not sug.get("suggested_golden_record") or _halted(sug):
+            return None, time.monotonic() - start, "no usable suggestion"
+        return sug, time.monotonic() - start, None
+
+    workers = AI_PRECOMPUTE_CONCURRENCY or provider_concurrency_limit()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ai-precompute-item") as pool:
+        futures = {pool.submit(_one, recs): (key, recs, h) for key, recs, h in to_compute}
+        for fut in as_completed(futures):
+            key, recs, h = futures[fut]
+            sug, elapsed, err = fut.result()
+            if err is None:
+                sug_json, tel_json = _serialize(sug)
+                pending.append(_row(key, recs, h, suggestion=sug_json, telemetry=tel_json,
+                                    human_review_required=bool(sug.get("human_review_required")),
+                                    elapsed_s=round(elapsed, 3)))
+                counts["computed"] += 1
+            else:
+                pending.append(_row(key, recs, h, status="error", error=err, elapsed_s=round(elapsed, 3)))
+                counts["errors"] += 1
+            done += 1
+            if len(pending) >= AI_PRECOMPUTE_FLUSH_EVERY:
+                _flush()
+    _flush()
+    _set_run(run_id, suggestions_status="done", suggestions_done=done)
+    print(f"INFO: Run {run_id}: {counts['computed']} AI suggestions computed, {counts['reused']} reused, "
+          f"{counts['errors']} errors.")
+    return counts
+
+
+def lookup_suggestion(session: Session, records: List[dict]) -> Optional[dict]:
+    """
+    Latest stored suggestion for exactly these records with this content, or
+    None. The golden record is re-anchored on the first record, as the live
+    merge would do.
+    """
+    row = session.exec(
+        select(AISuggestion)
+        .where(AISuggestion.records_hash == records_hash(records), AISuggestion.status == "ok")
+        .order_by(AISuggestion.id.desc())
+    ).first()
+    if row is None or not row.suggestion:
+        return None
+    suggestion = json.loads(row.suggestion)
+    suggestion["suggested_golden_record"]["record_id"] = str(records[0]["record_id"])
+    suggestion["processing_log"] = [f"INFO: Served precomputed suggestion (run {row.run_id})."] + \
+        suggestion.get("processing_log", [])
+    return suggestion
+
+
+def store_suggestion(run_id: Optional[int], records: List[dict], suggestion: dict, elapsed_s: float) -> None:
+    """Keeps a live suggestion so the next request for the same cluster content is served from the table."""
+    if _halted(suggestion):
+        return
+    sug_json, tel_json = _serialize(suggestion)
+    row = AISuggestion(
+        run_id=run_id or 0, cluster_key="live", records_hash=records_hash(records),
+        record_ids=",".join(sorted(str(r["record_id"]) for r in records)),
+        suggestion=sug_json, telemetry=tel_json,
+        human_review_required=bool(suggestion.get("human_review_required")), elapsed_s=round(elapsed_s, 3),
+    )
+    writer.run(lambda s: s.add(row))
@@ -1,9 +1,11 @@
 import pandas as pd
 from fastapi import HTTPException
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from .models import Patient, Link, ClusterAssignment
 from typing import Optional
 from .models import DedupeRun
+from .services.patient_keys import KEY_COLUMNS
 
 PATIENTS_COLUMNS = [
     "record_id","original_record_id","first_name","last_name","gender","date_of_birth",
@@ -11,11 +13,13 @@ PATIENTS_COLUMNS = [
 ]
 
 def df_from_patients_table(session: Session) -> pd.DataFrame:
+    """Patients as a DataFrame; the normalized key columns come along so scoring can reuse them."""
+    cols = PATIENTS_COLUMNS + KEY_COLUMNS
     rows = session.exec(select(Patient)).all()
     if not rows:
-        return pd.DataFrame(columns=PATIENTS_COLUMNS)
+        return pd.DataFrame(columns=cols)
     df = pd.DataFrame([r.__dict__ for r in rows])
-    return df[PATIENTS_COLUMNS]
+    return df[cols]
 
 def links_df_to_models(df: pd.DataFrame, run_id: int) -> list[Link]:
     needed = {
@@ -50,7 +54,16 @@ def links_df_to_models(df: pd.DataFrame, run_id: int) -> list[Link]:
         ))
     return out
 
-def clusters_to_assignments(clusters: list[list[str]], run_id: int) -> list[ClusterAssignment]:
+def clusters_to_assignments(clusters, run_id: int) -> list[ClusterAssignment]:
+    """
+    clusters: the clusters_df of run_pipeline (record_id, patient_id, ...) or a
+    list of member lists (patient ids are then numbered P00001, ...).
+    """
+    if isinstance(clusters, pd.DataFrame):
+        return [
+            ClusterAssignment(run_id=run_id, record_id=str(rid), patient_id=str(pid))
+            for rid, pid in zip(clusters["record_id"], clusters["patient_id"])
+        ]
     assignments: list[ClusterAssignment] = []
     for idx, members in enumerate(clusters, start=1):
         pid = f"P{idx:05d}"
@@ -58,12 +71,26 @@ def clusters_to_assignments(clusters: list[list[str]], run_id: int) -> list[Clus
             assignments.append(ClusterAssignment(run_id=run_id, record_id=str(rid), patient_id=pid))
     return assignments
 
+def finished_runs():
+    """WHERE clause for the runs whose links and assignments were fully persisted."""
+    return (DedupeRun.status == "completed") | DedupeRun.status.is_(None)
+
 def resolve_run_id(session: Session, run_id: Optional[int]) -> int:
     if run_id is not None:
         return run_id
     latest = session.exec(
-        select(DedupeRun).order_by(DedupeRun.created_at.desc())
+        select(DedupeRun).where(finished_runs()).order_by(DedupeRun.created_at.desc())
     ).first()
     if not latest:
         raise HTTPException(status_code=404, detail="No dedupe run found. Please run /dedupe/run first.")
-    return latest.id
\ No newline at end of file
+    return latest.id
+
+async def resolve_run_id_async(session: AsyncSession, run_id: Optional[int]) -> int:
+    if run_id is not None:
+        return run_id
+    latest = (await session.exec(
+        select(DedupeRun).where(finished_runs()).order_by(DedupeRun.created_at.desc())
+    )).first()
+    if not latest:
+        raise HTTPException(status_code=404, detail="No dedupe run found. Please run /dedupe/run first.")
+    return latest.id
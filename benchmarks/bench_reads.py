@@ -0,0 +1,180 @@
+"""
+Read-path benchmark: async handlers (aiosqlite) vs the former sync handlers.
+
+Runs in-process over httpx's ASGI transport, so it measures the app, not the
+network. The sync baselines are the pre-async handlers (same queries on a
+blocking Session), mounted under /bench/sync. Each scenario is run idle and
+while `--busy` slow sync requests (standing in for intake / ingest calls) hold
+threadpool threads.
+
+    python benchmarks/bench_reads.py --db /tmp/bench.db --concurrency 100 --requests 1000 --busy 40
+
+Results (400 patients, 1 run, 50 links per /links page; Python 3.11, anyio's
+default threadpool of 40; one process, so all scenarios share the GIL):
+
+    scenario                           req/s    p50 ms    p95 ms
+    links sync                           336     280.3     357.2
+    links async                          297     251.9     619.4
+    patient sync                         154     630.5     830.4
+    patient async                        156     580.8    1034.3
+    links sync + 40 busy                 151     523.1    1588.0
+    links async + 40 busy                272     289.8     658.4
+    patient sync + 40 busy                91    1062.3    1904.0
+    patient async + 40 busy              138     650.4    1191.9
+
+When idle the two paths are CPU-bound and close. When the threadpool is busy,
+the sync reads queue for a thread and the async ones do not. The patient read
+only gained this once get_current_user became an async dependency; as a sync
+dependency it still took a thread per request.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _setup_env(args) -> None:
+    db = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-reads-"), "bench.db")
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{db}", ASYNC_DATABASE_URL=f"sqlite+aiosqlite:///{db}",
+        # a connection per concurrent request: with fewer, the sync baseline
+        # deadlocks (every thread waits for a connection held by a request that
+        # needs a thread to serialize its response before releasing it)
+        DB_MAX_OVERFLOW=str(args.concurrency + 20), AI_WARMUP_ON_STARTUP="0", METRICS_ENABLED="0", PROFILING_ENABLED="0",
+        DEDUP_MODELS_DIR=os.path.join(os.path.dirname(db), "models"),
+    )
+
+
+def _mount_baselines(app) -> None:
+    """The sync handlers as they were before the async read path."""
+    from typing import List, Optional
+    from fastapi import Depends, HTTPException
+    from sqlmodel import Session, select
+    from app.db import get_session
+    from app.models import ClusterAssignment, Link, Patient
+    from app.routers.patients import _patient_to_out
+    from app.schemas import DuplicateCandidate, LinkOut, PatientWithDuplicates
+    from app.services.auth_service import get_current_user
+    from app.utils import resolve_run_id
+
+    @app.get("/bench/sync/links", response_model=List[LinkOut])
+    def sync_links(run_id: Optional[int] = None, limit: int = 100, offset: int = 0,
+                   session: Session = Depends(get_session)):
+        run_id = resolve_run_id(session, run_id)
+        rows = session.exec(select(Link).where(Link.run_id == run_id).order_by(Link.id).offset(offset).limit(limit)).all()
+        return [LinkOut.model_validate(r.__dict__) for r in rows]
+
+    @app.get("/bench/sync/patients/{record_id}", response_model=PatientWithDuplicates,
+             dependencies=[Depends(get_current_user)])
+    def sync_patient(record_id: str, run_id: Optional[int] = None, session: Session = Depends(get_session)):
+        run_id = resolve_run_id(session, run_id)
+        p = session.exec(select(Patient).where(Patient.record_id == record_id, Patient.is_deleted == 0)).first()
+        if not p:
+            raise HTTPException(status_code=404, detail="not found")
+        cluster = session.exec(select(ClusterAssignment).where(
+            ClusterAssignment.run_id == run_id, ClusterAssignment.record_id == record_id)).first()
+        links = session.exec(select(Link).where(
+            Link.run_id == run_id, Link.decision.in_(("match", "review")),
+            (Link.record_id1 == record_id) | (Link.record_id2 == record_id))
+            .order_by(Link.decision.desc(), Link.score.desc())).all()
+        others = [(l.record_id2 if l.record_id1 == record_id else l.record_id1) for l in links]
+        rid_to_patient = {op.record_id: op for op in session.exec(
+            select(Patient).where(Patient.record_id.in_(others))).all()}
+        dups = []
+        for l, other_id in zip(links, others):
+            op = rid_to_patient.get(other_id)
+            dups.append(DuplicateCandidate(
+                other_record_id=other_id, decision=l.decision, score=l.score or 0.0,
+                s_name=l.s_name, s_dob=l.s_dob, s_email=l.s_email, s_phone=l.s_phone,
+                s_address=l.s_address, s_gender=l.s_gender, s_ssn_hard_match=l.s_ssn_hard_match,
+                reason=l.reason, other_patient=_patient_to_out(op, None) if op else None))
+        return PatientWithDuplicates(patient=_patient_to_out(p, cluster.patient_id if cluster else None),
+                                     duplicates=dups)
+
+    @app.get("/bench/busy")
+    def busy(ms: int = 500):
+        time.sleep(ms / 1000)
+        return {"slept_ms": ms}
+
+
+async def _load(client, n: int, concurrency: int, make_url, headers) -> dict:
+    latencies = []
+    todo = iter(range(n))
+
+    async def _worker():
+        for i in todo:
+            t = time.perf_counter()
+            r = await client.get(make_url(i), headers=headers)
+            r.raise_for_status()
+            latencies.append((time.perf_counter() - t) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"rps": n / elapsed, "p50": statistics.median(latencies),
+            "p95": latencies[int(0.95 * (len(latencies) - 1))]}
+
+
+async def _main(args) -> None:
+    import httpx
+    from app.main import app
+    _mount_baselines(app)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+        token = (await client.post("/auth/login", json={"username": "admin@demo.local",
+                                                         "password": "adminpass"})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        if (await client.get("/links?limit=1")).status_code == 404:   # no dedupe run yet
+            with open(args.csv, encoding="utf-8") as f:
+                lines = f.readlines()[:args.rows + 1]
+            r = await client.post("/ingest/patients-csv", files={"file": ("bench.csv", "".join(lines))},
+                                  headers=headers)
+            r.raise_for_status()
+            (await client.post("/dedupe/run", headers=headers)).raise_for_status()
+
+        rids = [str(i) for i in range(1, args.rows + 1)]
+        scenarios = [
+            ("links sync", lambda i: "/bench/sync/links?limit=50"),
+            ("links async", lambda i: "/links?limit=50"),
+            ("patient sync", lambda i: f"/bench/sync/patients/{rids[i % len(rids)]}"),
+            ("patient async", lambda i: f"/patients/{rids[i % len(rids)]}"),
+        ]
+        print(f"{'scenario':32} {'req/s':>7} {'p50 ms':>9} {'p95 ms':>9}")
+        for busy in sorted({0, args.busy}):
+            for name, make_url in scenarios:
+                stop = asyncio.Event()
+
+                async def _hog():
+                    while not stop.is_set():
+                        await client.get("/bench/busy?ms=500")
+
+                hogs = [asyncio.create_task(_hog()) for _ in range(busy)]
+                await asyncio.sleep(0.2 if busy else 0)
+                res = await _load(client, args.requests, args.concurrency, make_url, headers)
+                stop.set()
+                await asyncio.gather(*hogs)
+                label = f"{name} + {busy} busy" if busy else name
+                print(f"{label:32} {res['rps']:7.0f} {res['p50']:9.1f} {res['p95']:9.1f}")
+
+    from app.db import async_engine
+    await async_engine.dispose()   # aiosqlite connection threads would keep the process alive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--csv", default="data_gen/synthetic_patient_records_with_duplicates.csv")
+    parser.add_argument("--rows", type=int, default=400)
+    parser.add_argument("--db", help="database file to use (kept); ingest + dedupe run only when it has no run")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--busy", type=int, default=40, help="concurrent slow sync requests in the busy scenarios")
+    args = parser.parse_args()
+    _setup_env(args)
+    asyncio.run(_main(args))
@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+# The engine is created when app.db is imported: point it at a scratch
+# database and keep the optional startup work off before importing the app.
+_TMP = tempfile.mkdtemp(prefix="dedup-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_TMP}/patients.db")
+os.environ.setdefault("DEDUP_MODELS_DIR", _TMP)
+os.environ.setdefault("AI_WARMUP_ON_STARTUP", "0")
+os.environ.setdefault("METRICS_ENABLED", "0")
+os.environ.setdefault("PROFILING_ENABLED", "0")
+
+import pytest
+from sqlalchemy import delete
+from sqlmodel import Session
+
+from app.db import engine, init_db
+from app.models import AutoMergeJob, ClusterAssignment, DedupeRun, Link, Patient, PatientMergeHistory
+from app.services.intake_index import intake_index
+
+init_db()
+
+
+@pytest.fixture()
+def db():
+    """A session on an emptied database (the change counters are kept)."""
+    with Session(engine) as s:
+        for table in (PatientMergeHistory, AutoMergeJob, ClusterAssignment, Link, DedupeRun, Patient):
+            s.exec(delete(table))
+        s.commit()
+    intake_index.invalidate()
+    with Session(engine) as s:
+        yield s
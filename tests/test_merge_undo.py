@@ -0,0 +1,180 @@
+import pytest
+from sqlalchemy import update
+from sqlmodel import Session, select
+
+from app.db import change_counters, engine, writer
+from app.models import AutoMergeJob, ClusterAssignment, DedupeRun, Link, Patient, PatientMergeHistory
+from app.schemas import BulkMergeGroup, BulkMergeRequest, PatientUpdate
+from app.services.auto_merge import undo_auto_merge
+from app.services.bulk_merge import merge_bulk
+
+# Two groups: p1 <- p5, p6 and p8 <- p3; p0 and p4 are left alone.
+GROUPS = [("p1", ["p5", "p6"]), ("p8", ["p3"])]
+LINKS = [
+    # id, record_id1, record_id2, decision, score
+    (1, "p1", "p5", "match", 0.95),    # becomes a self-link
+    (2, "p0", "p5", "match", 0.80),    # -> (p0, p1), best of its pair
+    (3, "p0", "p6", "match", 0.70),    # -> (p0, p1), dropped
+    (4, "p0", "p1", "match", 0.60),    # the master's own link, dropped
+    (5, "p3", "p6", "review", 0.50),   # touched by both groups -> (p1, p8)
+    (6, "p3", "p4", "match", 0.90),    # -> (p4, p8), order flips
+    (7, "p0", "p6", "review", 0.40),   # -> (p0, p1), other decision, kept
+    (8, "p3", "p8", "match", 0.99),    # becomes a self-link
+]
+CLUSTERS = {"p1": "P1", "p5": "P1", "p6": "P1", "p8": "P2", "p3": "P2", "p0": "P3", "p4": "P3"}
+
+
+@pytest.fixture()
+def run_id(db):
+    run = DedupeRun(status="completed")
+    db.add(run)
+    db.commit()
+    for rid, pid in CLUSTERS.items():
+        db.add(Patient(record_id=rid, first_name=f"Name {rid}", last_name="Popescu", date_of_birth="1980-01-01"))
+        db.add(ClusterAssignment(run_id=run.id, record_id=rid, patient_id=pid))
+    for lid, r1, r2, decision, score in LINKS:
+        db.add(Link(id=lid, run_id=run.id, record_id1=r1, record_id2=r2, decision=decision, score=score))
+    db.commit()
+    return run.id
+
+
+def _job(db, run_id: int) -> int:
+    job = AutoMergeJob(run_id=run_id, status="running")
+    db.add(job)
+    db.commit()
+    return job.id
+
+
+def _merge(run_id: int, job_id=None, hard=False, batch_size=None, updates=None):
+    req = BulkMergeRequest(
+        groups=[BulkMergeGroup(master_record_id=m, duplicate_record_ids=ds, updates=(updates or {}).get(m))
+                for m, ds in GROUPS],
+        reason="test", run_id=run_id, hard_delete_duplicates=hard, batch_size=batch_size,
+    )
+    out = merge_bulk(req, job_id=job_id)
+    if job_id is not None:
+        writer.run(lambda s: s.exec(update(AutoMergeJob).where(AutoMergeJob.id == job_id).values(status="done")))
+    return out
+
+
+def _snapshot():
+    with Session(engine) as s:
+        patients = {p.record_id: (p.first_name, p.is_deleted, p.merged_into, p.deleted_at)
+                    for p in s.exec(select(Patient))}
+        links = sorted(tuple(row) for row in s.execute(select(Link.__table__)))
+        clusters = {c.id: (c.record_id, c.patient_id) for c in s.exec(select(ClusterAssignment))}
+    return patients, links, clusters
+
+
+def _links():
+    with Session(engine) as s:
+        return {(l.id, l.record_id1, l.record_id2, l.decision) for l in s.exec(select(Link))}
+
+
+def _set_deleted(rid: str, merged_into=None) -> None:
+    """An edit made after the job: the record is restored (and optionally merged elsewhere)."""
+    writer.run(lambda s: s.exec(update(Patient).where(Patient.record_id == rid).values(
+        is_deleted=merged_into is not None, merged_into=merged_into)))
+
+
+def test_links_are_repointed_deduped_and_canonical(run_id):
+    out = _merge(run_id)
+
+    assert (out.merged, out.failed) == (2, 0)
+    assert _links() == {
+        (2, "p0", "p1", "match"),
+        (5, "p1", "p8", "review"),
+        (6, "p4", "p8", "match"),
+        (7, "p0", "p1", "review"),
+    }
+    with Session(engine) as s:
+        moved = {c.record_id for c in s.exec(select(ClusterAssignment).where(ClusterAssignment.patient_id != "P3"))}
+    assert moved == {"p1", "p8"}
+
+
+def test_soft_delete_keeps_duplicates_pointing_at_master(run_id):
+    _merge(run_id)
+
+    patients, _, _ = _snapshot()
+    for master, dups in GROUPS:
+        assert patients[master][1:3] == (False, None)
+        for d in dups:
+            assert patients[d][1:3] == (True, master)
+            assert patients[d][3] is not None
+
+
+def test_hard_delete_removes_duplicates_and_cannot_be_undone(db, run_id):
+    _, deletes_before = change_counters(db)
+    job_id = _job(db, run_id)
+    _merge(run_id, job_id=job_id, hard=True)
+
+    patients, _, _ = _snapshot()
+    assert sorted(patients) == ["p0", "p1", "p4", "p8"]
+    with Session(engine) as s:
+        assert change_counters(s)[1] == deletes_before + 3
+    assert len(_links()) == 4
+
+    links = _links()
+    out = undo_auto_merge(job_id)
+    assert (out.groups_undone, out.records_restored) == (0, 0)
+    assert sorted(out.failed) == ["p1", "p8"]
+    assert _links() == links
+
+
+@pytest.mark.parametrize("batch_size", [None, 1])
+def test_undo_restores_the_pre_merge_state(db, run_id, batch_size):
+    before = _snapshot()
+    job_id = _job(db, run_id)
+    _merge(run_id, job_id=job_id, batch_size=batch_size,
+           updates={"p1": PatientUpdate(first_name="Ion"), "p8": PatientUpdate(last_name="Ionescu")})
+    assert _snapshot()[0]["p1"][0] == "Ion"
+
+    out = undo_auto_merge(job_id)
+
+    assert (out.groups_undone, out.records_restored, out.failed) == (2, 3, [])
+    assert _snapshot() == before
+    with Session(engine) as s:
+        assert s.get(Patient, s.exec(select(Patient.id).where(Patient.record_id == "p8")).one()).last_name == "Popescu"
+        assert s.get(AutoMergeJob, job_id).status == "undone"
+        assert all(h.undone_at for h in s.exec(select(PatientMergeHistory).where(PatientMergeHistory.job_id == job_id)))
+    # a second undo has nothing left to do
+    assert undo_auto_merge(job_id).groups_undone == 0
+
+
+def test_shared_link_returns_to_its_oldest_snapshot(db, run_id):
+    # one group per batch: link 5 is moved by p1's group, then again by p8's
+    job_id = _job(db, run_id)
+    _merge(run_id, job_id=job_id, batch_size=1)
+    with Session(engine) as s:
+        firsts = s.exec(select(PatientMergeHistory).where(PatientMergeHistory.undo.is_not(None))).all()
+    assert len(firsts) == 2
+    assert (5, "p1", "p8", "review") in _links()
+
+    undo_auto_merge(job_id)
+
+    assert (5, "p3", "p6", "review") in _links()
+
+
+@pytest.mark.parametrize("merged_again", [False, True])
+def test_undo_skips_groups_whose_duplicate_changed(db, run_id, merged_again):
+    job_id = _job(db, run_id)
+    _merge(run_id, job_id=job_id, batch_size=1, updates={"p1": PatientUpdate(first_name="Ion")})
+    _set_deleted("p6")
+    if merged_again:
+        merge_bulk(BulkMergeRequest(groups=[BulkMergeGroup(master_record_id="p0", duplicate_record_ids=["p6"])]))
+    after_edit = _snapshot()[0]
+
+    out = undo_auto_merge(job_id)
+
+    assert (out.groups_undone, out.records_restored, out.failed) == (1, 1, ["p1"])
+    patients, _, _ = _snapshot()
+    for rid in ("p1", "p5", "p6"):
+        assert patients[rid] == after_edit[rid]
+    assert patients["p3"][1:3] == (False, None)
+    assert patients["p6"][1:3] == ((True, "p0") if merged_again else (False, None))
+    # p8's group is undone: link 5 goes back to p1's snapshot, not the original
+    assert (5, "p1", "p3", "review") in _links()
+    with Session(engine) as s:
+        pending = s.exec(select(PatientMergeHistory.target_record).where(
+            PatientMergeHistory.job_id == job_id, PatientMergeHistory.undone_at.is_(None))).all()
+    assert sorted(pending) == ["p1", "p1"]